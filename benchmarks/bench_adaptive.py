@@ -0,0 +1,92 @@
+"""
+Compare fixed thread counts with adaptive concurrency against simulated servers.
+Every profile starts its own stand-in server: a plain high-latency server, a server that can only serve a few
+requests at once, and a rate-limited server that answers 429 above its rate. URLDownloader_v2 downloads the same
+urls with every fixed num_thread and once with adaptive_concurrency=True (num_thread is then the upper bound).
+The result of every run is printed as one JSON line.
+
+Usage:
+    python benchmarks/bench_adaptive.py --num-urls 2000 --max-threads 64
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import URLDownloader_v2  # noqa: E402
+from stand_in_server import start_server_process  # noqa: E402
+
+PROFILES = {
+    "latency_50ms": {"latency_ms": 50, "body_size": 4096},
+    "capacity_8": {"latency_ms": 20, "body_size": 4096, "capacity": 8},
+    "rate_limit_300": {"latency_ms": 20, "body_size": 4096, "rate_limit": 300},
+}
+
+
+def run_download(profile: str, mode: str, url_list, num_thread: int, **kwargs) -> dict:
+    """
+    This function downloads url_list once and measures it.
+
+    Parameters:
+        profile (string): the server profile in the report.
+        mode (string): the mode in the report.
+        url_list (list): the urls to download.
+        num_thread (int): the num_thread argument of URLDownloader_v2.
+        kwargs: other constructor arguments of URLDownloader_v2.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_adaptive_")
+    try:
+        downloader = URLDownloader_v2(url_list, out_path, num_thread, verbose=False, **kwargs)
+        start = time.perf_counter()
+        downloader.download_all_sites()
+        wall = time.perf_counter() - start
+        snapshot = downloader.get_metrics()
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    result = {
+        "profile": profile,
+        "mode": mode,
+        "ok": snapshot["counters"].get("urls_ok", 0),
+        "throttled": snapshot["status_codes"].get("429", 0),
+        "wall_s": round(wall, 3),
+        "ok_per_s": round(snapshot["counters"].get("urls_ok", 0) / wall, 1),
+        "p50_latency_s": snapshot["latency_s"]["total"]["p50"],
+    }
+    history = getattr(downloader.host_limiter, "history", None)
+    if history:
+        settled = [limit for _, limit in history[len(history) // 2:]]
+        result["final_limit"] = history[-1][1]
+        result["settled_mean_limit"] = round(sum(settled) / len(settled), 1)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=2000)
+    parser.add_argument("--fixed-threads", type=int, nargs="+", default=[4, 16, 64])
+    parser.add_argument("--max-threads", type=int, default=64)
+    parser.add_argument("--profiles", nargs="+", default=list(PROFILES), choices=list(PROFILES))
+    args = parser.parse_args(argv)
+
+    for profile in args.profiles:
+        process, base_url = start_server_process(**PROFILES[profile])
+        try:
+            url_list = ["{}/img/{}.jpg".format(base_url, i) for i in range(args.num_urls)]
+            for num_thread in args.fixed_threads:
+                print(json.dumps(run_download(profile, "fixed_{}".format(num_thread), url_list, num_thread)), flush=True)
+            print(json.dumps(run_download(profile, "adaptive", url_list, args.max_threads, adaptive_concurrency=True)), flush=True)
+        finally:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compare the threaded and the asyncio download engines against the local stand-in server.
+Each engine downloads the same manifest into a fresh temp folder; the result of every engine is printed as one JSON line.
+
+Usage:
+    python benchmarks/bench_engines.py --num-urls 5000 --latency-ms 50 --threads 32 --concurrency 1000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import URLDownloader_v2, AsyncURLDownloader  # noqa: E402
+from stand_in_server import start_server_process  # noqa: E402
+
+
+def run_engine(name: str, engine_cls, url_list, num_thread: int, **kwargs) -> dict:
+    """
+    This function downloads url_list with one engine and measures it.
+
+    Parameters:
+        name (string): the engine name in the report.
+        engine_cls (class): URLDownloader_v2 or one of its subclasses.
+        url_list (list): the urls to download.
+        num_thread (int): the num_thread argument of the engine.
+        kwargs: other constructor arguments of the engine.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_{}_".format(name))
+    try:
+        downloader = engine_cls(url_list, out_path, num_thread, verbose=False, **kwargs)
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        downloader.download_all_sites()
+        cpu = time.process_time() - cpu_start
+        wall = time.perf_counter() - wall_start
+        with open(downloader.log_file) as f:
+            statuses = [line.rstrip("\n").split("\t")[1] for line in f]
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return {
+        "engine": name,
+        "num_urls": len(url_list),
+        "ok": statuses.count("o"),
+        "wall_s": round(wall, 3),
+        "urls_per_s": round(len(url_list) / wall, 1),
+        "cpu_s": round(cpu, 3),
+        "cpu_ms_per_url": round(cpu * 1000 / len(url_list), 4),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--body-size", type=int, default=10000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--engines", default="threaded,async")
+    args = parser.parse_args(argv)
+
+    server, base_url = start_server_process(latency_ms=args.latency_ms, body_size=args.body_size)
+    try:
+        url_list = ["{}/item/{}.bin".format(base_url, i) for i in range(args.num_urls)]
+        engines = args.engines.split(",")
+        if "threaded" in engines:
+            # every thread keeps its connection idle in the pool between urls, so the pool holds one per thread
+            print(json.dumps(run_engine("threaded", URLDownloader_v2, url_list, args.threads,
+                                        pool_maxsize_per_host=args.threads)), flush=True)
+        if "async" in engines:
+            print(json.dumps(run_engine("async", AsyncURLDownloader, url_list, args.threads,
+                                        max_concurrency=args.concurrency)), flush=True)
+    finally:
+        server.terminate()
+
+
+if __name__ == "__main__":
+    main()
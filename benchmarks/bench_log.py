@@ -0,0 +1,120 @@
+"""
+Measure the cost of appending finished urls to the log and of loading the log on resume.
+The append cases write the same entries one url at a time: by opening the log for every url, as
+URLDownloader_v1 did, and through a LogWriter with every fsync policy ("data" also fsyncs one saved file per url).
+The load cases build a ResumeIndex from a text and from a binary log of the same entries.
+The result of every case is printed as one JSON line.
+
+Usage:
+    python benchmarks/bench_log.py --num-urls 200000 --load-urls 1000000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import LogWriter, ResumeIndex, fsync_file  # noqa: E402
+
+URL_TEMPLATE = "https://images.example-cdn.com/product/converted/{0:09d}/{0:09d}lg.jpg"
+
+
+def append_open_per_url(log_file: str, urls):
+    for url in urls:
+        with open(log_file, "a") as f:
+            f.write("{}\t{}\n".format(url, "o"))
+
+
+def append_log_writer(log_file: str, urls, fsync: str, data_file: str):
+    writer = LogWriter(log_file, "text", flush_interval=1.0, batch_size=1024, fsync=fsync)
+    for url in urls:
+        if fsync == "data":
+            fsync_file(data_file)
+        writer.write([(url, False)])
+    writer.close()
+
+
+def run_append(case: str, num_urls: int) -> dict:
+    """
+    This function appends [num_urls] entries one url at a time and measures the time per url.
+
+    Parameters:
+        case (string): "open_per_url" or "writer_<fsync policy>".
+        num_urls (int): the number of appended entries.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_log_")
+    try:
+        log_file = os.path.join(out_path, "downloaded.log")
+        data_file = os.path.join(out_path, "data.jpg")
+        with open(data_file, "wb") as f:
+            f.write(b"\0" * 4096)
+        urls = [URL_TEMPLATE.format(i) for i in range(num_urls)]
+        start = time.perf_counter()
+        if case == "open_per_url":
+            append_open_per_url(log_file, urls)
+        else:
+            append_log_writer(log_file, urls, case[len("writer_"):], data_file)
+        wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return {"case": case, "urls": num_urls, "wall_s": round(wall, 3), "us_per_url": round(wall * 1e6 / num_urls, 3)}
+
+
+def run_load(log_format: str, num_urls: int) -> dict:
+    """
+    This function writes a log of [num_urls] entries and measures how long ResumeIndex takes to load it.
+
+    Parameters:
+        log_format (string): "text" or "binary".
+        num_urls (int): the number of entries in the log.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_log_")
+    try:
+        log_file = os.path.join(out_path, "downloaded.log")
+        writer = LogWriter(log_file, log_format, flush_interval=0)
+        for start in range(0, num_urls, 1 << 16):
+            writer.write([(URL_TEMPLATE.format(i), i % 100 == 0) for i in range(start, min(start + (1 << 16), num_urls))])
+        writer.close()
+        start = time.perf_counter()
+        index = ResumeIndex(log_file, log_format)
+        wall = time.perf_counter() - start
+        assert index.num_lines == num_urls
+        size = os.path.getsize(log_file)
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return {
+        "case": "load_{}".format(log_format),
+        "urls": num_urls,
+        "log_mb": round(size / (1 << 20), 1),
+        "wall_s": round(wall, 3),
+        "us_per_url": round(wall * 1e6 / num_urls, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=200000)
+    parser.add_argument("--fsync-urls", type=int, default=2000, help="the number of urls of the fsync cases")
+    parser.add_argument("--load-urls", type=int, default=1000000)
+    args = parser.parse_args(argv)
+
+    for case in ("open_per_url", "writer_none"):
+        print(json.dumps(run_append(case, args.num_urls)), flush=True)
+    for case in ("writer_log", "writer_data"):
+        print(json.dumps(run_append(case, args.fsync_urls)), flush=True)
+    for log_format in ("text", "binary"):
+        print(json.dumps(run_load(log_format, args.load_urls)), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Measure the cost of the metrics instrumentation on the download hot path.
+Every url records one attempt and one finished url; this benchmark times exactly those calls,
+single-threaded and from several threads contending on the metrics lock, with and without a hook.
+The result of every case is printed as one JSON line.
+
+Usage:
+    python benchmarks/bench_metrics.py --calls 200000 --threads 32
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import DownloadMetrics  # noqa: E402
+
+
+def record_calls(metrics: DownloadMetrics, num_calls: int):
+    for i in range(num_calls):
+        host = "host{}.example.com".format(i & 15)
+        metrics.record_attempt("http://{}/{}.jpg".format(host, i), host, 200, True, 4096, 0.0, 0.004, 0.001)
+        metrics.record_url(host, True)
+
+
+def run_case(name: str, num_calls: int, num_thread: int, with_hook: bool) -> dict:
+    """
+    This function records [num_calls] urls split over [num_thread] threads and measures the time per url.
+
+    Parameters:
+        name (string): the case name in the report.
+        num_calls (int): the total number of recorded urls.
+        num_thread (int): the number of recording threads.
+        with_hook (boolean): whether a no-op hook is attached.
+
+    Returns:
+        the measurement (dict)
+    """
+    metrics = DownloadMetrics()
+    if with_hook:
+        metrics.add_hook(lambda event: None)
+    per_thread = num_calls // num_thread
+    threads = [threading.Thread(target=record_calls, args=(metrics, per_thread)) for _ in range(num_thread)]
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    cpu = time.process_time() - cpu_start
+    wall = time.perf_counter() - wall_start
+    total = per_thread * num_thread
+    assert metrics.counters["urls_ok"] == total
+    return {
+        "case": name,
+        "calls": total,
+        "threads": num_thread,
+        "wall_s": round(wall, 3),
+        "cpu_us_per_url": round(cpu * 1e6 / total, 3),
+    }
+
+
+def run_baseline(num_calls: int) -> dict:
+    # the string formatting of record_calls without any metrics call, subtracted to get the pure overhead
+    start = time.process_time()
+    for i in range(num_calls):
+        host = "host{}.example.com".format(i & 15)
+        "http://{}/{}.jpg".format(host, i)
+    cpu = time.process_time() - start
+    return {"case": "baseline", "calls": num_calls, "threads": 1, "cpu_us_per_url": round(cpu * 1e6 / num_calls, 3)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=32)
+    args = parser.parse_args(argv)
+
+    print(json.dumps(run_baseline(args.calls)))
+    print(json.dumps(run_case("single_thread", args.calls, 1, False)))
+    print(json.dumps(run_case("single_thread_hook", args.calls, 1, True)))
+    print(json.dumps(run_case("contended", args.calls, args.threads, False)))
+    print(json.dumps(run_case("contended_hook", args.calls, args.threads, True)))
+
+
+if __name__ == "__main__":
+    main()
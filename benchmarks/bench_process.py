@@ -0,0 +1,107 @@
+"""
+Measure a CPU-heavy step on the downloaded bodies run inline by the download threads versus in worker processes, offline.
+Every body from a stand-in server (see stand_in_server.py) is summed [work] times in Python, a stand-in for image
+decode and resize that holds the GIL. The inline case runs it in a custom_img_saver on the download threads, as before the
+processor existed; the other cases hand the bodies to a processor with every number of [process_workers].
+Every case is printed as one JSON line with URLs/s and the stages of get_metrics(), whose secs_per_item and
+utilization tell how many threads or processes every stage needs.
+
+Usage:
+    python benchmarks/bench_process.py --num-urls 500 --work 50 --process-workers 1 2 4
+"""
+import argparse
+import functools
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import URLDownloader_v2  # noqa: E402
+from stand_in_server import start_server_process  # noqa: E402
+
+
+def burn(body: bytes, work: int) -> bytes:
+    checksum = 0
+    for _ in range(work):
+        checksum = (checksum * 31 + sum(body)) & 0xffffffff
+    return checksum.to_bytes(4, "big") + body
+
+
+def checksum_file(url: str, path: str, work: int):
+    # the processor, at module level so the spawned workers can unpickle it
+    with open(path, "rb") as f:
+        body = f.read()
+    with open(path, "wb") as f:
+        f.write(burn(body, work))
+
+
+def run_case(case: str, urls, num_thread: int, work: int, process_workers: int) -> dict:
+    """
+    This function downloads the urls with one case and measures it.
+
+    Parameters:
+        case (string): "inline" or "process".
+        urls (list): the urls to download.
+        num_thread (int): the number of download workers.
+        work (int): the rounds of summing every body.
+        process_workers (int): the number of worker processes of the process case.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_process_")
+
+    def save_inline(outpath, response):
+        with open(outpath, "wb") as f:
+            f.write(burn(response.content, work))
+
+    try:
+        if case == "inline":
+            downloader = URLDownloader_v2(urls, out_path, num_thread, verbose=False, custom_img_saver=save_inline)
+        else:
+            downloader = URLDownloader_v2(urls, out_path, num_thread, verbose=False,
+                                          processor=functools.partial(checksum_file, work=work),
+                                          process_workers=process_workers)
+        start = time.perf_counter()
+        downloader.download_all_sites()
+        wall = time.perf_counter() - start
+        stages = downloader.get_metrics()["stages"]
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return {
+        "case": case,
+        "process_workers": process_workers if case == "process" else None,
+        "urls": len(urls),
+        "wall_s": round(wall, 3),
+        "urls_per_s": round(len(urls) / wall, 1),
+        "stages": stages,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--body-size", type=int, default=64 << 10)
+    parser.add_argument("--work", type=int, default=50)
+    parser.add_argument("--process-workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args(argv)
+
+    server, base_url = start_server_process(latency_ms=args.latency_ms, body_size=args.body_size)
+    try:
+        urls = ["{}/img/{:07d}.jpg".format(base_url, i) for i in range(args.num_urls)]
+        print(json.dumps(run_case("inline", urls, args.threads, args.work, 0)), flush=True)
+        for process_workers in args.process_workers:
+            print(json.dumps(run_case("process", urls, args.threads, args.work, process_workers)), flush=True)
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
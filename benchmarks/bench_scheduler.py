@@ -0,0 +1,98 @@
+"""
+Measure the dispatch order of the scheduler on a manifest that is sorted by host, offline.
+[num_hosts] stand-in servers (see stand_in_server.py) act as separate hosts, and the manifest lists all urls of
+the first host, then all urls of the second, and so on, with every [priority_every]-th url marked as high priority.
+Every host allows [per_host] downloads in flight. The manifest is downloaded with every schedule_window, 1 being
+the input order, with and without the priorities. Every run is printed as one JSON line with URLs/s and the secs
+until the first and the last high-priority url finished.
+
+Usage:
+    python benchmarks/bench_scheduler.py --num-hosts 4 --urls-per-host 300 --per-host 2 --windows 1 1024 65536
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import URLDownloader_v2  # noqa: E402
+from stand_in_server import start_server_process  # noqa: E402
+
+
+def run_window(urls, high, window: int, use_priority: bool, num_thread: int, per_host: int) -> dict:
+    """
+    This function downloads the urls with one schedule_window and measures it.
+
+    Parameters:
+        urls (list): the urls, in manifest order.
+        high (set): the high-priority urls.
+        window (int): the schedule_window.
+        use_priority (boolean): whether the high-priority urls get a higher priority.
+        num_thread (int): the number of workers.
+        per_host (int): the max_in_flight_per_host.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_scheduler_")
+    finished = []
+    lock = threading.Lock()
+
+    def on_attempt(event):
+        if event["url"] in high and event["saved"]:
+            with lock:
+                finished.append(time.perf_counter())
+
+    try:
+        priority_fn = (lambda url: 1 if url in high else 0) if use_priority else None
+        downloader = URLDownloader_v2(urls, out_path, num_thread, verbose=False, max_in_flight_per_host=per_host,
+                                      schedule_window=window, priority_fn=priority_fn)
+        downloader.metrics.add_hook(on_attempt)
+        start = time.perf_counter()
+        downloader.download_all_sites()
+        wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return {
+        "window": window,
+        "priority": use_priority,
+        "urls": len(urls),
+        "wall_s": round(wall, 3),
+        "urls_per_s": round(len(urls) / wall, 1),
+        "first_high_s": round(min(finished) - start, 3) if finished else None,
+        "last_high_s": round(max(finished) - start, 3) if finished else None,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-hosts", type=int, default=4)
+    parser.add_argument("--urls-per-host", type=int, default=300)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--per-host", type=int, default=2)
+    parser.add_argument("--latency-ms", type=float, default=50)
+    parser.add_argument("--body-size", type=int, default=10000)
+    parser.add_argument("--priority-every", type=int, default=30)
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 1024, 65536])
+    args = parser.parse_args(argv)
+
+    servers = [start_server_process(latency_ms=args.latency_ms, body_size=args.body_size) for _ in range(args.num_hosts)]
+    try:
+        urls = ["{}/item/{:07d}.jpg".format(base_url, i) for _, base_url in servers for i in range(args.urls_per_host)]
+        high = set(urls[args.priority_every - 1::args.priority_every])
+        for window in args.windows:
+            for use_priority in (False, True):
+                print(json.dumps(run_window(urls, high, window, use_priority, args.threads, args.per_host)), flush=True)
+    finally:
+        for process, _ in servers:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Measure how the sharded mode scales with the number of processes.
+The same manifest is downloaded by run_sharded with every process count into a fresh temp folder;
+the result of every count is printed as one JSON line. Scaling needs free cores for both the shards and
+the stand-in server, so compare counts up to about half of the cores of the machine.
+
+Usage:
+    python benchmarks/bench_shards.py --num-urls 20000 --processes 1 2 4 --threads 16
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import run_sharded  # noqa: E402
+from stand_in_server import start_server_process  # noqa: E402
+
+
+def run_processes(manifest: str, num_urls: int, num_process: int, num_thread: int) -> dict:
+    """
+    This function downloads the manifest with [num_process] shards and measures it.
+
+    Parameters:
+        manifest (string): the path to the manifest.
+        num_urls (int): the number of urls in the manifest.
+        num_process (int): the number of processes.
+        num_thread (int): the num_thread of every shard.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_shards_")
+    try:
+        start = time.perf_counter()
+        run_sharded(manifest, out_path, num_process, num_thread=num_thread, verbose=False)
+        wall = time.perf_counter() - start
+        with open(os.path.join(out_path, "downloaded.log")) as f:
+            num_ok = sum(1 for line in f if line.rstrip("\n").endswith("\to"))
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return {
+        "processes": num_process,
+        "threads_per_process": num_thread,
+        "ok": num_ok,
+        "wall_s": round(wall, 3),
+        "urls_per_s": round(num_urls / wall, 1),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=20000)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--body-size", type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    process, base_url = start_server_process(latency_ms=args.latency_ms, body_size=args.body_size)
+    manifest_dir = tempfile.mkdtemp(prefix="bench_shards_manifest_")
+    try:
+        manifest = os.path.join(manifest_dir, "manifest.txt")
+        with open(manifest, "w") as f:
+            for i in range(args.num_urls):
+                f.write("{}/img/{}.jpg\n".format(base_url, i))
+        for num_process in args.processes:
+            print(json.dumps(run_processes(manifest, args.num_urls, num_process, args.threads)), flush=True)
+    finally:
+        process.terminate()
+        process.join()
+        shutil.rmtree(manifest_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
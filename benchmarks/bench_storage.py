@@ -0,0 +1,110 @@
+"""
+Measure the storage backends and the I/O threads of URLDownloader_v2, offline.
+The same manifest of small bodies from a stand-in server (see stand_in_server.py) is downloaded into every
+backend: FileStorage without and with I/O threads, TarShardStorage, and S3Storage against a stand-in store
+(see stand_in_s3.py) with [s3_latency_ms] per request. Every case reports URLs/s, the number of files it created
+in the output folder and the time to read back [num_reads] random bodies through the backend.
+The result of every case is printed as one JSON line.
+
+Usage:
+    python benchmarks/bench_storage.py --num-urls 20000 --threads 16
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import URLDownloader_v2, FileStorage, TarShardStorage, S3Storage  # noqa: E402
+from stand_in_server import start_server_process  # noqa: E402
+from stand_in_s3 import start_s3_process  # noqa: E402
+
+CASES = ("file_inline", "file_io_threads", "tar", "s3_inline", "s3_io_threads")
+
+
+def make_storage(case: str, s3_endpoint: str):
+    if case.startswith("tar"):
+        return TarShardStorage()
+    if case.startswith("s3"):
+        return S3Storage(s3_endpoint, "bench", "{}/".format(case), "bench", "bench-secret")
+    return FileStorage()
+
+
+def count_files(out_path: str) -> int:
+    return sum(len(files) for _, _, files in os.walk(out_path))
+
+
+def run_case(case: str, urls, num_thread: int, io_threads: int, num_reads: int, s3_endpoint: str) -> dict:
+    """
+    This function downloads the urls into one backend and measures it.
+
+    Parameters:
+        case (string): one of CASES.
+        urls (list): the urls to download.
+        num_thread (int): the number of download workers.
+        io_threads (int): the number of I/O threads of the *_io_threads and tar cases.
+        num_reads (int): the number of bodies read back.
+        s3_endpoint (string): the endpoint of the stand-in store.
+
+    Returns:
+        the measurement (dict)
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_storage_")
+    try:
+        storage = make_storage(case, s3_endpoint)
+        downloader = URLDownloader_v2(urls, out_path, num_thread, verbose=False, storage=storage,
+                                      io_threads=0 if case.endswith("inline") else io_threads)
+        start = time.perf_counter()
+        downloader.download_all_sites()
+        wall = time.perf_counter() - start
+        num_files = count_files(out_path)
+        outpaths = [outpath for _, _, _, outpath in downloader.iter_outpaths()]
+        sample = random.Random(0).sample(outpaths, min(num_reads, len(outpaths)))
+        start = time.perf_counter()
+        num_bytes = sum(len(storage.read(outpath)) for outpath in sample)
+        read_wall = time.perf_counter() - start
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    return {
+        "case": case,
+        "urls": len(urls),
+        "wall_s": round(wall, 3),
+        "urls_per_s": round(len(urls) / wall, 1),
+        "files": num_files,
+        "read_ms_per_body": round(read_wall * 1000 / max(len(sample), 1), 3),
+        "read_bytes": num_bytes,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--io-threads", type=int, default=4)
+    parser.add_argument("--body-size", type=int, default=4096)
+    parser.add_argument("--latency-ms", type=float, default=2)
+    parser.add_argument("--s3-latency-ms", type=float, default=5)
+    parser.add_argument("--num-reads", type=int, default=1000)
+    parser.add_argument("--cases", nargs="+", default=list(CASES), choices=CASES)
+    args = parser.parse_args(argv)
+
+    server, base_url = start_server_process(latency_ms=args.latency_ms, body_size=args.body_size)
+    s3, s3_endpoint = start_s3_process(latency_ms=args.s3_latency_ms, access_key="bench", secret_key="bench-secret")
+    try:
+        urls = ["{}/img/{:07d}.jpg".format(base_url, i) for i in range(args.num_urls)]
+        for case in args.cases:
+            print(json.dumps(run_case(case, urls, args.threads, args.io_threads, args.num_reads, s3_endpoint)), flush=True)
+    finally:
+        server.terminate()
+        s3.terminate()
+        server.join()
+        s3.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Run every download engine over fixed manifests against stand-in servers with different behaviours, offline.
+Every scenario starts its own stand-in server (see stand_in_server.py) and writes a fixed manifest of
+[num_urls] urls; every engine downloads it in a fresh spawned process, so peak RSS and CPU time are its own.
+The result of every (scenario, engine) pair is printed as one JSON line with URLs/s, bytes/s, the p50/p99
+latency of the attempts, the peak RSS growth and the CPU time per url, so runs can be saved and compared:
+
+Usage:
+    python benchmarks/bench_suite.py --num-urls 1000 --output before.jsonl
+    python benchmarks/bench_suite.py --num-urls 1000 --output after.jsonl
+    python benchmarks/bench_suite.py --compare before.jsonl after.jsonl
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import URLDownloader_v1, URLDownloader_v2, AsyncURLDownloader, RetryPolicy, LogReader, aiohttp  # noqa: E402
+from stand_in_server import start_server_process  # noqa: E402
+
+# the server options of every scenario, the sizes of the bodies in its manifest and the share of its urls
+# whose connection is cut in the middle of the body unless a Range request continues it
+SCENARIOS = {
+    "baseline": {"server": {"latency_ms": 20, "body_size": 10000}},
+    "lognormal_latency": {"server": {"latency_ms": 30, "latency_dist": "lognormal", "latency_sigma": 1.0, "body_size": 10000}},
+    "mixed_sizes": {"server": {"latency_ms": 10}, "sizes": (1 << 10, 1 << 20)},
+    "bandwidth_cap": {"server": {"latency_ms": 5, "body_size": 256 << 10, "bandwidth_per_conn": 4 << 20,
+                                 "bandwidth_total": 64 << 20}},
+    "errors_and_429": {"server": {"latency_ms": 20, "body_size": 10000, "error_rate": 0.05, "throttle_rate": 0.05}},
+    "no_keep_alive": {"server": {"latency_ms": 20, "body_size": 10000, "keep_alive": False}},
+    "cut_bodies": {"server": {"latency_ms": 10, "body_size": 256 << 10}, "cut_rate": 0.1},
+    "no_ranges": {"server": {"latency_ms": 10, "body_size": 1 << 20, "ranges": False, "etag": False}},
+}
+
+ENGINES = ("v1", "v2", "v2_stream", "v2_adaptive", "async")
+# the log, metrics and state files that are not downloaded bodies
+NON_BODY_SUFFIXES = (".log", ".jsonl", ".index", ".meta")
+
+
+def write_manifest(path: str, base_url: str, num_urls: int, sizes=None, cut_rate: float=0, seed: int=0):
+    """
+    This function writes a fixed newline manifest of [num_urls] urls of the stand-in server.
+
+    Parameters:
+        path (string): the path to the manifest.
+        base_url (string): the base url of the server.
+        num_urls (int): the number of urls.
+        sizes (tuple): (min, max) body sizes, drawn log-uniformly per url with [seed]. None uses the size of the server.
+        cut_rate (float): the share of the urls whose body is cut off after 64 KiB, see ?cut= of the stand-in server.
+        seed (int): the seed of the sizes and the cut urls.
+
+    Returns:
+        None
+    """
+    rng = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(num_urls):
+            query = []
+            if sizes is not None:
+                query.append("size={}".format(int(round(sizes[0] * (sizes[1] / sizes[0]) ** rng.random()))))
+            if rng.random() < cut_rate:
+                query.append("cut=65536")
+            url = "{}/item/{:07d}.jpg".format(base_url, i)
+            f.write(url + ("?" + "&".join(query) if query else "") + "\n")
+
+
+class TimedURLDownloader_v1(URLDownloader_v1):
+    # URLDownloader_v1 has no metrics, so the latency of every url is timed around download_site
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+
+    def download_site(self, url, outpath):
+        start = time.perf_counter()
+        try:
+            super().download_site(url, outpath)
+        finally:
+            self.latencies.append(time.perf_counter() - start)
+
+
+def make_downloader(engine: str, manifest: str, out_path: str, num_thread: int, concurrency: int):
+    retry_policy = RetryPolicy(max_attempts=3, backoff_base=0.05, backoff_max=1)
+    if engine == "v1":
+        with open(manifest) as f:
+            url_list = [line.strip() for line in f if line.strip()]
+        return TimedURLDownloader_v1(url_list, out_path, num_thread, verbose=False)
+    if engine == "v2":
+        return URLDownloader_v2(manifest, out_path, num_thread, verbose=False, retry_policy=retry_policy)
+    if engine == "v2_stream":
+        return URLDownloader_v2(manifest, out_path, num_thread, verbose=False, retry_policy=retry_policy,
+                                stream=True, resume_partial=True)
+    if engine == "v2_adaptive":
+        return URLDownloader_v2(manifest, out_path, num_thread, verbose=False, retry_policy=retry_policy,
+                                adaptive_concurrency=True)
+    return AsyncURLDownloader(manifest, out_path, num_thread, verbose=False, retry_policy=retry_policy,
+                              max_concurrency=concurrency)
+
+
+def get_percentile(values, q: float):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def get_body_bytes(out_path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(out_path):
+        for name in files:
+            if not name.endswith(NON_BODY_SUFFIXES):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def measure(scenario: str, engine: str, manifest: str, num_urls: int, num_thread: int, concurrency: int, report):
+    """
+    This function downloads the manifest with one engine in this process and puts the measurement into [report].
+
+    Parameters:
+        scenario (string): the scenario name in the report.
+        engine (string): one of ENGINES.
+        manifest (string): the path to the manifest.
+        num_urls (int): the number of urls in the manifest.
+        num_thread (int): the num_thread argument of the engine.
+        concurrency (int): the max_concurrency of the async engine.
+        report (Queue): the queue that gets the measurement (dict).
+
+    Returns:
+        None
+    """
+    out_path = tempfile.mkdtemp(prefix="bench_suite_")
+    try:
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        downloader = make_downloader(engine, manifest, out_path, num_thread, concurrency)
+        latencies = getattr(downloader, "latencies", None)
+        if latencies is None:
+            latencies = []
+            downloader.metrics.add_hook(lambda event: latencies.append(event["total_s"]))
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        # the engines print their progress to stdout, which only carries the JSON lines here
+        with contextlib.redirect_stdout(sys.stderr):
+            downloader.download_all_sites()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        num_ok = sum(1 for _, failed, _ in LogReader(downloader.log_file) if not failed)
+        num_bytes = get_body_bytes(out_path)
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    p50 = get_percentile(latencies, 0.5)
+    p99 = get_percentile(latencies, 0.99)
+    # ru_maxrss is in KiB on Linux
+    report.put({
+        "scenario": scenario,
+        "engine": engine,
+        "num_urls": num_urls,
+        "ok": num_ok,
+        "wall_s": round(wall, 3),
+        "urls_per_s": round(num_urls / wall, 1),
+        "bytes_per_s": round(num_bytes / wall),
+        "p50_latency_ms": None if p50 is None else round(p50 * 1000, 2),
+        "p99_latency_ms": None if p99 is None else round(p99 * 1000, 2),
+        "peak_rss_growth_mb": round((rss_peak - rss_start) / 1024, 1),
+        "cpu_ms_per_url": round(cpu * 1000 / num_urls, 4),
+    })
+
+
+def run_suite(scenarios, engines, num_urls: int, num_thread: int, concurrency: int, output=None):
+    """
+    This function runs every engine over the manifest of every scenario and prints one JSON line per run.
+
+    Parameters:
+        scenarios (list): the names of the scenarios, see SCENARIOS.
+        engines (list): the names of the engines, see ENGINES.
+        num_urls (int): the number of urls per manifest.
+        num_thread (int): the num_thread argument of every engine.
+        concurrency (int): the max_concurrency of the async engine.
+        output (file): a file that also gets every JSON line, None to only print them.
+
+    Returns:
+        None
+    """
+    context = multiprocessing.get_context("spawn")
+    manifest_dir = tempfile.mkdtemp(prefix="bench_suite_manifest_")
+    try:
+        for scenario in scenarios:
+            config = SCENARIOS[scenario]
+            process, base_url = start_server_process(**config["server"])
+            try:
+                manifest = os.path.join(manifest_dir, "{}.txt".format(scenario))
+                write_manifest(manifest, base_url, num_urls, config.get("sizes"), config.get("cut_rate", 0))
+                for engine in engines:
+                    report = context.Queue()
+                    client = context.Process(target=measure,
+                                             args=(scenario, engine, manifest, num_urls, num_thread, concurrency, report))
+                    client.start()
+                    result = report.get()
+                    client.join()
+                    line = json.dumps(result)
+                    print(line, flush=True)
+                    if output is not None:
+                        output.write(line + "\n")
+                        output.flush()
+            finally:
+                process.terminate()
+                process.join()
+    finally:
+        shutil.rmtree(manifest_dir, ignore_errors=True)
+
+
+def compare(baseline_file: str, current_file: str):
+    """
+    This function prints the change of every metric between two saved runs, one JSON line per (scenario, engine).
+    A ratio above 1 means the value grew, which is good for urls_per_s and bytes_per_s and bad for the others.
+
+    Parameters:
+        baseline_file (string): the JSON lines of the baseline run.
+        current_file (string): the JSON lines of the current run.
+
+    Returns:
+        None
+    """
+    def load(path):
+        with open(path) as f:
+            return {(r["scenario"], r["engine"]): r for r in map(json.loads, filter(str.strip, f))}
+
+    baseline = load(baseline_file)
+    for key, current in load(current_file).items():
+        if key not in baseline:
+            continue
+        ratios = {}
+        for name, value in current.items():
+            old = baseline[key].get(name)
+            if name in ("scenario", "engine", "num_urls") or not isinstance(value, (int, float)) \
+                    or not isinstance(old, (int, float)) or old == 0:
+                continue
+            ratios[name] = round(value / old, 3)
+        print(json.dumps({"scenario": key[0], "engine": key[1], "ratio": ratios}), flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES), choices=ENGINES)
+    parser.add_argument("--output", help="also append the JSON lines to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two saved runs instead of running")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    engines = [engine for engine in args.engines if engine != "async" or aiohttp is not None]
+    if len(engines) < len(args.engines):
+        print("aiohttp is not installed, skipping the async engine", file=sys.stderr)
+    output = open(args.output, "a") if args.output else None
+    try:
+        run_suite(args.scenarios, engines, args.num_urls, args.threads, args.concurrency, output)
+    finally:
+        if output is not None:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Measure the per-url memory and CPU of the download bookkeeping, without any network.
+Two modes run the same number of urls, each in its own process so their peak RSS does not mix:
+    legacy: the bookkeeping of the former batch loop, which built url_list and output_path_list up front,
+            sliced both per batch and formatted a (log lines, stderr outputs) pair of lists per url in the workers.
+    pipeline: URLDownloader_v2.download_all_sites over a lazy input, with fetch answering at once, so only the
+            pipeline is measured: DownloadTask records, result rows, ResultColumns and the formatting in the writer.
+The result of every mode is printed as one JSON line.
+
+Usage:
+    python benchmarks/bench_task_table.py --num-urls 10000000
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import URLDownloader_v2  # noqa: E402
+
+URL_TEMPLATE = "https://images.example-cdn.com/product/converted/{0:09d}/{0:09d}lg.jpg"
+
+
+class OfflineDownloader(URLDownloader_v2):
+    # every url succeeds at once, so the benchmark measures the bookkeeping around the requests
+    def fetch(self, url, outpath, schedule_segments=None):
+        return True, 200, None
+
+
+def iter_urls(num_urls: int):
+    for i in range(num_urls):
+        yield URL_TEMPLATE.format(i)
+
+
+def run_legacy(num_urls: int, out_path: str, batch_size: int, num_thread: int):
+    url_list = list(iter_urls(num_urls))
+    output_path_list = [os.path.join(out_path, "data", os.path.basename(url)) for url in url_list]
+    log_file = os.path.join(out_path, "downloaded.log")
+
+    def format_result(url, outpath):
+        print_to_log_file = ["{}\t{}\n".format(url, "o")]
+        print_to_stderr = []
+        return print_to_log_file, print_to_stderr
+
+    with open(log_file, "a") as f:
+        for start in range(0, num_urls, batch_size):
+            urls = url_list[start:start + batch_size]
+            outpaths = output_path_list[start:start + batch_size]
+            with concurrent.futures.ThreadPoolExecutor(max_workers=num_thread) as executor:
+                results = list(executor.map(format_result, urls, outpaths))
+            for print_to_log_file, _ in results:
+                for line in print_to_log_file:
+                    f.write(line)
+
+
+def run_pipeline(num_urls: int, out_path: str, batch_size: int, num_thread: int):
+    downloader = OfflineDownloader(iter_urls(num_urls), out_path, num_thread, verbose=False)
+    downloader.download_all_sites(batch_size)
+
+
+def measure(mode: str, num_urls: int, batch_size: int, num_thread: int, report):
+    out_path = tempfile.mkdtemp(prefix="bench_task_table_")
+    try:
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        (run_legacy if mode == "legacy" else run_pipeline)(num_urls, out_path, batch_size, num_thread)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        shutil.rmtree(out_path, ignore_errors=True)
+    # ru_maxrss is in KiB on Linux
+    report.put({
+        "mode": mode,
+        "num_urls": num_urls,
+        "wall_s": round(wall, 3),
+        "cpu_us_per_url": round(cpu * 1e6 / num_urls, 3),
+        "peak_rss_growth_mb": round((rss_peak - rss_start) / 1024, 1),
+        "bytes_per_url": round((rss_peak - rss_start) * 1024 / num_urls, 1),
+    })
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--num-urls", type=int, default=10000000)
+    parser.add_argument("--batch-size", type=int, default=1024)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--modes", nargs="+", default=["legacy", "pipeline"], choices=["legacy", "pipeline"])
+    args = parser.parse_args(argv)
+
+    context = multiprocessing.get_context("spawn")
+    for mode in args.modes:
+        report = context.Queue()
+        process = context.Process(target=measure, args=(mode, args.num_urls, args.batch_size, args.threads, report))
+        process.start()
+        result = report.get()
+        process.join()
+        print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""
+A local S3-compatible object store that stands in for S3 in the benchmarks, in path style (/<bucket>/<key>).
+It answers PUT, GET, HEAD and DELETE of objects, keeps the objects in memory or under [root], and adds
+[latency_ms] milliseconds to every request. With [access_key] and [secret_key] every request must carry a valid
+AWS Signature Version 4, checked with sign_s3_request of url_downloader, otherwise it answers 403.
+
+Usage:
+    python benchmarks/stand_in_s3.py --port 9000 --latency-ms 5 --access-key bench --secret-key bench-secret
+"""
+import argparse
+import calendar
+import hashlib
+import http.server
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from typing import Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from url_downloader import sign_s3_request  # noqa: E402
+
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+
+class StandInS3Server(http.server.ThreadingHTTPServer):
+    """
+    This is a class for serving the objects of the stand-in store.
+
+    Attributes:
+        latency_ms (float): the milliseconds added to every request.
+        root (string): the folder of the objects, None to keep them in memory.
+        access_key (string): the access key every request must be signed with, None to accept unsigned requests.
+        num_requests (int): the number of requests served.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms: float=0, root: Optional[str]=None, access_key: Optional[str]=None,
+                 secret_key: Optional[str]=None, region: str="us-east-1"):
+        super().__init__(address, StandInS3Handler)
+        self.latency_ms = latency_ms
+        self.root = root
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.num_requests = 0
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def get_object_path(self, bucket: str, key: str) -> str:
+        # the key is hashed, so keys with slashes or dots never leave the root
+        return os.path.join(self.root, bucket, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def put_object(self, bucket: str, key: str, body: bytes):
+        if self.root is None:
+            with self.lock:
+                self.objects[(bucket, key)] = body
+            return
+        path = self.get_object_path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(body)
+        os.replace(path + ".tmp", path)
+
+    def get_object(self, bucket: str, key: str) -> Optional[bytes]:
+        if self.root is None:
+            with self.lock:
+                return self.objects.get((bucket, key))
+        path = self.get_object_path(bucket, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def delete_object(self, bucket: str, key: str):
+        if self.root is None:
+            with self.lock:
+                self.objects.pop((bucket, key), None)
+        elif os.path.exists(self.get_object_path(bucket, key)):
+            os.remove(self.get_object_path(bucket, key))
+
+
+class StandInS3Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the body are written separately, Nagle would hold back the body for a delayed ACK
+    disable_nagle_algorithm = True
+
+    def _parse_target(self) -> Tuple[str, str]:
+        path = urlparse(self.path).path
+        bucket, _, key = path.lstrip("/").partition("/")
+        return bucket, unquote(key)
+
+    def _is_authorized(self, payload_hash: str) -> bool:
+        server = self.server
+        if server.access_key is None:
+            return True
+        authorization = self.headers.get("Authorization", "")
+        amz_date = self.headers.get("x-amz-date", "")
+        if not authorization.startswith("AWS4-HMAC-SHA256 ") or not amz_date:
+            return False
+        fields = dict(part.strip().split("=", 1) for part in authorization[len("AWS4-HMAC-SHA256 "):].split(","))
+        signed_names = fields.get("SignedHeaders", "").split(";")
+        headers = {name: self.headers.get(name, "") for name in signed_names
+                   if name not in ("host", "x-amz-date", "x-amz-content-sha256")}
+        now = calendar.timegm(time.strptime(amz_date, "%Y%m%dT%H%M%SZ"))
+        expected = sign_s3_request(self.command, "http://{}{}".format(self.headers.get("Host", ""), self.path), headers,
+                                   payload_hash, server.access_key, server.secret_key, server.region, now=now)
+        return expected["Authorization"] == authorization
+
+    def _respond(self, status: int, body: bytes=b"", send_body: bool=True):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if status == 200 and body:
+            self.send_header("ETag", '"{}"'.format(hashlib.md5(body).hexdigest()))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def _handle(self):
+        server = self.server
+        with server.lock:
+            server.num_requests += 1
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if server.latency_ms:
+            time.sleep(server.latency_ms / 1000)
+        payload_hash = self.headers.get("x-amz-content-sha256", EMPTY_SHA256)
+        if server.access_key is not None and self.command == "PUT" and payload_hash != hashlib.sha256(body).hexdigest():
+            self._respond(400, b"XAmzContentSHA256Mismatch")
+            return
+        if not self._is_authorized(payload_hash):
+            self._respond(403, b"SignatureDoesNotMatch")
+            return
+        bucket, key = self._parse_target()
+        if not bucket or not key:
+            self._respond(400, b"InvalidRequest")
+        elif self.command == "PUT":
+            server.put_object(bucket, key, body)
+            self._respond(200)
+        elif self.command == "DELETE":
+            server.delete_object(bucket, key)
+            self._respond(204)
+        else:
+            data = server.get_object(bucket, key)
+            if data is None:
+                self._respond(404, b"NoSuchKey", self.command != "HEAD")
+            else:
+                self._respond(200, data, self.command != "HEAD")
+
+    do_GET = do_HEAD = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _run(options, ready):
+    server = StandInS3Server(("127.0.0.1", 0), **options)
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_s3_process(**options) -> Tuple[multiprocessing.Process, str]:
+    """
+    This function starts a stand-in store in a child process, so its CPU time is not counted against the client.
+
+    Parameters:
+        options: the keyword arguments of StandInS3Server.
+
+    Returns:
+        the server process (multiprocessing.Process) and its endpoint url (string)
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(options, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=30)
+    return process, "http://127.0.0.1:{}".format(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--root", help="keep the objects in this folder instead of in memory")
+    parser.add_argument("--access-key")
+    parser.add_argument("--secret-key")
+    parser.add_argument("--region", default="us-east-1")
+    args = parser.parse_args(argv)
+    server = StandInS3Server((args.host, args.port), args.latency_ms, args.root, args.access_key, args.secret_key,
+                             args.region)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
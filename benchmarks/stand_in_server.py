@@ -0,0 +1,323 @@
+"""
+A local HTTP/1.1 server that stands in for a CDN in the benchmarks.
+It runs on asyncio, so it can hold thousands of keep-alive connections on one core.
+
+Every GET returns [body_size] bytes after a latency drawn from [latency_dist] with a mean of [latency_ms]
+milliseconds. The query string can override the server-wide settings per url, e.g. /item/1.jpg?size=2048&latency_ms=5&status=503.
+A server with [capacity] serves that many requests at once and queues the others, and a server with
+[rate_limit] answers 429 to the requests above that many per second, so the benchmarks can overload it.
+[error_rate] and [throttle_rate] answer a random share of the requests with a 503 or a 429, and the bandwidth
+caps pace the bodies per connection and in total.
+Bodies have an ETag and honour Range/If-Range and If-None-Match; ?cut=N closes the connection after N bytes of the body.
+The Content-Type is guessed from the extension of the path unless ?type= gives it, and ?no_length=1 sends the body
+without a Content-Length, delimited by closing the connection.
+The random draws come from one generator seeded with [seed], so a run sees the same distributions every time.
+
+Usage:
+    python benchmarks/stand_in_server.py --port 8000 --latency-ms 20 --latency-dist lognormal --body-size 10000
+"""
+import argparse
+import asyncio
+import math
+import mimetypes
+import multiprocessing
+import random
+import sys
+import time
+from typing import Dict, Tuple
+from urllib.parse import urlparse, parse_qs
+
+LATENCY_DISTS = ("fixed", "uniform", "exponential", "lognormal")
+# the bodies are written in chunks of this size, so the bandwidth caps pace them smoothly
+SEND_CHUNK_SIZE = 16384
+
+REASONS = {200: "OK", 206: "Partial Content", 304: "Not Modified", 416: "Range Not Satisfiable", 404: "Not Found", 429: "Too Many Requests", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+_BODIES = {}
+
+
+def get_body(size: int) -> bytes:
+    # a body whose bytes depend on their position, so a misplaced range shows up in the content
+    if size not in _BODIES:
+        _BODIES[size] = (bytes(range(251)) * (size // 251 + 1))[:size]
+    return _BODIES[size]
+
+
+def parse_range(value, size: int):
+    # parses "bytes=first-last" and "bytes=first-", the only forms the downloader sends
+    if not value or not value.startswith("bytes="):
+        return None
+    first, _, last = value[6:].partition("-")
+    if not first.isdigit():
+        return None
+    return int(first), min(int(last), size - 1) if last.isdigit() else size - 1
+
+
+class StandInServer:
+    """
+    This is a class for serving the benchmark urls.
+
+    Attributes:
+        latency_ms (float): the mean delay before every response.
+        body_size (int): the size of every response body.
+        keep_alive (boolean): whether connections are kept open after a response.
+        capacity (int): the number of requests served at once, the others wait. 0 means no limit.
+        rate_limit (float): the number of requests per second served, the others get a 429. 0 means no limit.
+        latency_dist (string): "fixed", "uniform" (0 to 2 * latency_ms), "exponential" or "lognormal".
+        latency_sigma (float): the sigma of the lognormal latency, larger values give a longer tail.
+        error_rate (float): the share of the requests answered with a 503.
+        throttle_rate (float): the share of the requests answered with a 429.
+        retry_after (int): the Retry-After secs of the 429 and 503 responses, 0 means no header.
+        bandwidth_per_conn (float): the bytes per second of a body on one connection. 0 means no limit.
+        bandwidth_total (float): the bytes per second of all bodies together. 0 means no limit.
+        ranges (boolean): whether Range requests are honoured.
+        etag (boolean): whether bodies have an ETag, which resuming and conditional requests need.
+        seed (int): the seed of the random draws.
+    """
+    def __init__(self, latency_ms: float=0, body_size: int=10000, keep_alive: bool=True, capacity: int=0, rate_limit: float=0,
+                 latency_dist: str="fixed", latency_sigma: float=1.0, error_rate: float=0, throttle_rate: float=0,
+                 retry_after: int=0, bandwidth_per_conn: float=0, bandwidth_total: float=0, ranges: bool=True,
+                 etag: bool=True, seed: int=0):
+        assert latency_dist in LATENCY_DISTS, "latency_dist should be one of {}".format(LATENCY_DISTS)
+        self.latency_ms = latency_ms
+        self.body_size = body_size
+        self.keep_alive = keep_alive
+        self.capacity = capacity
+        self.rate_limit = rate_limit
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.bandwidth_per_conn = bandwidth_per_conn
+        self.bandwidth_total = bandwidth_total
+        self.ranges = ranges
+        self.etag = etag
+        self._random = random.Random(seed)
+        self._slots = None
+        self._tokens = rate_limit
+        self._tokens_time = time.monotonic()
+        # the time the shared bandwidth is booked until
+        self._bandwidth_until = 0.0
+
+    def _take_token(self) -> bool:
+        # a token bucket of [rate_limit] tokens per second with a burst of one second
+        now = time.monotonic()
+        self._tokens = min(self.rate_limit, self._tokens + (now - self._tokens_time) * self.rate_limit)
+        self._tokens_time = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def sample_latency_ms(self, mean_ms: float) -> float:
+        """
+        This function draws the latency of one response from latency_dist.
+
+        Parameters:
+            mean_ms (float): the mean latency in milliseconds.
+
+        Returns:
+            the latency in milliseconds (float)
+        """
+        if mean_ms <= 0 or self.latency_dist == "fixed":
+            return mean_ms
+        if self.latency_dist == "uniform":
+            return self._random.uniform(0, 2 * mean_ms)
+        if self.latency_dist == "exponential":
+            return self._random.expovariate(1 / mean_ms)
+        # the mu that keeps the mean of the lognormal at mean_ms
+        mu = math.log(mean_ms) - self.latency_sigma ** 2 / 2
+        return self._random.lognormvariate(mu, self.latency_sigma)
+
+    async def send_body(self, writer: asyncio.StreamWriter, body: bytes):
+        """
+        This function writes a body in chunks, paced by the bandwidth caps.
+
+        Parameters:
+            writer (StreamWriter): the connection.
+            body (bytes): the body.
+
+        Returns:
+            None
+        """
+        if not (self.bandwidth_per_conn or self.bandwidth_total):
+            writer.write(body)
+            return
+        for pos in range(0, len(body), SEND_CHUNK_SIZE):
+            chunk = body[pos:pos + SEND_CHUNK_SIZE]
+            writer.write(chunk)
+            await writer.drain()
+            now = time.monotonic()
+            ready = now + (len(chunk) / self.bandwidth_per_conn if self.bandwidth_per_conn else 0)
+            if self.bandwidth_total:
+                # every chunk books its share of the total bandwidth after the chunks before it
+                self._bandwidth_until = max(self._bandwidth_until, now) + len(chunk) / self.bandwidth_total
+                ready = max(ready, self._bandwidth_until)
+            if ready > now:
+                await asyncio.sleep(ready - now)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                keep_alive = self.keep_alive and headers.get("connection", "").lower() != "close"
+                status, response_headers, body = await self.respond(method, target, headers)
+                response_headers.setdefault("Content-Length", str(len(body)))
+                if response_headers["Content-Length"] is None:
+                    del response_headers["Content-Length"]
+                keep_alive = keep_alive and response_headers.get("Connection") != "close"
+                response_headers["Connection"] = "keep-alive" if keep_alive else "close"
+                head = "HTTP/1.1 {} {}\r\n".format(status, REASONS.get(status, "Unknown"))
+                head += "".join("{}: {}\r\n".format(k, v) for k, v in response_headers.items()) + "\r\n"
+                writer.write(head.encode("latin-1"))
+                if method != "HEAD":
+                    await self.send_body(writer, body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method: str, target: str, headers: Dict) -> Tuple[int, Dict, bytes]:
+        """
+        This function builds the response of one request.
+
+        Parameters:
+            method (string): the http method.
+            target (string): the request target, a path with an optional query string.
+            headers (dict): the request headers with lower-case keys.
+
+        Returns:
+            the status code (int), the response headers (dict) and the body (bytes)
+        """
+        query = parse_qs(urlparse(target).query)
+        latency_ms = self.sample_latency_ms(float(query.get("latency_ms", [self.latency_ms])[0]))
+        body_size = int(query.get("size", [self.body_size])[0])
+        status = int(query.get("status", [200])[0])
+        error_headers = {"Content-Type": "text/plain"}
+        if self.retry_after:
+            error_headers["Retry-After"] = str(self.retry_after)
+        if self.rate_limit and not self._take_token():
+            return 429, error_headers, b""
+        if status < 400 and (self.error_rate or self.throttle_rate):
+            draw = self._random.random()
+            if draw < self.throttle_rate:
+                status = 429
+            elif draw < self.throttle_rate + self.error_rate:
+                status = 503
+        if self.capacity:
+            if self._slots is None:
+                self._slots = asyncio.Semaphore(self.capacity)
+            async with self._slots:
+                if latency_ms > 0:
+                    await asyncio.sleep(latency_ms / 1000)
+        elif latency_ms > 0:
+            await asyncio.sleep(latency_ms / 1000)
+        if status >= 400:
+            return status, error_headers, b""
+        body = get_body(body_size)
+        etag = '"{}"'.format(body_size) if self.etag else None
+        content_type = query.get("type", [mimetypes.guess_type(urlparse(target).path)[0] or "application/octet-stream"])[0]
+        response_headers = {"Content-Type": content_type}
+        if etag is not None:
+            response_headers["ETag"] = etag
+            if headers.get("if-none-match") == etag:
+                return 304, response_headers, b""
+        if self.ranges:
+            response_headers["Accept-Ranges"] = "bytes"
+        byte_range = parse_range(headers.get("range"), body_size) if self.ranges else None
+        if byte_range is not None and headers.get("if-range", etag) == etag:
+            first, last = byte_range
+            if first >= body_size:
+                response_headers["Content-Range"] = "bytes */{}".format(body_size)
+                return 416, response_headers, b""
+            status = 206
+            response_headers["Content-Range"] = "bytes {}-{}/{}".format(first, last, body_size)
+            body = body[first:last + 1]
+        if "cut" in query and byte_range is None:
+            response_headers["Content-Length"] = str(len(body))
+            response_headers["Connection"] = "close"
+            body = body[:int(query["cut"][0])]
+        if "no_length" in query and status == 200:
+            response_headers["Content-Length"] = None
+            response_headers["Connection"] = "close"
+        return status, response_headers, body
+
+    async def serve(self, host: str, port: int, ready=None):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        port = server.sockets[0].getsockname()[1]
+        if ready is not None:
+            ready.put(port)
+        else:
+            print("Serving on http://{}:{}".format(host, port), flush=True)
+        async with server:
+            await server.serve_forever()
+
+
+def _run(options, ready):
+    server = StandInServer(**options)
+    asyncio.run(server.serve("127.0.0.1", 0, ready))
+
+
+def start_server_process(**options) -> Tuple[multiprocessing.Process, str]:
+    """
+    This function starts a stand-in server in a child process, so its CPU time is not counted against the client.
+
+    Parameters:
+        options: the keyword arguments of StandInServer.
+
+    Returns:
+        the server process (multiprocessing.Process) and its base url (string)
+    """
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run, args=(options, ready), daemon=True)
+    process.start()
+    port = ready.get(timeout=30)
+    return process, "http://127.0.0.1:{}".format(port)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--body-size", type=int, default=10000)
+    parser.add_argument("--no-keep-alive", action="store_true")
+    parser.add_argument("--capacity", type=int, default=0)
+    parser.add_argument("--rate-limit", type=float, default=0)
+    parser.add_argument("--latency-dist", default="fixed", choices=LATENCY_DISTS)
+    parser.add_argument("--latency-sigma", type=float, default=1.0)
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--throttle-rate", type=float, default=0)
+    parser.add_argument("--retry-after", type=int, default=0)
+    parser.add_argument("--bandwidth-per-conn", type=float, default=0)
+    parser.add_argument("--bandwidth-total", type=float, default=0)
+    parser.add_argument("--no-ranges", action="store_true")
+    parser.add_argument("--no-etag", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    server = StandInServer(args.latency_ms, args.body_size, not args.no_keep_alive, args.capacity, args.rate_limit,
+                           args.latency_dist, args.latency_sigma, args.error_rate, args.throttle_rate, args.retry_after,
+                           args.bandwidth_per_conn, args.bandwidth_total, not args.no_ranges, not args.no_etag, args.seed)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""
+Shared fixtures of the tests: a local HTTP server whose responses are chosen by the query string of each url.
+
+Query parameters:
+    size (int): the number of bytes of the body, 100 by default.
+    seed (string): the pattern the body repeats, so urls can share or differ in content.
+    status (int): the status code, 200 by default; error responses have an empty body.
+    delay (float): the secs to wait before answering.
+    fail (int): the first fail requests of the url answer with status (503 by default), the later ones with 200.
+    retry_after (string): the Retry-After header of error responses.
+    etag (string): the ETag header, a request with a matching If-None-Match gets a 304 without a body.
+    cut (int): close the connection after that many bytes of a full body.
+    type (string): the Content-Type header, guessed from the extension of the path by default.
+    no_length (any): send the body without a Content-Length, delimited by closing the connection.
+Range requests get a 206 when their If-Range is missing or matches etag, and a 416 past the end of the body.
+"""
+import http.server
+import mimetypes
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def get_body(size: int, seed: str="0123456789") -> bytes:
+    pattern = seed.encode()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def parse_range(value, size: int):
+    # "bytes=first-last" and "bytes=first-", the forms the downloader sends
+    if not value or not value.startswith("bytes="):
+        return None
+    first, _, last = value[6:].partition("-")
+    if not first.isdigit():
+        return None
+    return int(first), min(int(last), size - 1) if last.isdigit() else size - 1
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        query = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+        with self.server.lock:
+            self.server.requests.append((self.path, dict(self.headers)))
+            self.server.request_times.append(time.monotonic())
+        if "delay" in query:
+            time.sleep(float(query["delay"]))
+        status = int(query.get("status", 200))
+        if "fail" in query:
+            with self.server.lock:
+                num_failed = self.server.fail_counts.get(self.path, 0)
+                self.server.fail_counts[self.path] = num_failed + 1
+            status = int(query.get("status", 503)) if num_failed < int(query["fail"]) else 200
+        if "etag" in query and self.headers.get("If-None-Match") == query["etag"]:
+            status = 304
+        body = get_body(int(query.get("size", 100)), query.get("seed", "0123456789")) if status < 300 else b""
+        headers = {"Content-Length": str(len(body))}
+        byte_range = parse_range(self.headers.get("Range"), len(body))
+        if status == 200 and byte_range is not None and self.headers.get("If-Range", query.get("etag")) == query.get("etag"):
+            first, last = byte_range
+            if first >= len(body):
+                status, headers["Content-Range"], body = 416, "bytes */{}".format(len(body)), b""
+            else:
+                status, headers["Content-Range"] = 206, "bytes {}-{}/{}".format(first, last, len(body))
+                body = body[first:last + 1]
+            headers["Content-Length"] = str(len(body))
+        elif status == 200 and "cut" in query:
+            body = body[:int(query["cut"])]
+            self.close_connection = True
+        if "no_length" in query and status == 200:
+            del headers["Content-Length"]
+            self.close_connection = True
+        content_type = query.get("type", mimetypes.guess_type(urlparse(self.path).path)[0])
+        if content_type and status < 300:
+            headers["Content-Type"] = content_type
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        if "etag" in query:
+            self.send_header("ETag", query["etag"])
+        if status >= 400 and "retry_after" in query:
+            self.send_header("Retry-After", query["retry_after"])
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(http.server.ThreadingHTTPServer):
+    # the async engine opens many connections at once, the default backlog of 5 drops some and they retry after 1 sec
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class LocalServer:
+    """
+    A threaded HTTP server on 127.0.0.1, see the module docstring for how the responses are chosen.
+
+    Attributes:
+        base (string): the base url of the server.
+        requests (list): the (path, headers) of every request received, in order.
+        request_times (list): the time.monotonic() when every request was received, in the same order.
+    """
+    def __init__(self):
+        self._httpd = _Server(("127.0.0.1", 0), _Handler)
+        self._httpd.requests = []
+        self._httpd.request_times = []
+        self._httpd.fail_counts = {}
+        self._httpd.lock = threading.Lock()
+        self.base = "http://127.0.0.1:{}".format(self._httpd.server_address[1])
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def requests(self):
+        with self._httpd.lock:
+            return list(self._httpd.requests)
+
+    @property
+    def request_times(self):
+        with self._httpd.lock:
+            return list(self._httpd.request_times)
+
+    def url(self, path: str, **query) -> str:
+        return self.base + path + ("?" + urlencode(query) if query else "")
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def server():
+    local_server = LocalServer()
+    yield local_server
+    local_server.close()
+
+
+def read_log(out_path: str):
+    """
+    This function returns the (url, status) entries of the downloaded.log in out_path.
+    """
+    with open(os.path.join(out_path, "downloaded.log")) as f:
+        return [tuple(line.rstrip("\n").split("\t")) for line in f if line.strip()]
@@ -0,0 +1,83 @@
+import pytest
+
+from conftest import read_log
+from url_downloader import AdaptiveConcurrencyLimiter, AsyncURLDownloader, URLDownloader_v2
+
+
+def observe(limiter, status=200, latency=0.1, host="a"):
+    limiter.observe({"host": host, "status": status, "total_s": latency})
+
+
+def fill(limiter, host="a"):
+    while limiter.try_acquire(host):
+        pass
+
+
+def test_the_limit_bounds_the_downloads_in_flight():
+    limiter = AdaptiveConcurrencyLimiter(1, 8, initial_limit=2)
+    assert limiter.try_acquire("a") and limiter.try_acquire("b")
+    assert not limiter.has_capacity() and not limiter.try_acquire("c")
+    limiter.release("a")
+    assert limiter.has_capacity() and limiter.try_acquire("c")
+
+
+def test_slow_start_doubles_a_used_limit_up_to_max_limit():
+    limiter = AdaptiveConcurrencyLimiter(1, 6, interval=0)
+    for expected in (2, 4, 6):
+        fill(limiter)
+        observe(limiter)
+        assert limiter.limit == expected
+    assert [limit for _, limit in limiter.history] == [2, 4, 6]
+
+
+def test_an_unused_limit_does_not_grow():
+    limiter = AdaptiveConcurrencyLimiter(1, 64, initial_limit=4, interval=0)
+    observe(limiter)
+    assert limiter.limit == 4
+
+
+def test_throttling_decreases_the_limit_multiplicatively():
+    limiter = AdaptiveConcurrencyLimiter(2, 64, initial_limit=10, interval=0, decrease_factor=0.5)
+    observe(limiter, status=503)
+    assert limiter.limit == 5
+    observe(limiter, status=None)
+    assert limiter.limit == 2.5
+    observe(limiter, status=429)
+    assert limiter.limit == 2
+    # after a decrease the limit grows by one per window
+    fill(limiter)
+    observe(limiter)
+    assert limiter.limit == 3
+
+
+def test_a_rising_latency_lowers_the_limit():
+    limiter = AdaptiveConcurrencyLimiter(1, 64, initial_limit=10, interval=0)
+    observe(limiter, latency=0.1)
+    observe(limiter, latency=1.0)
+    # limit * latency_tolerance * min_latency / latency, the baseline creeping up by 1%
+    assert limiter.limit == pytest.approx(10 * 2 * 0.101 / 1.0)
+
+
+def test_a_throttling_host_only_lowers_its_own_limit():
+    limiter = AdaptiveConcurrencyLimiter(1, 64, initial_limit=8, per_host=True, interval=0, decrease_factor=0.5)
+    assert limiter.try_acquire("a") and limiter.try_acquire("b")
+    observe(limiter, status=503, host="a")
+    assert limiter.get_host_limit("a") == 4
+    assert limiter.get_host_limit("b") == 8
+    assert limiter.limit == 8
+    assert limiter.get_host_limit("c") is None
+
+
+def test_threaded_engine_downloads_with_adaptive_concurrency(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i)) for i in range(30)]
+    downloader = URLDownloader_v2(urls, str(tmp_path), 8, verbose=False, adaptive_concurrency=True)
+    downloader.host_limiter.interval = 0
+    downloader.download_all_sites()
+    assert len(read_log(str(tmp_path))) == 30
+    assert downloader.host_limiter.history
+    assert 1 <= downloader.host_limiter.limit <= 8
+
+
+def test_async_engine_rejects_adaptive_concurrency(tmp_path):
+    with pytest.raises(ValueError):
+        AsyncURLDownloader(["http://a/1"], str(tmp_path), verbose=False, adaptive_concurrency=True).download_all_sites()
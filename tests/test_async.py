@@ -0,0 +1,40 @@
+import os
+
+from conftest import get_body, read_log
+from url_downloader import AsyncURLDownloader
+
+
+def test_async_engine_downloads_and_logs(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i), size=1000 + i) for i in range(20)]
+    AsyncURLDownloader(urls, str(tmp_path), 2, verbose=False, max_concurrency=5).download_all_sites(batch_size=7)
+    for i in range(20):
+        assert (tmp_path / "data" / "{}.bin".format(i)).read_bytes() == get_body(1000 + i)
+    assert sorted(read_log(str(tmp_path))) == sorted((url, "o") for url in urls)
+
+
+def test_async_engine_resumes_from_the_log(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i)) for i in range(4)]
+    AsyncURLDownloader(urls[:2], str(tmp_path), verbose=False).download_all_sites()
+    AsyncURLDownloader(urls, str(tmp_path), verbose=False).download_all_sites()
+    assert sorted(path for path, _ in server.requests) == ["/0.bin", "/1.bin", "/2.bin", "/3.bin"]
+    assert len(read_log(str(tmp_path))) == 4
+
+
+def test_async_stream_mode_drops_a_body_over_max_bytes_per_file(server, tmp_path):
+    small, large = server.url("/small.bin", size=100), server.url("/large.bin", size=5000)
+    AsyncURLDownloader([small, large], str(tmp_path), verbose=False, stream=True, chunk_size=512,
+                       max_bytes_per_file=1000).download_all_sites()
+    assert os.listdir(tmp_path / "data") == ["small.bin"]
+    assert sorted(read_log(str(tmp_path))) == sorted([(small, "o"), (large, "x")])
+
+
+def test_error_tolerance_pauses_every_dispatch(server, tmp_path):
+    # once the error url fails, no other url may start for stop_interval, even with free concurrency
+    failing = server.url("/error.bin", status=500)
+    urls = [failing] + [server.url("/{}.bin".format(i), delay=0.05) for i in range(6)]
+    AsyncURLDownloader(urls, str(tmp_path), verbose=False, max_concurrency=2, err_tolerance_num=0,
+                       stop_interval=0.5).download_all_sites()
+    times = dict(zip((path for path, _ in server.requests), server.request_times))
+    failed_at = times.pop("/error.bin?status=500")
+    assert not [t for t in times.values() if failed_at + 0.1 < t < failed_at + 0.45]
+    assert len(read_log(str(tmp_path))) == 7
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from conftest import get_body, read_log
+from url_downloader import AsyncURLDownloader, ContentFilter, URLDownloader_v2, guess_url_mimetype
+
+
+def test_guess_url_mimetype_ignores_the_query():
+    assert guess_url_mimetype("http://a/b/c.JPG?size=xl") == "image/jpeg"
+    assert guess_url_mimetype("http://a/b/c") is None
+
+
+def test_preflight_checks_the_extension_only():
+    content_filter = ContentFilter(("image/*", "application/pdf"))
+    assert content_filter.check_url("http://a/1.png") is None
+    assert content_filter.check_url("http://a/1.pdf") is None
+    assert content_filter.check_url("http://a/page") is None
+    assert content_filter.check_url("http://a/1.html") is not None
+    assert ContentFilter(preflight=False).check_url("http://a/1.html") is None
+
+
+def test_headers_check_the_type_and_the_size():
+    content_filter = ContentFilter(min_size=10, max_size=100, allow_missing_type=False)
+    assert content_filter.check_headers("image/png; charset=binary", 50) is None
+    assert content_filter.check_headers("image/png", None) is None
+    assert content_filter.check_headers("text/html", 50) is not None
+    assert content_filter.check_headers(None, 50) is not None
+    assert content_filter.check_headers("image/png", 5) is not None
+    assert content_filter.check_headers("image/png", 500) is not None
+
+
+@pytest.mark.parametrize("engine, stream", [(URLDownloader_v2, False), (URLDownloader_v2, True),
+                                            (AsyncURLDownloader, False), (AsyncURLDownloader, True)])
+def test_engines_filter_before_and_after_the_headers(server, tmp_path, engine, stream):
+    ok = server.url("/ok.png", size=500)
+    page = server.url("/page.html")
+    html = server.url("/image", type="text/html")
+    large = server.url("/large.png", size=5000)
+    unsized = server.url("/unsized.png", size=5000, no_length=1)
+    small = server.url("/small.png", size=10, no_length=1)
+    downloader = engine([ok, page, html, large, unsized, small], str(tmp_path), verbose=False, stream=stream,
+                        content_filter=ContentFilter(min_size=100, max_size=1000))
+    downloader.download_all_sites()
+    # the page is dropped before any request and not logged
+    assert "/page.html" not in [path for path, _ in server.requests]
+    assert sorted(read_log(str(tmp_path))) == sorted([(ok, "o"), (html, "x"), (large, "x"), (unsized, "x"),
+                                                      (small, "x")])
+    assert os.listdir(tmp_path / "data") == ["ok.png"]
+    counters = downloader.get_metrics()["counters"]
+    assert (counters["filtered_url"], counters["filtered_headers"], counters["filtered_body"]) == (1, 2, 1)
+
+
+@pytest.mark.parametrize("io_threads", [0, 4])
+def test_a_custom_saver_gets_the_body_read_under_the_cap(server, tmp_path, io_threads):
+    # with a filter the response is streamed, the saver may run on the io_pool once it is closed
+    def saver(outpath, response):
+        with open(outpath, "wb") as f:
+            f.write(response.content)
+
+    ok = server.url("/ok.png", size=500, no_length=1)
+    unsized = server.url("/unsized.png", size=5000, no_length=1)
+    URLDownloader_v2([ok, unsized], str(tmp_path), verbose=False, custom_img_saver=saver, io_threads=io_threads,
+                     content_filter=ContentFilter(max_size=1000)).download_all_sites()
+    assert (tmp_path / "data" / "ok.png").read_bytes() == get_body(500)
+    assert not (tmp_path / "data" / "unsized.png").exists()
+    assert sorted(read_log(str(tmp_path))) == sorted([(ok, "o"), (unsized, "x")])
+
+
+def test_the_resume_path_checks_the_headers(server, tmp_path):
+    urls = [server.url("/a.png", size=1000, etag='"v1"'), server.url("/b.png", size=1000, type="text/html")]
+    URLDownloader_v2(urls, str(tmp_path), verbose=False, stream=True, resume_partial=True,
+                     content_filter=ContentFilter()).download_all_sites()
+    assert sorted(read_log(str(tmp_path))) == sorted([(urls[0], "o"), (urls[1], "x")])
+    assert os.listdir(tmp_path / "data") == ["a.png"]
@@ -0,0 +1,114 @@
+import os
+import threading
+
+import pytest
+
+from conftest import get_body, read_log
+from url_downloader import AsyncURLDownloader, ContentStore, URLDownloader_v1, URLDownloader_v2
+
+
+def make_store(tmp_path, link_mode="hardlink"):
+    return ContentStore(str(tmp_path / "blobs"), str(tmp_path / "content.index"), link_mode)
+
+
+def list_blobs(tmp_path):
+    root = tmp_path / "blobs"
+    return sorted(path.name for path in root.rglob("*") if path.is_file() and path.parent.name != "tmp")
+
+
+def test_a_duplicated_body_is_stored_once_and_hardlinked(tmp_path):
+    store = make_store(tmp_path)
+    assert not store.put_bytes("http://a/1", str(tmp_path / "1.bin"), b"same")
+    assert store.put_bytes("http://a/2", str(tmp_path / "2.bin"), b"same")
+    assert not store.put_bytes("http://a/3", str(tmp_path / "3.bin"), b"other")
+    assert len(list_blobs(tmp_path)) == 2
+    assert os.path.samefile(tmp_path / "1.bin", tmp_path / "2.bin")
+    assert (tmp_path / "3.bin").read_bytes() == b"other"
+    assert (store.num_blobs, store.num_duplicates, store.bytes_deduplicated) == (2, 1, 4)
+    store.close()
+    assert [line.split("\t")[0] for line in (tmp_path / "content.index").read_text().splitlines()] == \
+        ["http://a/1", "http://a/2", "http://a/3"]
+
+
+def test_concurrent_duplicates_share_one_blob(tmp_path):
+    store = make_store(tmp_path)
+    barrier = threading.Barrier(16)
+
+    def put(i):
+        barrier.wait()
+        store.put_bytes("http://a/{}".format(i), str(tmp_path / "{}.bin".format(i)), b"same")
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    store.close()
+    assert len(list_blobs(tmp_path)) == 1
+    assert all(os.path.samefile(tmp_path / "0.bin", tmp_path / "{}.bin".format(i)) for i in range(16))
+    assert (store.num_blobs, store.num_duplicates) == (1, 15)
+
+
+def test_link_mode_none_only_records_the_url(tmp_path):
+    store = make_store(tmp_path, "none")
+    store.put_bytes("http://a/1", str(tmp_path / "1.bin"), b"body")
+    store.close()
+    assert not (tmp_path / "1.bin").exists()
+    assert len(list_blobs(tmp_path)) == 1
+    assert (tmp_path / "content.index").read_text().startswith("http://a/1\t")
+
+
+def test_duplicates_are_found_after_a_restart(tmp_path):
+    store = make_store(tmp_path)
+    store.put_bytes("http://a/1", str(tmp_path / "1.bin"), b"body")
+    store.close()
+    reloaded = make_store(tmp_path)
+    assert reloaded.put_bytes("http://a/2", str(tmp_path / "2.bin"), b"body")
+    reloaded.close()
+
+
+def test_a_missing_blob_is_stored_again(tmp_path):
+    store = make_store(tmp_path)
+    store.put_bytes("http://a/1", str(tmp_path / "1.bin"), b"body")
+    for path in (tmp_path / "blobs").rglob("*"):
+        if path.is_file():
+            path.unlink()
+    assert not store.put_bytes("http://a/2", str(tmp_path / "2.bin"), b"body")
+    assert (tmp_path / "2.bin").read_bytes() == b"body"
+    store.close()
+
+
+def test_blob_writer_hashes_the_chunks(tmp_path):
+    store = make_store(tmp_path)
+    store.put_bytes("http://a/1", str(tmp_path / "1.bin"), b"abcdef")
+    writer = store.open_writer("http://a/2", str(tmp_path / "2.bin"))
+    writer.write(b"abc")
+    writer.write(b"def")
+    assert writer.size == 6 and writer.commit()
+    aborted = store.open_writer("http://a/3", str(tmp_path / "3.bin"))
+    aborted.write(b"partial")
+    aborted.abort()
+    assert os.listdir(tmp_path / "blobs" / "tmp") == []
+    assert not (tmp_path / "3.bin").exists()
+    assert len(list_blobs(tmp_path)) == 1
+    store.close()
+
+
+@pytest.mark.parametrize("engine, stream", [(URLDownloader_v2, False), (URLDownloader_v2, True),
+                                            (AsyncURLDownloader, False), (AsyncURLDownloader, True)])
+def test_engines_store_duplicated_urls_once(server, tmp_path, engine, stream):
+    urls = [server.url("/{}.bin".format(i), size=1000) for i in range(3)] + [server.url("/other.bin", seed="x")]
+    engine(urls, str(tmp_path), verbose=False, content_store=True, stream=stream).download_all_sites()
+    assert len(list_blobs(tmp_path)) == 2
+    assert (tmp_path / "data" / "2.bin").read_bytes() == get_body(1000)
+    assert os.path.samefile(tmp_path / "data" / "0.bin", tmp_path / "data" / "2.bin")
+    assert sorted(read_log(str(tmp_path))) == sorted((url, "o") for url in urls)
+
+
+def test_remove_dup_img_of_v1_uses_the_store(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i)) for i in range(2)]
+    downloader = URLDownloader_v1(urls, str(tmp_path), verbose=False, remove_dup_img=True)
+    for url, outpath in zip(downloader.url_list, downloader.outpath_list):
+        downloader.download_site(url, outpath)
+    assert len(list_blobs(tmp_path)) == 1
+    assert os.path.samefile(tmp_path / "0.bin", tmp_path / "1.bin")
@@ -0,0 +1,68 @@
+from conftest import read_log
+from url_downloader import AsyncURLDownloader, DownloadTask, HostConcurrencyLimiter, HostScheduler, URLDownloader_v2
+
+
+def slow_and_fast_urls(server, num_slow, num_fast, delay):
+    # the same server under two host names, so the per-host limits see two hosts
+    slow = [server.url("/slow{}.bin".format(i), delay=delay).replace("127.0.0.1", "localhost") for i in range(num_slow)]
+    fast = [server.url("/fast{}.bin".format(i)) for i in range(num_fast)]
+    return slow, fast
+
+
+def get_start_times(server, prefix):
+    return sorted(t for (path, _), t in zip(server.requests, server.request_times) if path.startswith(prefix))
+
+
+def test_host_concurrency_limiter():
+    limiter = HostConcurrencyLimiter(2)
+    assert limiter.try_acquire("a") and limiter.try_acquire("a")
+    assert not limiter.try_acquire("a")
+    assert limiter.try_acquire("b")
+    limiter.release("a")
+    assert limiter.try_acquire("a")
+    assert HostConcurrencyLimiter(None).try_acquire("a")
+
+
+def test_scheduler_skips_a_saturated_host():
+    limiter = HostConcurrencyLimiter(1)
+    scheduler = HostScheduler(iter([DownloadTask("http://a/1", "a1"), DownloadTask("http://a/2", "a2"),
+                                    DownloadTask("http://b/1", "b1"), DownloadTask("http://a/3", "a3")]))
+    assert scheduler.next(limiter.try_acquire).outpath == "a1"
+    assert scheduler.next(limiter.try_acquire).outpath == "b1"
+    assert scheduler.next(limiter.try_acquire) is None
+    assert scheduler.exhausted and len(scheduler) == 2
+    limiter.release("a")
+    assert scheduler.next(limiter.try_acquire).outpath == "a2"
+    assert len(scheduler) == 1
+
+
+def test_threaded_engine_keeps_the_cap_of_a_slow_host(server, tmp_path):
+    slow, fast = slow_and_fast_urls(server, 6, 20, 0.3)
+    URLDownloader_v2(slow + fast, str(tmp_path), 6, verbose=False, max_in_flight_per_host=2).download_all_sites()
+    starts = get_start_times(server, "/slow")
+    assert len(starts) == 6
+    # at most 2 slow requests overlap, so every third one starts after the first of them ended
+    assert all(b - a >= 0.25 for a, b in zip(starts, starts[2:]))
+    assert len(read_log(str(tmp_path))) == 26
+
+
+def test_async_engine_keeps_fast_hosts_going_past_a_capped_host(server, tmp_path):
+    slow, fast = slow_and_fast_urls(server, 8, 40, 0.5)
+    AsyncURLDownloader(slow + fast, str(tmp_path), verbose=False, max_concurrency=4,
+                       max_in_flight_per_host=2).download_all_sites()
+    slow_starts, fast_starts = get_start_times(server, "/slow"), get_start_times(server, "/fast")
+    assert all(b - a >= 0.45 for a, b in zip(slow_starts, slow_starts[2:]))
+    # the slow host takes 2 secs at 2 in flight, the fast urls do not wait for it
+    assert fast_starts[-1] - min(slow_starts[0], fast_starts[0]) < 1.0
+    assert len(read_log(str(tmp_path))) == 48
+
+
+def test_pool_stats_count_connection_reuse(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i)) for i in range(10)]
+    downloader = URLDownloader_v2(urls, str(tmp_path), 1, verbose=False)
+    downloader.download_all_sites()
+    stats = downloader.get_pool_stats()["per_host"]["127.0.0.1"]
+    assert stats["requests"] == 10
+    assert stats["connections"] == 1
+    assert stats["connection_reuses"] == 9
+    assert stats["pool_misses"] == 1
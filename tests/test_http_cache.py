@@ -0,0 +1,72 @@
+import json
+
+import pytest
+
+from conftest import get_body, read_log
+from url_downloader import AsyncURLDownloader, HttpCache, URLDownloader_v2, url_fingerprint
+
+
+def test_http_cache_records_and_reloads_validators(tmp_path):
+    cache_file = str(tmp_path / "http_cache.jsonl")
+    cache = HttpCache(cache_file)
+    cache.record("http://a/1", '"v1"', "Wed, 21 Oct 2015 07:28:00 GMT", 10)
+    cache.record("http://a/2", None, None, 5)
+    cache.close()
+    with open(cache_file, "a") as f:
+        f.write('{"url": "http://a/3", "et')
+    reloaded = HttpCache(cache_file)
+    assert reloaded.get("http://a/1")[:3] == ('"v1"', "Wed, 21 Oct 2015 07:28:00 GMT", 10)
+    assert reloaded.get_conditional_headers("http://a/1") == {
+        "If-None-Match": '"v1"', "If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"}
+    assert reloaded.get_conditional_headers("http://a/2") == {}
+    assert reloaded.get("http://a/3") is None
+    reloaded.close()
+
+
+def test_touch_renews_the_fetch_time_and_keeps_the_validators(tmp_path):
+    cache = HttpCache(str(tmp_path / "http_cache.jsonl"))
+    cache.record("http://a/1", '"v1"', None, 10)
+    # fetched long ago
+    cache.entries[url_fingerprint("http://a/1")] = ('"v1"', None, 10, 0)
+    assert not cache.is_fresh("http://a/1", 60)
+    cache.touch("http://a/1")
+    assert cache.is_fresh("http://a/1", 60)
+    assert not cache.is_fresh("http://a/1", None)
+    assert cache.get("http://a/1")[:3] == ('"v1"', None, 10)
+    cache.close()
+
+
+def test_a_mostly_stale_cache_file_is_compacted_on_load(tmp_path):
+    cache_file = tmp_path / "http_cache.jsonl"
+    lines = [json.dumps({"url": "http://a/{}".format(i % 10), "etag": str(i), "fetched_at": i}) for i in range(2000)]
+    cache_file.write_text("\n".join(lines) + "\n")
+    cache = HttpCache(str(cache_file))
+    cache.close()
+    compacted = cache_file.read_text().splitlines()
+    assert len(compacted) == 10
+    assert HttpCache(str(cache_file)).get("http://a/3")[0] == "1993"
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_refresh_sends_conditional_requests(server, tmp_path, engine):
+    cached, uncached = server.url("/cached.bin", etag='"v1"'), server.url("/plain.bin", size=50)
+    engine([cached, uncached], str(tmp_path), verbose=False, http_cache=True).download_all_sites()
+    (tmp_path / "data" / "cached.bin").write_bytes(b"kept")
+    (tmp_path / "data" / "plain.bin").write_bytes(b"stale")
+    engine([cached, uncached], str(tmp_path), verbose=False, refresh=True).download_all_sites()
+    refreshed = {path: headers for path, headers in server.requests[2:]}
+    assert refreshed["/cached.bin?etag=%22v1%22"]["If-None-Match"] == '"v1"'
+    assert "If-None-Match" not in refreshed["/plain.bin?size=50"]
+    # a 304 leaves the file alone, a 200 rewrites it
+    assert (tmp_path / "data" / "cached.bin").read_bytes() == b"kept"
+    assert (tmp_path / "data" / "plain.bin").read_bytes() == get_body(50)
+    assert sorted(read_log(str(tmp_path))) == sorted([(cached, "o"), (uncached, "o")])
+
+
+def test_refresh_skips_urls_fetched_within_max_age(server, tmp_path):
+    url = server.url("/a.bin")
+    URLDownloader_v2([url], str(tmp_path), verbose=False, http_cache=True).download_all_sites()
+    URLDownloader_v2([url], str(tmp_path), verbose=False, refresh=True, max_age=3600).download_all_sites()
+    assert len(server.requests) == 1
+    URLDownloader_v2([url], str(tmp_path), verbose=False, refresh=True).download_all_sites()
+    assert len(server.requests) == 2
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from url_downloader import FingerprintTable, URLDownloader_v2, iter_manifest, url_fingerprint
+
+
+def test_fingerprint_table_grows_and_keeps_values():
+    table = FingerprintTable(capacity=4)
+    for i in range(5000):
+        assert table.add(url_fingerprint("u{}".format(i)))
+    assert len(table) == 5000
+    assert not table.add(url_fingerprint("u7"))
+    table.set(url_fingerprint("u7"), 3)
+    assert table.get(url_fingerprint("u7")) == 3
+    assert table.get(url_fingerprint("missing")) is None
+    assert url_fingerprint("missing") not in table
+
+
+@pytest.mark.parametrize("name, content, expected", [
+    ("urls.txt", "# comment\nhttp://a/1\n\nhttp://a/2\n", [("http://a/1", None), ("http://a/2", None)]),
+    ("urls.jsonl", json.dumps({"url": "http://a/1", "output_name": "one"}) + "\n\n" + json.dumps({"url": "http://a/2"}) + "\n",
+     [("http://a/1", "one"), ("http://a/2", None)]),
+    ("urls.csv", "url,name\nhttp://a/1,one\nhttp://a/2,\n", [("http://a/1", "one"), ("http://a/2", None)]),
+    ("urls.tsv", "http://a/1\tone\n", [("http://a/1", "one")]),
+])
+def test_iter_manifest_reads_every_format(tmp_path, name, content, expected):
+    path = tmp_path / name
+    path.write_text(content)
+    assert list(iter_manifest(str(path))) == expected
+
+
+def test_duplicate_urls_are_dropped_in_input_order(tmp_path):
+    urls = ["http://a/2.jpg", "http://a/1.jpg", "http://a/2.jpg", "http://a/3.jpg", "http://a/1.jpg"]
+    downloader = URLDownloader_v2(urls, str(tmp_path / "out"), verbose=False)
+    assert downloader.url_list == ["http://a/2.jpg", "http://a/1.jpg", "http://a/3.jpg"]
+    assert downloader.output_path_list[0] == str(tmp_path / "out" / "data" / "2.jpg")
+
+
+def test_input_is_read_lazily_from_a_manifest(tmp_path):
+    manifest = tmp_path / "urls.txt"
+    manifest.write_text("http://a/1.jpg\nhttp://a/2.jpg\n")
+    downloader = URLDownloader_v2(str(manifest), str(tmp_path / "out"), verbose=False)
+    manifest.write_text("http://a/3.jpg\n")
+    assert downloader.url_list == ["http://a/3.jpg"]
+
+
+def test_output_names_go_with_their_urls(tmp_path):
+    downloader = URLDownloader_v2(["http://a/x", "http://a/y"], str(tmp_path), verbose=False,
+                                  output_name_list=["1.jpg", "2.jpg"])
+    assert downloader.output_path_list == [str(tmp_path / "data" / "1.jpg"), str(tmp_path / "data" / "2.jpg")]
+    with pytest.raises(AssertionError):
+        URLDownloader_v2(["http://a/x", "http://a/y"], str(tmp_path), verbose=False, output_name_list=["1.jpg"])
+
+
+def test_an_empty_output_name_list_means_the_default_names(tmp_path):
+    downloader = URLDownloader_v2(["http://a/x.jpg"], str(tmp_path), verbose=False, output_name_list=[])
+    assert downloader.output_path_list == [str(tmp_path / "data" / "x.jpg")]
@@ -0,0 +1,59 @@
+import pytest
+
+from conftest import get_body, read_log
+from url_downloader import AsyncURLDownloader, DownloadResult, ResultColumns, URLDownloader_v2
+
+
+def make_downloader(engine, urls, tmp_path, num_thread=2, **kwargs):
+    if engine is AsyncURLDownloader:
+        kwargs["max_concurrency"] = num_thread
+    return engine(urls, str(tmp_path), num_thread, verbose=False, **kwargs)
+
+
+def test_results_are_made_from_the_columns():
+    columns = ResultColumns()
+    columns.append("http://a/1", True, 200, 100, 0.5, outpath="out/1")
+    columns.append("http://a/2", False, None, message="last error")
+    results = list(DownloadResult.from_columns(columns))
+    assert [(r.url, r.outpath, r.ok, r.status_code, r.size) for r in results] == \
+        [("http://a/1", "out/1", True, 200, 100), ("http://a/2", None, False, None, 0)]
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_every_url_is_yielded_once_logged(server, tmp_path, engine):
+    urls = [server.url("/{}.bin".format(i), size=500, seed=str(i)) for i in range(6)]
+    missing = server.url("/missing.bin", status=404)
+    downloader = make_downloader(engine, urls + [missing], tmp_path)
+    results = {result.url: result for result in downloader.iter_downloads(read_bodies=True)}
+    assert sorted(results) == sorted(urls + [missing])
+    for i, url in enumerate(urls):
+        assert results[url].ok and results[url].status_code == 200 and results[url].size == 500
+        assert results[url].outpath == str(tmp_path / "data" / "{}.bin".format(i))
+        assert results[url].body == get_body(500, str(i))
+    assert (results[missing].ok, results[missing].status_code, results[missing].body) == (False, 404, None)
+    assert sorted(read_log(str(tmp_path))) == sorted([(url, "o") for url in urls] + [(missing, "x")])
+    # the object can be iterated again, nothing is pending
+    assert list(downloader.iter_downloads()) == []
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_results_are_yielded_while_the_others_download(server, tmp_path, engine):
+    urls = [server.url("/{}.bin".format(i), delay=0.2) for i in range(5)]
+    downloader = make_downloader(engine, urls, tmp_path, num_thread=1)
+    for _ in downloader.iter_downloads(max_buffered=1):
+        assert len(server.requests) < len(urls)
+        break
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_leaving_the_loop_keeps_the_rest_pending(server, tmp_path, engine):
+    urls = [server.url("/{}.bin".format(i), delay=0.05) for i in range(20)]
+    downloader = make_downloader(engine, urls, tmp_path)
+    first = next(iter(downloader.iter_downloads(max_buffered=1)))
+    assert first.ok
+    logged = [url for url, _ in read_log(str(tmp_path))]
+    assert first.url in logged and len(logged) < len(urls)
+    # a new run downloads only the urls that were not logged
+    rest = make_downloader(engine, urls, tmp_path)
+    assert sorted(result.url for result in rest.iter_downloads()) == sorted(set(urls) - set(logged))
+    assert sorted(url for url, _ in read_log(str(tmp_path))) == sorted(urls)
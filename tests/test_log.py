@@ -0,0 +1,95 @@
+import os
+import time
+
+import pytest
+
+from conftest import read_log
+from url_downloader import (AsyncURLDownloader, LogReader, LogWriter, ResumeIndex, URLDownloader_v2,
+                            merge_shard_logs, url_fingerprint)
+
+ENTRIES = [("http://a/1", False), ("http://a/2", True), ("http://a/é", False)]
+
+
+@pytest.mark.parametrize("log_format", ["text", "binary"])
+def test_log_formats_round_trip(tmp_path, log_format):
+    path = str(tmp_path / "downloaded.log")
+    writer = LogWriter(path, log_format)
+    writer.write(ENTRIES)
+    writer.close()
+    reader = LogReader(path)
+    assert reader.log_format == log_format
+    assert list(reader) == [(url, failed, url_fingerprint(url)) for url, failed in ENTRIES]
+    assert reader.valid_size == os.path.getsize(path)
+
+
+def test_binary_reader_can_skip_the_urls(tmp_path):
+    path = str(tmp_path / "downloaded.log")
+    writer = LogWriter(path, "binary")
+    writer.write(ENTRIES)
+    writer.close()
+    assert list(LogReader(path, read_size=7, read_urls=False)) == \
+        [(None, failed, url_fingerprint(url)) for url, failed in ENTRIES]
+
+
+def test_writer_buffers_until_the_batch_is_full(tmp_path):
+    path = str(tmp_path / "downloaded.log")
+    writer = LogWriter(path, flush_interval=60, batch_size=3)
+    writer.write(ENTRIES[:2])
+    assert not os.path.exists(path)
+    writer.write(ENTRIES[2:])
+    assert writer.num_flushes == 1 and len(list(LogReader(path))) == 3
+    writer.close()
+
+
+def test_writer_flushes_after_the_interval(tmp_path):
+    path = str(tmp_path / "downloaded.log")
+    writer = LogWriter(path, flush_interval=0.05, batch_size=1000)
+    writer.write(ENTRIES[:1])
+    deadline = time.monotonic() + 5
+    while writer.num_flushes == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert len(list(LogReader(path))) == 1
+    writer.close()
+
+
+@pytest.mark.parametrize("log_format", ["text", "binary"])
+def test_a_torn_record_is_cut_off_before_appending(tmp_path, log_format):
+    path = str(tmp_path / "downloaded.log")
+    writer = LogWriter(path, log_format)
+    writer.write(ENTRIES[:2])
+    writer.close()
+    with open(path, "ab") as f:
+        f.write(b"http://a/torn" if log_format == "text" else b"\x20\x00\x00")
+    index = ResumeIndex(path)
+    assert index.log_format == log_format and index.num_lines == 2
+    index.append_entries([("http://a/3", False)])
+    index.close()
+    assert [url for url, _, _ in LogReader(path)] == ["http://a/1", "http://a/2", "http://a/3"]
+
+
+def test_an_existing_log_keeps_its_format(tmp_path):
+    path = str(tmp_path / "downloaded.log")
+    index = ResumeIndex(path, log_format="binary")
+    index.append_entries(ENTRIES)
+    index.close()
+    reloaded = ResumeIndex(path, log_format="text")
+    assert reloaded.log_format == "binary"
+    assert (reloaded.count("http://a/1"), reloaded.is_failed("http://a/2")) == (1, True)
+
+
+def test_merge_shard_logs_keeps_the_binary_format(tmp_path):
+    for i in range(2):
+        writer = LogWriter(str(tmp_path / "downloaded.shard-0000{}-of-00002.log".format(i)), "binary")
+        writer.write(ENTRIES[i:i + 1])
+        writer.close()
+    assert merge_shard_logs(str(tmp_path)) == 2
+    merged = LogReader(str(tmp_path / "downloaded.log"))
+    assert merged.log_format == "binary"
+    assert [url for url, _, _ in merged] == ["http://a/1", "http://a/2"]
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_engines_flush_the_log_on_exit(server, tmp_path, engine):
+    urls = [server.url("/{}.bin".format(i)) for i in range(5)]
+    engine(urls, str(tmp_path), 2, verbose=False, log_flush_interval=60, log_fsync="data").download_all_sites()
+    assert sorted(read_log(str(tmp_path))) == sorted((url, "o") for url in urls)
@@ -0,0 +1,75 @@
+import json
+import urllib.request
+
+import pytest
+
+from url_downloader import AsyncURLDownloader, DownloadMetrics, Histogram, RetryPolicy, URLDownloader_v2
+
+
+def test_histogram_buckets_and_quantiles():
+    hist = Histogram([0.1, 1])
+    assert hist.quantile(0.5) is None
+    for value in (0.05, 0.1, 0.5, 5):
+        hist.observe(value)
+    assert hist.counts == [2, 1, 1]
+    assert (hist.quantile(0.5), hist.quantile(0.75), hist.quantile(1)) == (0.1, 1, float("inf"))
+    assert hist.to_dict()["count"] == 4
+
+
+def test_metrics_record_attempts_urls_and_hooks():
+    metrics = DownloadMetrics()
+    events = []
+    metrics.add_hook(events.append)
+    metrics.add_hook(lambda event: 1 / 0)
+    metrics.record_attempt("http://a/1", "a", 503, False, 0, 0.01, 0.02, 0.0)
+    metrics.record_retry()
+    metrics.record_attempt("http://a/1", "a", 200, True, 100, 0, 0.02, 0.01)
+    assert metrics.record_url("a", True) == 1
+    assert metrics.record_url("b", False) == 2
+    snapshot = metrics.snapshot()
+    assert snapshot["counters"] == {"attempts": 2, "bytes": 100, "retries": 1, "urls_ok": 1, "urls_failed": 1}
+    assert snapshot["status_codes"] == {"503": 1, "200": 1}
+    # a reused connection has no connect time
+    assert snapshot["latency_s"]["connect"]["count"] == 1
+    assert snapshot["per_host"]["a"]["attempts"] == 2 and snapshot["per_host"]["b"]["failed"] == 1
+    assert [event["status"] for event in events] == [503, 200]
+    json.dumps(snapshot)
+
+
+def test_prometheus_text():
+    metrics = DownloadMetrics()
+    metrics.record_attempt("http://a/1", "a", None, False, 0, 0, 0.02, 0)
+    metrics.record_url("a", False)
+    text = metrics.to_prometheus()
+    assert 'downloader_urls_total{result="failed"} 1' in text
+    assert 'downloader_status_total{code="error"} 1' in text
+    assert 'downloader_latency_seconds_bucket{phase="ttfb",le="+Inf"} 1' in text
+    assert text.endswith("downloader_queue_depth 0\n")
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_engines_record_metrics(server, tmp_path, engine):
+    urls = [server.url("/{}.bin".format(i), size=200) for i in range(4)] + [server.url("/flaky.bin", fail=1)]
+    metrics_file = tmp_path / "metrics.jsonl"
+    downloader = engine(urls, str(tmp_path), verbose=False, metrics_file=str(metrics_file), metrics_interval=60,
+                        retry_policy=RetryPolicy(backoff_base=0.01))
+    downloader.download_all_sites()
+    snapshot = downloader.get_metrics()
+    assert snapshot["counters"]["urls_ok"] == 5
+    assert (snapshot["counters"]["attempts"], snapshot["counters"]["retries"]) == (6, 1)
+    assert snapshot["counters"]["bytes"] == 900
+    assert snapshot["status_codes"] == {"200": 5, "503": 1}
+    assert snapshot["active_workers"] == 0
+    # the reporter writes a last snapshot when the download ends
+    assert json.loads(metrics_file.read_text().splitlines()[-1])["counters"]["urls_ok"] == 5
+
+
+def test_prometheus_endpoint(server, tmp_path):
+    downloader = URLDownloader_v2([server.url("/a.bin")], str(tmp_path), verbose=False, prometheus_port=0)
+    downloader.download_all_sites()
+    port = downloader.metrics_server.server_address[1]
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(port)) as response:
+            assert 'downloader_urls_total{result="ok"} 1' in response.read().decode()
+    finally:
+        downloader.metrics_server.shutdown()
@@ -0,0 +1,101 @@
+import os
+
+import pytest
+
+from conftest import get_body, read_log
+from url_downloader import AsyncURLDownloader, PartialDownload, RetryPolicy, URLDownloader_v2, parse_content_range
+
+
+def ranged_downloader(urls, out_path, **kwargs):
+    return URLDownloader_v2(urls, str(out_path), 4, verbose=False, stream=True, chunk_size=100, resume_partial=True,
+                            retry_policy=RetryPolicy(backoff_base=0.01), **kwargs)
+
+
+def get_ranges(server):
+    return [headers.get("Range") for _, headers in server.requests]
+
+
+def test_parse_content_range():
+    assert parse_content_range("bytes 0-1023/4096") == (0, 1023, 4096)
+    assert parse_content_range("bytes 5-9/*") == (5, 9, None)
+    assert parse_content_range("bytes */4096") is None
+    assert parse_content_range(None) is None
+
+
+def test_partial_download_state_round_trip(tmp_path):
+    outpath = str(tmp_path / "a.bin")
+    partial = PartialDownload("http://a/1", outpath, 'W/"weak"', "Wed, 21 Oct 2015 07:28:00 GMT", 1000, 300, [0])
+    # If-Range takes only a strong ETag
+    assert partial.validator == "Wed, 21 Oct 2015 07:28:00 GMT"
+    assert (partial.num_segments, partial.segment_range(3), partial.missing_segments()) == (4, (900, 999), [1, 2, 3])
+    open(partial.part_path, "wb").close()
+    partial.save()
+    loaded = PartialDownload.load("http://a/1", outpath)
+    assert (loaded.total, loaded.segment_size, loaded.done) == (1000, 300, {0})
+    # the state of another url is stale
+    assert PartialDownload.load("http://a/2", outpath) is None
+    assert not os.path.exists(partial.part_path) and not os.path.exists(partial.meta_path)
+
+
+def test_an_interrupted_download_continues_with_a_range_request(server, tmp_path):
+    url = server.url("/a.bin", size=1000, etag='"v1"', cut=300)
+    ranged_downloader([url], tmp_path).download_all_sites()
+    assert get_ranges(server) == [None, "bytes=300-"]
+    assert server.requests[1][1]["If-Range"] == '"v1"'
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(1000)
+    assert not os.path.exists(tmp_path / "data" / "a.bin.part.meta")
+    assert read_log(str(tmp_path)) == [(url, "o")]
+
+
+def test_a_changed_body_starts_over(server, tmp_path):
+    url = server.url("/a.bin", size=1000, etag='"v2"')
+    outpath = str(tmp_path / "data" / "a.bin")
+    os.makedirs(os.path.dirname(outpath))
+    with open(outpath + ".part", "wb") as f:
+        f.write(b"x" * 400)
+    PartialDownload(url, outpath, '"v1"', None, 1000).save()
+    ranged_downloader([url], tmp_path).download_all_sites()
+    assert get_ranges(server) == ["bytes=400-"]
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(1000)
+
+
+def test_a_complete_part_file_is_finished_on_416(server, tmp_path):
+    url = server.url("/a.bin", size=1000, etag='"v1"')
+    outpath = str(tmp_path / "data" / "a.bin")
+    os.makedirs(os.path.dirname(outpath))
+    with open(outpath + ".part", "wb") as f:
+        f.write(get_body(1000))
+    PartialDownload(url, outpath, '"v1"', None, 1000).save()
+    ranged_downloader([url], tmp_path).download_all_sites()
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(1000)
+    assert read_log(str(tmp_path)) == [(url, "o")]
+
+
+def test_a_large_body_is_downloaded_in_segments(server, tmp_path):
+    url = server.url("/a.bin", size=10000, etag='"v1"')
+    ranged_downloader([url], tmp_path, segment_size=3000).download_all_sites()
+    assert sorted(get_ranges(server)) == ["bytes=0-2999", "bytes=3000-5999", "bytes=6000-8999", "bytes=9000-9999"]
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(10000)
+    assert read_log(str(tmp_path)) == [(url, "o")]
+
+
+def test_segments_of_a_body_over_max_bytes_per_file_are_not_requested(server, tmp_path):
+    url = server.url("/a.bin", size=10000, etag='"v1"')
+    ranged_downloader([url], tmp_path, segment_size=3000, max_bytes_per_file=5000).download_all_sites()
+    assert get_ranges(server) == ["bytes=0-2999"]
+    assert os.listdir(tmp_path / "data") == []
+    assert read_log(str(tmp_path)) == [(url, "x")]
+
+
+def test_download_site_fetches_the_segments_inline(server, tmp_path):
+    url = server.url("/a.bin", size=5000, etag='"v1"')
+    downloader = ranged_downloader([url], tmp_path, segment_size=2000)
+    downloader.download_site(url, str(tmp_path / "data" / "a.bin"), log_flag=True)
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(5000)
+    assert len(server.requests) == 3
+
+
+def test_async_engine_rejects_ranged_downloads(tmp_path):
+    with pytest.raises(ValueError):
+        AsyncURLDownloader(["http://a/1"], str(tmp_path), verbose=False, stream=True,
+                           resume_partial=True).download_all_sites()
@@ -0,0 +1,42 @@
+import time
+
+from conftest import read_log
+from url_downloader import AsyncURLDownloader, URLDownloader_v2
+
+
+def test_a_straggler_does_not_hold_back_the_other_urls(server, tmp_path):
+    slow = server.url("/slow.bin", delay=2.0)
+    fast = [server.url("/{}.bin".format(i)) for i in range(20)]
+    start = time.monotonic()
+    URLDownloader_v2([slow] + fast, str(tmp_path), 2, verbose=False).download_all_sites(batch_size=4)
+    assert time.monotonic() - start < 3.0
+    # every fast url is logged while the straggler still holds its worker
+    log = read_log(str(tmp_path))
+    assert len(log) == 21
+    assert log[-1] == (slow, "o")
+
+
+def test_a_connection_error_is_logged_as_failed(server, tmp_path):
+    url = "http://127.0.0.1:1/a.bin"
+    URLDownloader_v2([url], str(tmp_path), verbose=False, timeout=5).download_all_sites()
+    assert read_log(str(tmp_path)) == [(url, "x")]
+
+
+def test_an_unexpected_error_leaves_the_url_out_of_the_log(server, tmp_path):
+    def saver(outpath, response):
+        if "bad" in outpath:
+            raise ValueError("cannot decode")
+        with open(outpath, "wb") as f:
+            f.write(response.content)
+
+    good, bad = server.url("/good.bin"), server.url("/bad.bin")
+    URLDownloader_v2([good, bad], str(tmp_path), verbose=False, custom_img_saver=saver).download_all_sites()
+    assert read_log(str(tmp_path)) == [(good, "o")]
+    assert URLDownloader_v2([good, bad], str(tmp_path), verbose=False).url_list == [bad]
+
+
+def test_downloads_print_nothing_to_stdout(server, tmp_path, capsys):
+    urls = [server.url("/{}.bin".format(i)) for i in range(3)]
+    URLDownloader_v2(urls, str(tmp_path / "threaded"), verbose=False).download_all_sites()
+    AsyncURLDownloader(urls, str(tmp_path / "async"), verbose=False).download_all_sites()
+    assert capsys.readouterr().out == ""
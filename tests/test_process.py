@@ -0,0 +1,57 @@
+import os
+
+import pytest
+
+from conftest import get_body, read_log
+from url_downloader import AsyncURLDownloader, TarShardStorage, URLDownloader_v2
+
+
+def reverse_body(url, path):
+    # the processors run in spawned processes, so they are at module level
+    if "reject" in url:
+        return False
+    if "error" in url:
+        raise ValueError("cannot decode")
+    with open(path, "rb") as f:
+        body = f.read()
+    with open(path, "wb") as f:
+        f.write(body[::-1])
+
+
+@pytest.mark.parametrize("engine, stream", [(URLDownloader_v2, False), (URLDownloader_v2, True),
+                                            (AsyncURLDownloader, False), (AsyncURLDownloader, True)])
+def test_processed_bodies_are_saved_and_rejected_ones_logged(server, tmp_path, engine, stream):
+    urls = [server.url("/{}.bin".format(i), size=1000, seed=str(i)) for i in range(4)]
+    rejected = [server.url("/reject.bin"), server.url("/error.bin")]
+    downloader = engine(urls + rejected, str(tmp_path), 2, verbose=False, stream=stream, processor=reverse_body,
+                        process_workers=2)
+    downloader.download_all_sites()
+    assert sorted(read_log(str(tmp_path))) == sorted([(url, "o") for url in urls] + [(url, "x") for url in rejected])
+    assert all((tmp_path / "data" / "{}.bin".format(i)).read_bytes() == get_body(1000, str(i))[::-1] for i in range(4))
+    assert sorted(os.listdir(tmp_path / "data")) == ["{}.bin".format(i) for i in range(4)]
+    # the temp files are removed, saved or not
+    assert os.listdir(downloader.processing_dir) == []
+    stages = downloader.get_metrics()["stages"]
+    assert stages["process"]["items"] == 5 and stages["process"]["workers"] == 2
+
+
+def test_processed_files_go_through_the_storage(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i), size=1000, seed=str(i)) for i in range(3)]
+    URLDownloader_v2(urls, str(tmp_path), 2, verbose=False, processor=reverse_body, process_workers=1,
+                     storage=TarShardStorage()).download_all_sites()
+    reloaded = TarShardStorage(str(tmp_path / "data"))
+    assert all(reloaded.read(str(tmp_path / "data" / "{}.bin".format(i))) == get_body(1000, str(i))[::-1]
+               for i in range(3))
+
+
+def test_the_processor_runs_inline_outside_a_pipeline(server, tmp_path):
+    url = server.url("/a.bin", size=100)
+    downloader = URLDownloader_v2([url], str(tmp_path), verbose=False, processor=reverse_body)
+    downloader.download_site(url, str(tmp_path / "data" / "a.bin"))
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(100)[::-1]
+
+
+def test_the_processor_excludes_custom_savers(tmp_path):
+    with pytest.raises(AssertionError):
+        URLDownloader_v2([], str(tmp_path), verbose=False, processor=reverse_body,
+                         custom_img_saver=lambda outpath, response: None)
@@ -0,0 +1,64 @@
+import pytest
+
+from conftest import read_log
+from url_downloader import AsyncURLDownloader, RateLimiter, TokenBucket, URLDownloader_v2
+
+
+def test_token_bucket_refills_and_pays_its_debt():
+    bucket = TokenBucket(rate=10, burst=2)
+    now = bucket._updated
+    assert bucket.get_wait(1, now) == 0
+    bucket.take(2, now)
+    assert bucket.get_wait(1, now) == pytest.approx(0.1)
+    assert bucket.get_wait(1, now + 0.11) == 0
+    bucket.take(5, now + 0.11)
+    # 3.9 tokens in debt, paid after 0.39 secs
+    assert bucket.get_wait(0, now + 0.11) == pytest.approx(0.39)
+    assert bucket.get_wait(2, now + 10) == 0 and bucket.tokens == 2
+
+
+def test_rate_limiter_keeps_global_and_per_host_rates():
+    limiter = RateLimiter(requests_per_sec=10, requests_per_sec_per_host={"slow": 1})
+    assert limiter.try_acquire("slow") == 0
+    assert limiter.try_acquire("slow") > 0.9
+    assert all(limiter.try_acquire("fast") == 0 for _ in range(9))
+    assert limiter.num_delayed == {"slow": 1}
+    assert limiter.get_global_wait() > 0.05
+    assert limiter.try_acquire("fast") > 0.05
+
+
+def test_rate_limiter_charges_bytes_after_the_request():
+    limiter = RateLimiter(bytes_per_sec_per_host=1000)
+    assert limiter.try_acquire("a") == 0
+    limiter.observe({"host": "a", "bytes": 3000})
+    assert limiter.try_acquire("a") == pytest.approx(2.0, abs=0.05)
+    assert limiter.try_acquire("b") == 0
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_a_rate_limited_host_does_not_hold_back_the_others(server, tmp_path, engine):
+    slow = [server.url("/slow{}.bin".format(i)).replace("127.0.0.1", "localhost") for i in range(4)]
+    fast = [server.url("/fast{}.bin".format(i)) for i in range(20)]
+    limiter = RateLimiter(requests_per_sec_per_host={slow[0].split("/")[2]: 5}, burst_secs=0.2)
+    engine(slow + fast, str(tmp_path), 4, verbose=False, rate_limiter=limiter).download_all_sites()
+    times = dict(zip((path for path, _ in server.requests), server.request_times))
+    slow_starts = sorted(t for path, t in times.items() if path.startswith("/slow"))
+    fast_starts = sorted(t for path, t in times.items() if path.startswith("/fast"))
+    # one request per 0.2 secs, the first connection to the host may add a few msecs to the first gap
+    assert all(b - a >= 0.1 for a, b in zip(slow_starts, slow_starts[1:]))
+    assert slow_starts[-1] - slow_starts[0] >= 0.55
+    # the slow host needs 0.6 secs for its 4 urls, the fast urls are done well before
+    assert fast_starts[-1] < slow_starts[-1]
+    assert len(read_log(str(tmp_path))) == 24
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_error_tolerance_pauses_the_dispatcher(server, tmp_path, engine):
+    # once the error url fails, no other url may start for stop_interval, and no worker sleeps meanwhile
+    failing = server.url("/error.bin", status=500)
+    urls = [failing] + [server.url("/{}.bin".format(i), delay=0.05) for i in range(6)]
+    engine(urls, str(tmp_path), 2, verbose=False, err_tolerance_num=0, stop_interval=0.5).download_all_sites()
+    times = dict(zip((path for path, _ in server.requests), server.request_times))
+    failed_at = times.pop("/error.bin?status=500")
+    assert not [t for t in times.values() if failed_at + 0.1 < t < failed_at + 0.45]
+    assert len(read_log(str(tmp_path))) == 7
@@ -0,0 +1,51 @@
+from urllib.parse import urlparse
+
+import pytest
+
+from conftest import read_log
+from url_downloader import ResultColumns, ResumeIndex, URLDownloader_v2, get_host, split_url
+
+
+@pytest.mark.parametrize("url", [
+    "https://images.example.com/product/1.jpg?size=xl#top",
+    "http://example.com",
+    "http://example.com?q=1",
+    "http://user@example.com:8080/a/b/",
+    "example.com/a.jpg",
+])
+def test_split_url_agrees_with_urlparse(url):
+    parsing = urlparse(url)
+    assert split_url(url) == (parsing.netloc, parsing.path)
+    assert get_host(url) == parsing.netloc
+
+
+def test_result_columns_append_and_clear():
+    columns = ResultColumns()
+    columns.append("http://a/1", True, 200, 100, 0.5)
+    columns.append("http://a/2", False, None, message="last error")
+    assert len(columns) == 2
+    assert (list(columns.saved), list(columns.status_codes), list(columns.sizes)) == ([1, 0], [200, 0], [100, 0])
+    assert columns.messages == ["last error"]
+    columns.clear()
+    assert len(columns) == 0 and len(columns.saved) == 0 and columns.messages == []
+
+
+def test_append_entries_writes_the_log_once(tmp_path):
+    log_file = str(tmp_path / "downloaded.log")
+    index = ResumeIndex(log_file)
+    index.append_entries([("a", False), ("b", True)])
+    assert (index.count("a"), index.is_failed("b"), index.num_lines) == (1, True, 2)
+    index.close()
+    assert read_log(str(tmp_path)) == [("a", "o"), ("b", "x")]
+
+
+def test_write_results_logs_and_reports_a_batch(tmp_path, capsys):
+    downloader = URLDownloader_v2([], str(tmp_path), verbose=False)
+    columns = ResultColumns()
+    columns.append("http://a/1", True, 200)
+    columns.append("http://a/2", False, 404, message="last error code is 404")
+    downloader.write_results(columns)
+    downloader.resume_index.flush()
+    assert read_log(str(tmp_path)) == [("http://a/1", "o"), ("http://a/2", "x")]
+    # without verbose only the errors are reported
+    assert capsys.readouterr().err == "xlast error code is 404"
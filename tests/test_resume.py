@@ -0,0 +1,59 @@
+from conftest import read_log
+from url_downloader import ResumeIndex, URLDownloader_v2
+
+
+def write_log(path, lines):
+    with open(path, "w") as f:
+        f.writelines(lines)
+
+
+def test_resume_index_loads_the_log_once(tmp_path):
+    log_file = str(tmp_path / "downloaded.log")
+    write_log(log_file, ["a\to\n", "b\tx\n", "a\to\n", "# batch above\n"])
+    index = ResumeIndex(log_file)
+    assert (index.count("a"), index.count("b"), index.count("c")) == (2, 1, 0)
+    assert not index.is_failed("a") and index.is_failed("b")
+    # the marker line is not an entry
+    assert index.num_lines == 3
+
+
+def test_resume_index_append_writes_and_records(tmp_path):
+    log_file = str(tmp_path / "downloaded.log")
+    index = ResumeIndex(log_file)
+    index.append(["a\tx\n", "b\to\n"])
+    assert index.count("a") == 1 and index.is_failed("a")
+    index.close()
+    reloaded = ResumeIndex(log_file)
+    assert (reloaded.count("a"), reloaded.count("b")) == (1, 1)
+    assert reloaded.is_failed("a") and not reloaded.is_failed("b")
+
+
+def test_pending_skips_one_slot_per_log_entry(tmp_path):
+    write_log(str(tmp_path / "downloaded.log"), ["a\to\n", "b\tx\n"])
+    downloader = URLDownloader_v2(["a", "a", "b", "c"], str(tmp_path), verbose=False,
+                                  output_name_list=["a1", "a2", "b1", "c1"])
+    assert list(downloader.iter_pending()) == [("a", str(tmp_path / "data" / "a2")), ("c", str(tmp_path / "data" / "c1"))]
+
+
+def test_compact_keeps_the_counts_and_the_latest_status(tmp_path):
+    log_file = str(tmp_path / "downloaded.log")
+    write_log(log_file, ["a\to\n", "# batch above\n", "b\to\n", "b\tx\n", "a\to\n"])
+    index = ResumeIndex(log_file)
+    index.compact()
+    with open(log_file) as f:
+        assert sorted(f) == ["a\to\n", "a\to\n", "b\to\n", "b\tx\n"]
+    assert index.num_lines == 4
+    reloaded = ResumeIndex(log_file)
+    assert (reloaded.count("a"), reloaded.count("b")) == (2, 2)
+    assert reloaded.is_failed("b")
+
+
+def test_downloader_resumes_from_the_log(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i)) for i in range(6)]
+    write_log(str(tmp_path / "downloaded.log"), ["{}\to\n".format(url) for url in urls[:4]])
+    downloader = URLDownloader_v2(urls, str(tmp_path), 2, verbose=False)
+    assert sorted(downloader.url_list) == urls[4:]
+    downloader.download_all_sites(batch_size=1)
+    assert sorted(path for path, _ in server.requests) == ["/4.bin", "/5.bin"]
+    assert sorted(read_log(str(tmp_path))[4:]) == [(urls[4], "o"), (urls[5], "o")]
+    assert URLDownloader_v2(urls, str(tmp_path), 2, verbose=False).get_num_urls_needed() == 0
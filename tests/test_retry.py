@@ -0,0 +1,91 @@
+import email.utils
+import time
+
+import pytest
+
+from conftest import read_log
+from url_downloader import AsyncURLDownloader, ResumeIndex, RetryPolicy, URLDownloader_v2, parse_retry_after
+
+
+def fast_policy(**kwargs):
+    return RetryPolicy(backoff_base=0.01, backoff_max=0.05, **kwargs)
+
+
+def test_retry_policy_decides_by_status_and_attempt():
+    policy = RetryPolicy(max_attempts=3, status_max_attempts={503: 2})
+    assert policy.should_retry(503, 1) and not policy.should_retry(503, 2)
+    assert not policy.should_retry(404, 1)
+    assert policy.should_retry(None, 2) and not policy.should_retry(None, 3)
+    assert not RetryPolicy(retry_on_connection_error=False).should_retry(None, 1)
+
+
+def test_retry_policy_backs_off_exponentially_up_to_the_max():
+    policy = RetryPolicy(backoff_base=1, backoff_factor=2, backoff_max=5, jitter=0)
+    assert [policy.get_delay(attempt) for attempt in (1, 2, 3, 4)] == [1, 2, 4, 5]
+    jittered = RetryPolicy(backoff_base=1, jitter=0.5)
+    assert all(0.5 <= jittered.get_delay(1) <= 1 for _ in range(100))
+
+
+def test_retry_after_overrides_the_backoff():
+    policy = RetryPolicy(jitter=0, max_retry_after=10)
+    assert policy.get_delay(1, "3") == 3
+    assert policy.get_delay(1, "120") == 10
+    assert policy.get_delay(2, "soon") == 2
+    assert RetryPolicy(jitter=0, respect_retry_after=False).get_delay(1, "3") == 1
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(" 7 ") == 7.0
+    assert parse_retry_after("soon") is None
+    date = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 <= parse_retry_after(date) <= 30
+    assert parse_retry_after(email.utils.formatdate(time.time() - 30, usegmt=True)) == 0.0
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_a_flaky_url_is_retried_until_it_succeeds(server, tmp_path, engine):
+    url = server.url("/flaky.bin", fail=2)
+    engine([url], str(tmp_path), verbose=False, retry_policy=fast_policy()).download_all_sites()
+    assert len(server.requests) == 3
+    assert read_log(str(tmp_path)) == [(url, "o")]
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_an_url_is_logged_as_failed_after_the_last_attempt(server, tmp_path, engine):
+    flaky, missing = server.url("/flaky.bin", fail=5), server.url("/missing.bin", status=404)
+    engine([flaky, missing], str(tmp_path), verbose=False,
+           retry_policy=fast_policy(max_attempts=2)).download_all_sites()
+    assert sorted(path for path, _ in server.requests) == ["/flaky.bin?fail=5"] * 2 + ["/missing.bin?status=404"]
+    assert sorted(read_log(str(tmp_path))) == sorted([(flaky, "x"), (missing, "x")])
+
+
+def test_a_retry_waits_for_retry_after(server, tmp_path):
+    url = server.url("/busy.bin", fail=1, status=429, retry_after=1)
+    URLDownloader_v2([url], str(tmp_path), verbose=False, retry_policy=fast_policy()).download_all_sites()
+    first, second = server.request_times
+    assert second - first >= 0.9
+    assert read_log(str(tmp_path)) == [(url, "o")]
+
+
+def test_retry_failed_downloads_only_the_failed_urls(server, tmp_path):
+    good, flaky = server.url("/good.bin"), server.url("/flaky.bin", fail=1)
+    URLDownloader_v2([good, flaky], str(tmp_path), verbose=False).download_all_sites()
+    assert sorted(read_log(str(tmp_path))) == sorted([(good, "o"), (flaky, "x")])
+    downloader = URLDownloader_v2([good, flaky], str(tmp_path), verbose=False)
+    downloader.retry_failed()
+    assert [path for path, _ in server.requests].count("/good.bin") == 1
+    assert read_log(str(tmp_path))[-1] == (flaky, "o")
+    assert (tmp_path / "data" / "flaky.bin").exists()
+    assert URLDownloader_v2([good, flaky], str(tmp_path), verbose=False).get_num_urls_needed() == 0
+
+
+def test_an_entry_after_an_error_replaces_the_error(tmp_path):
+    log_file = str(tmp_path / "downloaded.log")
+    with open(log_file, "w") as f:
+        f.writelines(["a\tx\n", "a\to\n", "b\tx\n", "b\tx\n", "c\to\n", "c\tx\n"])
+    index = ResumeIndex(log_file)
+    # a retry of a failed url is not a new entry, so it does not take a second slot of a duplicated url
+    assert (index.count("a"), index.is_failed("a")) == (1, False)
+    assert (index.count("b"), index.is_failed("b")) == (1, True)
+    # an entry after a success is a new entry, as before
+    assert (index.count("c"), index.is_failed("c")) == (2, True)
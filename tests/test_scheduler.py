@@ -0,0 +1,91 @@
+import pytest
+
+from conftest import read_log
+from url_downloader import AsyncURLDownloader, DownloadTask, HostScheduler, URLDownloader_v2
+
+
+def make_tasks(urls):
+    return iter([DownloadTask(url, url.split("/")[-1]) for url in urls])
+
+
+def drain(scheduler, try_start=lambda host: True):
+    order = []
+    while True:
+        task = scheduler.next(try_start)
+        if task is None:
+            return order
+        order.append(task.outpath)
+
+
+def test_hosts_take_turns_and_keep_their_input_order():
+    urls = ["http://a/1", "http://a/2", "http://a/3", "http://b/1", "http://b/2", "http://c/1"]
+    assert drain(HostScheduler(make_tasks(urls))) == ["1", "1", "1", "2", "2", "3"]
+    scheduler = HostScheduler(make_tasks(urls))
+    assert [scheduler.next().url for _ in range(6)] == \
+        ["http://a/1", "http://b/1", "http://c/1", "http://a/2", "http://b/2", "http://a/3"]
+
+
+def test_a_window_of_one_keeps_the_input_order():
+    urls = ["http://a/1", "http://a/2", "http://b/1"]
+    scheduler = HostScheduler(make_tasks(urls), window=1)
+    assert [scheduler.next().url for _ in range(3)] == urls
+
+
+def test_priorities_then_deadlines_go_first():
+    urls = ["http://a/1", "http://a/2", "http://b/1", "http://c/1"]
+    priorities = {"http://a/2": 1, "http://c/1": 1}
+    deadlines = {"http://c/1": 60}
+    scheduler = HostScheduler(make_tasks(urls), priority_fn=lambda url: priorities.get(url, 0),
+                              deadline_fn=deadlines.get)
+    assert [scheduler.next().url for _ in range(4)] == ["http://c/1", "http://a/2", "http://b/1", "http://a/1"]
+
+
+def test_a_skipped_host_keeps_its_turn():
+    urls = ["http://a/1", "http://b/1", "http://c/1"]
+    scheduler = HostScheduler(make_tasks(urls))
+    assert scheduler.next(lambda host: host != "a").url == "http://b/1"
+    assert scheduler.next().url == "http://a/1"
+
+
+def test_a_pushed_retry_keeps_the_place_of_its_url():
+    scheduler = HostScheduler(make_tasks(["http://a/1", "http://a/2", "http://a/3"]))
+    first = scheduler.next()
+    assert scheduler.next().url == "http://a/2"
+    scheduler.push(first)
+    assert [scheduler.next().url for _ in range(2)] == ["http://a/1", "http://a/3"]
+
+
+def test_expired_tasks_are_set_aside():
+    scheduler = HostScheduler(make_tasks(["http://a/1", "http://b/1"]),
+                              deadline_fn=lambda url: -1 if url == "http://a/1" else None)
+    assert scheduler.next().url == "http://b/1"
+    assert [task.url for task in scheduler.expired] == ["http://a/1"]
+    assert scheduler.next() is None and scheduler.exhausted
+
+
+def test_the_window_bounds_the_tasks_read_ahead():
+    read = []
+
+    def tasks():
+        for i in range(10):
+            read.append(i)
+            yield DownloadTask("http://a/{}".format(i), str(i))
+
+    scheduler = HostScheduler(tasks(), window=3)
+    scheduler.next(lambda host: False)
+    assert len(read) == 3 and len(scheduler) == 3
+    assert scheduler.next().outpath == "0"
+    assert scheduler.next().outpath == "1"
+    assert len(read) == 4
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_engines_dispatch_by_priority_and_expire_late_urls(server, tmp_path, engine):
+    urls = [server.url("/{}.bin".format(i)) for i in range(6)]
+    late = urls[5]
+    kwargs = {"max_concurrency": 1} if engine is AsyncURLDownloader else {}
+    engine(urls, str(tmp_path), 1, verbose=False, priority_fn=lambda url: url == urls[4],
+           deadline_fn=lambda url: -1 if url == late else None, **kwargs).download_all_sites()
+    paths = [path for path, _ in server.requests]
+    assert paths == ["/4.bin", "/0.bin", "/1.bin", "/2.bin", "/3.bin"]
+    assert sorted(read_log(str(tmp_path))) == sorted([(url, "o") for url in urls[:5]] + [(late, "x")])
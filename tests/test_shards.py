@@ -0,0 +1,48 @@
+import collections
+import os
+
+from conftest import read_log
+from url_downloader import URLDownloader_v2, get_shard_of_url, merge_shard_logs, run_sharded
+
+
+def test_shards_are_stable_and_balanced():
+    urls = ["http://a/{}.jpg".format(i) for i in range(4000)]
+    shards = [get_shard_of_url(url, 4) for url in urls]
+    assert shards == [get_shard_of_url(url, 4) for url in urls]
+    assert all(800 < cnt < 1200 for cnt in collections.Counter(shards).values())
+
+
+def test_shards_split_the_input(tmp_path):
+    urls = ["http://a/{}.jpg".format(i) for i in range(100)]
+    pending = [URLDownloader_v2(urls, str(tmp_path), verbose=False, shard_index=i, shard_count=3).url_list
+               for i in range(3)]
+    assert sorted(sum(pending, [])) == sorted(urls)
+    assert all(get_shard_of_url(url, 3) == 1 for url in pending[1])
+
+
+def test_a_shard_resumes_from_its_own_log(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i)) for i in range(10)]
+    shard_urls = [url for url in urls if get_shard_of_url(url, 2) == 0]
+    URLDownloader_v2(urls, str(tmp_path), verbose=False, shard_index=0, shard_count=2).download_all_sites()
+    assert not os.path.exists(tmp_path / "downloaded.log")
+    with open(tmp_path / "downloaded.shard-00000-of-00002.log") as f:
+        assert sorted(line.split("\t")[0] for line in f) == sorted(shard_urls)
+    assert URLDownloader_v2(urls, str(tmp_path), verbose=False, shard_index=0, shard_count=2).url_list == []
+    assert len(URLDownloader_v2(urls, str(tmp_path), verbose=False, shard_index=1, shard_count=2).url_list) == \
+        len(urls) - len(shard_urls)
+
+
+def test_merge_shard_logs_drops_a_torn_last_line(tmp_path):
+    (tmp_path / "downloaded.shard-00000-of-00002.log").write_text("a\to\nb\tx\nb\to\n")
+    (tmp_path / "downloaded.shard-00001-of-00002.log").write_text("c\to\nd\t")
+    assert merge_shard_logs(str(tmp_path)) == 4
+    assert read_log(str(tmp_path)) == [("a", "o"), ("b", "x"), ("b", "o"), ("c", "o")]
+    assert os.path.exists(tmp_path / "downloaded.shard-00000-of-00002.log")
+
+
+def test_run_sharded_downloads_every_url_once(server, tmp_path):
+    urls = [server.url("/{}.bin".format(i)) for i in range(12)]
+    run_sharded(urls, str(tmp_path), 2, num_thread=2, verbose=False)
+    assert sorted(path for path, _ in server.requests) == sorted("/{}.bin".format(i) for i in range(12))
+    assert sorted(read_log(str(tmp_path))) == sorted((url, "o") for url in urls)
+    assert len(os.listdir(tmp_path / "data")) == 12
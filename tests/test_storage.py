@@ -0,0 +1,141 @@
+import os
+import tarfile
+import threading
+
+import pytest
+
+from benchmarks.stand_in_s3 import StandInS3Server
+from conftest import get_body, read_log
+from url_downloader import (AsyncURLDownloader, FileStorage, S3Storage, StorageBackend, TarShardStorage,
+                            URLDownloader_v2)
+
+
+@pytest.fixture
+def s3_server():
+    server = StandInS3Server(("127.0.0.1", 0), access_key="key", secret_key="secret")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class FailingStorage(FileStorage):
+    def put_bytes(self, url, outpath, body):
+        raise OSError("disk full")
+
+
+def write_with_writer(storage, url, outpath, chunks):
+    writer = storage.open_writer(url, outpath)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.commit()
+
+
+def test_file_storage_renames_a_committed_writer(tmp_path):
+    storage = FileStorage()
+    outpath = str(tmp_path / "a.bin")
+    write_with_writer(storage, "http://a/1", outpath, [b"abc", b"def"])
+    assert storage.exists(outpath) and storage.read(outpath) == b"abcdef"
+    aborted = storage.open_writer("http://a/2", str(tmp_path / "b.bin"))
+    aborted.write(b"partial")
+    aborted.abort()
+    assert os.listdir(tmp_path) == ["a.bin"]
+
+
+def test_tar_shards_are_indexed_and_readable(tmp_path):
+    storage = TarShardStorage(str(tmp_path), max_shard_size=4000)
+    storage.attach(str(tmp_path))
+    for i in range(4):
+        storage.put_bytes("http://a/{}".format(i), str(tmp_path / "{}.bin".format(i)), get_body(1000, str(i)))
+    write_with_writer(storage, "http://a/4", str(tmp_path / "sub" / "4.bin"), [b"x" * 700, b"y" * 300])
+    storage.close()
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".tar")) == \
+        ["shard-000000.tar", "shard-000001.tar"]
+    with tarfile.open(tmp_path / "shard-000000.tar") as tar:
+        assert tar.getnames() == ["0.bin", "1.bin", "2.bin"]
+        assert tar.extractfile("1.bin").read() == get_body(1000, "1")
+    reloaded = TarShardStorage(str(tmp_path))
+    assert reloaded.read(str(tmp_path / "3.bin")) == get_body(1000, "3")
+    assert reloaded.read(str(tmp_path / "sub" / "4.bin")) == b"x" * 700 + b"y" * 300
+    assert not reloaded.exists(str(tmp_path / "5.bin"))
+
+
+def test_a_new_run_appends_a_new_shard(tmp_path):
+    for i in range(2):
+        storage = TarShardStorage(str(tmp_path))
+        storage.put_bytes("http://a/{}".format(i), str(tmp_path / "{}.bin".format(i)), b"body")
+        storage.close()
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".tar")) == \
+        ["shard-000000.tar", "shard-000001.tar"]
+    assert TarShardStorage(str(tmp_path)).read(str(tmp_path / "0.bin")) == b"body"
+
+
+def test_s3_storage_signs_its_requests(tmp_path, s3_server):
+    endpoint = "http://127.0.0.1:{}".format(s3_server.server_address[1])
+    storage = S3Storage(endpoint, "bucket", "run/", access_key="key", secret_key="secret")
+    storage.attach(str(tmp_path))
+    storage.put_bytes("http://a/1", str(tmp_path / "a b.bin"), b"body")
+    write_with_writer(storage, "http://a/2", str(tmp_path / "sub" / "c.bin"), [b"chunk", b"ed"])
+    assert storage.read(str(tmp_path / "a b.bin")) == b"body"
+    assert storage.read(str(tmp_path / "sub" / "c.bin")) == b"chunked"
+    assert storage.exists(str(tmp_path / "a b.bin")) and not storage.exists(str(tmp_path / "d.bin"))
+    assert s3_server.objects[("bucket", "run/a b.bin")] == b"body"
+    forged = S3Storage(endpoint, "bucket", access_key="key", secret_key="wrong")
+    with pytest.raises(OSError):
+        forged.put_bytes("http://a/1", str(tmp_path / "a.bin"), b"body")
+
+
+@pytest.mark.parametrize("engine, stream", [(URLDownloader_v2, False), (URLDownloader_v2, True),
+                                            (AsyncURLDownloader, False), (AsyncURLDownloader, True)])
+def test_engines_save_through_the_storage(server, tmp_path, engine, stream):
+    urls = [server.url("/{}.bin".format(i), size=1000, seed=str(i)) for i in range(5)]
+    storage = TarShardStorage()
+    engine(urls, str(tmp_path), 2, verbose=False, stream=stream, storage=storage).download_all_sites()
+    assert sorted(read_log(str(tmp_path))) == sorted((url, "o") for url in urls)
+    assert [name for name in os.listdir(tmp_path / "data") if name.endswith(".bin")] == []
+    reloaded = TarShardStorage(str(tmp_path / "data"))
+    assert all(reloaded.read(str(tmp_path / "data" / "{}.bin".format(i))) == get_body(1000, str(i)) for i in range(5))
+
+
+@pytest.mark.parametrize("io_threads", [0, 2])
+def test_a_failed_save_is_an_error_and_not_cached(server, tmp_path, io_threads):
+    url = server.url("/a.bin", etag='"v1"')
+    downloader = URLDownloader_v2([url], str(tmp_path), verbose=False, http_cache=True, storage=FailingStorage(),
+                                  io_threads=io_threads)
+    downloader.download_all_sites()
+    assert read_log(str(tmp_path)) == [(url, "x")]
+    assert downloader.http_cache.get(url) is None
+
+
+def test_the_cache_records_a_save_of_the_io_pool_once_it_is_done(server, tmp_path):
+    url = server.url("/a.bin", size=1000, etag='"v1"')
+    downloader = URLDownloader_v2([url], str(tmp_path), verbose=False, http_cache=True, io_threads=2)
+    downloader.download_all_sites()
+    assert downloader.http_cache.get(url)[:3] == ('"v1"', None, 1000)
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(1000)
+
+
+@pytest.mark.parametrize("engine", [URLDownloader_v2, AsyncURLDownloader])
+def test_colliding_output_names_are_renamed(server, tmp_path, engine):
+    urls = [server.url("/a/img.jpg"), server.url("/b/img.jpg")]
+    downloader = engine(urls, str(tmp_path / "run1"), verbose=False)
+    names = [os.path.basename(path) for path in downloader.output_path_list]
+    assert names[0] == "img.jpg" and names[1] != names[0] and names[1].startswith("img.")
+    downloader.download_all_sites()
+    assert sorted(os.listdir(tmp_path / "run1" / "data")) == sorted(names)
+    # the names are stable across runs and shards
+    assert [os.path.basename(path) for path in engine(urls, str(tmp_path / "run2"), verbose=False).output_path_list] == names
+    shards = [engine(urls, str(tmp_path / "run3"), verbose=False, shard_index=i, shard_count=2) for i in range(2)]
+    assert sorted(os.path.basename(path) for shard in shards for path in shard.output_path_list) == sorted(names)
+
+
+def test_name_collision_overwrite_keeps_one_path(tmp_path):
+    urls = ["http://a/a/img.jpg", "http://a/b/img.jpg"]
+    downloader = URLDownloader_v2(urls, str(tmp_path), verbose=False, name_collision="overwrite")
+    assert len(set(downloader.output_path_list)) == 1
+
+
+def test_the_base_backend_is_an_interface():
+    with pytest.raises(NotImplementedError):
+        StorageBackend().put_bytes("http://a/1", "a.bin", b"")
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+import requests
+
+from conftest import get_body, read_log
+from url_downloader import DownloadSizeExceeded, URLDownloader_v2, iter_response_chunks, stream_to_file
+
+
+def test_stream_mode_saves_the_body(server, tmp_path):
+    url = server.url("/a.bin", size=10000)
+    URLDownloader_v2([url], str(tmp_path), 2, verbose=False, stream=True, chunk_size=1024).batch_download_sites()
+    assert (tmp_path / "data" / "a.bin").read_bytes() == get_body(10000)
+    assert os.listdir(tmp_path / "data") == ["a.bin"]
+    assert read_log(str(tmp_path)) == [(url, "o")]
+
+
+def test_stream_mode_drops_a_body_over_max_bytes_per_file(server, tmp_path):
+    small, large = server.url("/small.bin", size=100), server.url("/large.bin", size=5000)
+    URLDownloader_v2([small, large], str(tmp_path), 2, verbose=False, stream=True,
+                     max_bytes_per_file=1000).batch_download_sites()
+    assert os.listdir(tmp_path / "data") == ["small.bin"]
+    assert sorted(read_log(str(tmp_path))) == sorted([(small, "o"), (large, "x")])
+
+
+def test_custom_stream_saver_gets_the_chunks(server, tmp_path):
+    received = {}
+
+    def saver(outpath, chunks):
+        received[outpath] = b"".join(bytes(chunk) for chunk in chunks)
+
+    url = server.url("/a.bin", size=3000)
+    URLDownloader_v2([url], str(tmp_path), 1, verbose=False, stream=True, chunk_size=512,
+                     custom_stream_saver=saver).batch_download_sites()
+    assert received == {str(tmp_path / "data" / "a.bin"): get_body(3000)}
+
+
+def test_iter_response_chunks_stops_at_max_bytes(server):
+    with requests.get(server.url("/a.bin", size=5000), stream=True) as response:
+        chunks = iter_response_chunks(response, 1024, max_bytes=2000)
+        with pytest.raises(DownloadSizeExceeded):
+            for _ in chunks:
+                pass
+
+
+def test_stream_to_file_leaves_nothing_when_the_body_fails(tmp_path):
+    def chunks():
+        yield b"abc"
+        raise OSError("connection reset")
+
+    outpath = str(tmp_path / "a.bin")
+    with pytest.raises(OSError):
+        stream_to_file(chunks(), outpath)
+    assert os.listdir(tmp_path) == []
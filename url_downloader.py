@@ -1,15 +1,43 @@
+import asyncio
+import bisect
 import collections
 import concurrent.futures
+import contextlib
+import csv
+import email.utils
+import functools
+import hashlib
+import heapq
+import hmac
+import http.server
+import itertools
+import json
+import glob
 import logging
 import mimetypes
+import multiprocessing
 import os
+import queue
+import random
+import shutil
+import struct
 import sys
+import tarfile
+import tempfile
 import threading
 import time
-from urllib.parse import urljoin, urlparse
-from typing import List, Set, Dict, Tuple, Optional, Callable
+from array import array
+from urllib.parse import quote, urljoin, urlparse
+from typing import List, Set, Dict, Tuple, Optional, Callable, Iterator, Iterable, Union
 
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 thread_local = threading.local()
 
@@ -17,6 +45,12 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+class DownloadSizeExceeded(Exception):
+    """
+    Raised when a streamed response body grows beyond the allowed number of bytes.
+    """
+
+
 def remove_query_from_url(url):
     """ 
     This function remove the query term in the url.
@@ -30,19 +64,18 @@ def remove_query_from_url(url):
     return urljoin(url, urlparse(url).path) 
 
 
-def is_url_image(url):  
-    """ 
-    This function detects if the given url is an image.
-    
-    Parameters: 
+def guess_url_mimetype(url: str) -> Optional[str]:
+    """
+    This function guesses the mimetype of an url from the extension of its path, the query is ignored.
+
+    Parameters:
         url (string)
 
-    Returns: 
-        whether it is an image url or not(boolean)
+    Returns:
+        the mimetype (string), None if the extension is unknown or missing
     """
-    url = remove_query_from_url(url)  
-    mimetype, _ = mimetypes.guess_type(url)
-    return (mimetype and mimetype.startswith("image"))
+    mimetype, _ = mimetypes.guess_type(remove_query_from_url(url))
+    return mimetype
 
 
 def get_session():
@@ -60,245 +93,3813 @@ def get_session():
     return thread_local.session
 
 
-def get_thread_local_err_cntr():
-    if not hasattr(thread_local, "err_cntr"):
-        thread_local.err_cntr = 0
-    return thread_local.err_cntr
+def get_host(url):
+    """
+    This function returns the host of an url, which is the key of connection pools and per-host limits.
 
+    Parameters:
+        url (string)
 
-def increment_thread_local_err_cntr():
-    if not hasattr(thread_local, "err_cntr"):
-        thread_local.err_cntr = 0
-    thread_local.err_cntr += 1
+    Returns:
+        the host with its port (string)
+    """
+    return split_url(url)[0]
 
 
-def set_to_zero_thread_local_err_cntr():
-    thread_local.err_cntr = 0
+def split_url(url: str) -> Tuple[str, str]:
+    """
+    This function returns the netloc and the path of an url, like urlparse but without building a ParseResult,
+    since it runs for every url on the dispatch path.
 
+    Parameters:
+        url (string)
 
-class URLDownloader_v1:
-    """ 
-    This is a class for downloading a batch of urls via http connection.
-      
-    Attributes: 
-        url_list (list): a list of url to download.
-        out_path (string): the path to the output folder /
-        outpath_list (list): appending the outname with outpath.
-        num_thread (int): the number of thread used for download.
-        err_tolerance_num (int): the number of error tolerance for downloading.
-        stop_interval (int): the secs to stop after error number exceeds the  err_tolerance_num
-        time_out_for_GET (int): the time limit for http GET
-        http_headers (dict): the header for http.
-        outname_list (list): the list for the output file name. The default behaviour is using the file name in the url. If this is specified, it will overwrite the default name.
-        err_cnter (int): counter for counting consecutive errors.
-        log_file (string): a file name for logging, saving inside the out_path.
-        _errs_cnter_lock (RLock): avoid race condition. this lock is for err_cnter
-        __log_lock (Lock): avoid race condition. this lock is for log_file
+    Returns:
+        the netloc (string) and the path (string)
     """
-    def __init__(self, url_list,
-                 out_path,
-                 num_thread=4,
-                 err_tolerance_num=1000,
-                 stop_interval=0,
-                 time_out_for_GET=600,
-                 http_headers={},
-                 remove_dup_img=False,
-                 outname_list=None,
-                 verbose=True
-                 ):
-        """ 
-        The constructor for URLDownloader Class. It saves the parameters as attributes, set some attributes, and call update_downloading_status
-        
-        Parameters: 
-            url_list (list): a list of url to download.
-            out_path (string): the path to the output folder 
-            num_thread (int): the number of thread used for download.
-            err_tolerance_num (int): the number of error tolerance for downloading.
-            stop_interval (int): the secs to stop after error number exceeds the  err_tolerance_num
-            time_out_for_GET (int): the time limit for http GET
-            http_headers (dict): the header for http.
-            remove_dup_img (boolean): whether to remove the same image with different urls.
-            outname_list (list): the list for the output file name. The default behaviour is using the file name in the url. If this is specified, it will overwrite the default name.
-                    
-        Returns: 
-            The URLDownloader object
-        """
-        self.out_path = out_path
-        if outname_list:
-            assert(len(url_list) == len(outname_list))
-            url2oname = {url: oname for url, oname in zip(url_list, outname_list)}
-            url_list = [k for k in url2oname.keys()]
-            outname_list = [v for v in url2oname.values()]
-        else:
-            url_list = list(set(url_list))
-        if outname_list:
-            self.outpath_list = [os.path.join(out_path, name) for name in outname_list]
-        else:
-            self.outpath_list = [self.get_outpath_from_url(i) for i in url_list]
-        self.url_list = url_list
-        self.num_thread = num_thread
-        self.err_tolerance_num = err_tolerance_num
-        self.stop_interval = stop_interval
-        self.time_out_for_GET = time_out_for_GET
-        self.http_headers = http_headers
-        self.verbose = verbose
+    start = url.find("://")
+    if start < 0:
+        parsing = urlparse(url)
+        return parsing.netloc, parsing.path
+    start += 3
+    end = len(url)
+    for sep in "?#":
+        i = url.find(sep, start)
+        if 0 <= i < end:
+            end = i
+    slash = url.find("/", start, end)
+    if slash < 0:
+        return url[start:end], ""
+    return url[start:slash], url[slash:end]
 
-        self.err_cnter = 0
-        self.url_cnter = 0
-        self.log_file = os.path.join(out_path, 'downloaded.log')
-        self._errs_cnter_lock = threading.Lock()
-        self._log_lock = threading.Lock()
-        # self._check_url_lock = threading.Lock()
-        if not os.path.exists(out_path): 
-            print('output folder is not exist, create "{}" folder'.format(out_path))
-            os.makedirs(out_path)
-        if not os.path.exists(self.log_file): 
-            f = open(self.log_file, 'w')
-            f.close()
-        #self.adapter = HTTPAdapter(max_retries=3)
-        #self.check_urls()
-        self.update_downloading_status()
 
-    def update_downloading_status(self):
-        """ 
-        The function to update the url_list, outpaht_list, and img_hash_set, based on the log in the folder.
-        This is useful when you already have some urls downloaded in the output folder.
-        This function depnds on the log file in the output folder.
+class ConnectionPoolStats:
+    """
+    This is a class for counting how connection pools are used, per host and in total.
 
-        Parameters: 
-            None  
+    Attributes:
+        per_host (dict): host -> Counter with the keys pool_lookups, pool_misses, requests and connections.
+    """
+    def __init__(self):
+        self.per_host = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
 
-        Returns: 
-            None
+    def record(self, host: str, key: str):
+        with self._lock:
+            self.per_host[host][key] += 1
+
+    def snapshot(self) -> Dict:
         """
-        tmp = []
-        with open(self.log_file, 'r') as f:
-            downloaded_url = collections.Counter([line.split('\t')[0] for line in f])
-        for url, outpath in zip(self.url_list, self.outpath_list):
-            if url in downloaded_url:
-                downloaded_url[url] -= 1
-                if downloaded_url[url] == 0:
-                    downloaded_url.pop(url)
-            else:
-                tmp.append((url, outpath))
-        # random.shuffle(tmp)
-        self.url_list = [i[0] for i in tmp]
-        self.outpath_list = [i[1] for i in tmp]
+        This function returns the counters.
+        pool_hits are lookups that found an existing pool of the host, connection_reuses are
+        requests sent on an already connected socket (no new TCP/TLS handshake).
 
-    def get_num_urls_needed(self):
-        """ 
-        This function returns the number of urls needs to download to the output folder.
-        
-        Parameters: 
-            None  
+        Parameters:
+            None
 
-        Returns: 
-            len(self.url_list) (int)
+        Returns:
+            the total counters and the per-host counters (dict)
         """
-        self.update_downloading_status()
-        return len(self.url_list)
+        with self._lock:
+            per_host = {}
+            for host, cntr in self.per_host.items():
+                per_host[host] = {
+                    "pool_hits": cntr["pool_lookups"] - cntr["pool_misses"],
+                    "pool_misses": cntr["pool_misses"],
+                    "requests": cntr["requests"],
+                    "connections": cntr["connections"],
+                    "connection_reuses": max(cntr["requests"] - cntr["connections"], 0),
+                }
+        total = collections.Counter()
+        for stats in per_host.values():
+            total.update(stats)
+        return {"total": dict(total), "per_host": per_host}
 
-    def get_outpath_from_url(self, url):
-        """ 
-        This function generate output path for an url, based on the filename in an url.
-        
-        Parameters: 
-            url (string)  
 
-        Returns: 
-            outpath (string): output path for the given url
-        """
-        parsing = urlparse(url)
-        if os.path.basename(parsing.path):
-            fname = os.path.basename(parsing.path)
-        else:
-            fname = parsing.netloc
-        outpath = os.path.join(self.out_path, fname)
-        return outpath
+class _CountingConnectionMixin:
+    pool_stats = None
 
-    def download_site(self, url, outpath):
+    def connect(self):
+        start = time.perf_counter()
+        super().connect()
+        # DNS, TCP and TLS time of the request running on this thread, read by URLDownloader_v2.fetch
+        thread_local.connect_time = getattr(thread_local, "connect_time", 0.0) + time.perf_counter() - start
+        if self.pool_stats is not None:
+            self.pool_stats.record(self.host, "connections")
+
+
+class _CountingHTTPConnection(_CountingConnectionMixin, urllib3.connection.HTTPConnection):
+    pass
+
+
+class _CountingHTTPSConnection(_CountingConnectionMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+
+class _CountingPoolMixin:
+    pool_stats = None
+
+    def _new_conn(self):
+        conn = super()._new_conn()
+        conn.pool_stats = self.pool_stats
+        return conn
+
+    def urlopen(self, method, url, *args, **kwargs):
+        if self.pool_stats is not None:
+            self.pool_stats.record(self.host, "requests")
+        return super().urlopen(method, url, *args, **kwargs)
+
+
+class _CountingHTTPConnectionPool(_CountingPoolMixin, urllib3.HTTPConnectionPool):
+    ConnectionCls = _CountingHTTPConnection
+
+
+class _CountingHTTPSConnectionPool(_CountingPoolMixin, urllib3.HTTPSConnectionPool):
+    ConnectionCls = _CountingHTTPSConnection
+
+
+class _CountingPoolManager(urllib3.PoolManager):
+    def __init__(self, *args, pool_stats: ConnectionPoolStats, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_stats = pool_stats
+        self.pool_classes_by_scheme = {"http": _CountingHTTPConnectionPool, "https": _CountingHTTPSConnectionPool}
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.pool_stats = self.pool_stats
+        self.pool_stats.record(host, "pool_misses")
+        return pool
+
+    def connection_from_pool_key(self, pool_key, request_context):
+        self.pool_stats.record(pool_key.key_host, "pool_lookups")
+        return super().connection_from_pool_key(pool_key, request_context)
+
+
+class HostPoolAdapter(HTTPAdapter):
+    """
+    This is a transport adapter that keeps one connection pool per host and counts its usage in pool_stats.
+
+    Attributes:
+        pool_stats (ConnectionPoolStats): the usage counters of the pools.
+    """
+    def __init__(self, pool_stats: ConnectionPoolStats, **kwargs):
+        self.pool_stats = pool_stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = _CountingPoolManager(num_pools=connections, maxsize=maxsize, block=block,
+                                                pool_stats=self.pool_stats, **pool_kwargs)
+
+
+def create_shared_session(http_headers: Dict,
+                          pool_stats: ConnectionPoolStats,
+                          pool_num_hosts: int=64,
+                          pool_maxsize_per_host: int=16,
+                          max_connections_per_host: Optional[int]=None,
+                          keep_alive: bool=True) -> requests.Session:
+    """
+    This function creates a session that all download threads share, so connections to one host are reused across threads.
+
+    Parameters:
+        http_headers (dict): the header for http.
+        pool_stats (ConnectionPoolStats): the usage counters of the pools.
+        pool_num_hosts (int): the number of host pools to keep.
+        pool_maxsize_per_host (int): the number of idle connections to keep per host.
+        max_connections_per_host (int): the hard limit of open connections per host, requests wait for a free connection. None means no limit.
+        keep_alive (boolean): whether to keep connections open between requests.
+
+    Returns:
+        the session (requests.Session)
+    """
+    session = requests.Session()
+    session.headers.update(http_headers)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    if max_connections_per_host is not None:
+        pool_maxsize_per_host = max_connections_per_host
+    adapter = HostPoolAdapter(pool_stats,
+                              pool_connections=pool_num_hosts,
+                              pool_maxsize=pool_maxsize_per_host,
+                              pool_block=max_connections_per_host is not None)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class HostConcurrencyLimiter:
+    """
+    This is a class for limiting the number of downloads in flight per host.
+
+    Attributes:
+        max_per_host (int): the max number of downloads in flight per host. None means no limit.
+        in_flight (Counter): the number of downloads in flight of each host.
+    """
+    def __init__(self, max_per_host: Optional[int]=None):
+        self.max_per_host = max_per_host
+        self.in_flight = collections.Counter()
+        self._lock = threading.Lock()
+
+    def has_capacity(self) -> bool:
         """
-        This function download an url and save its content to the outpath.
+        This function tells whether any download can start now, whatever its host.
 
         Parameters:
-            url (string): the url to downalod.
-            outpath (string): the output path to save the content.
+            None
 
         Returns:
-            None
+            boolean
         """
-        session = get_session()
-        session.headers.update(self.http_headers)
-        #session.mount(url, self.adapter) #for retry
-        #print('url: {}, outpath: {}'.format(url, outpath))
-        with session.get(url, timeout=self.time_out_for_GET) as response:
-            if response:
-                if self.verbose:
-                    print('o', end='', file=sys.stderr, flush=True)
-                self.url_cnter += 1
-                if self.url_cnter % 1000 == 0 and self.verbose:
-                    print('# processed url: {}...'.format(self.url_cnter), end='', file=sys.stderr, flush=True)
-                #print(f"Read {len(response.content)} from {url}")
-                with open(outpath, 'wb') as f:
-                    f.write(response.content)
-                with self._log_lock:
-                    with open(self.log_file, 'a') as f:
-                        f.write('{}\t{}\n'.format(url, 'o'))
-                with self._errs_cnter_lock:
-                    self.err_cnter = 0
-            else:
-                print('x', end='', file=sys.stderr, flush=True)
-                self.url_cnter += 1
-                if self.url_cnter % 1000 == 0:
-                    print('# processed url: {}...'.format(self.url_cnter), end='', file=sys.stderr, flush=True)
-                with self._errs_cnter_lock:
-                    if self.err_cnter >= self.err_tolerance_num:
-                        time.sleep(self.stop_interval)
-                        self.err_cnter = 0
-                        print('last error code is {}, error url: {}'.format(response.status_code, url), file=sys.stderr, flush=True)
-                    else:
-                        self.err_cnter += 1
-                with self._log_lock:
-                    with open(self.log_file, 'a') as f:
-                        f.write('{}\t{}\n'.format(url, 'x'))
+        return True
 
-    def download_all_sites(self):
-        """ 
-        This function calls [self.num_thread] threads to download urls.
-        Its a multithread version of download_site
-        
-        Parameters: 
-            None
-        Returns: 
-            None
+    def try_acquire(self, host: str) -> bool:
         """
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_thread) as executor:
-            executor.map(self.download_site, self.url_list, self.outpath_list)
+        This function takes a slot of the host if one is free.
 
-    def batch_download_sites(self, num):
-        """ 
-        This function calls [self.num_thread] threads to download urls.
-        Its a multithread version of download_site
-        
-        Parameters: 
-            None
-        Returns: 
-            None
+        Parameters:
+            host (string)
+
+        Returns:
+            whether a slot is taken (boolean)
         """
-        print('# files to download: {}'.format(len( self.url_list[:num])))
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_thread) as executor:
-            executor.map(self.download_site, self.url_list[:num], self.outpath_list[:num])
-        self.update_downloading_status()
+        with self._lock:
+            if self.max_per_host is not None and self.in_flight[host] >= self.max_per_host:
+                return False
+            self.in_flight[host] += 1
+            return True
 
+    def release(self, host: str):
+        with self._lock:
+            self.in_flight[host] -= 1
+            if self.in_flight[host] <= 0:
+                del self.in_flight[host]
 
-class URLDownloader_v2:
-    """ 
-    This is a class for downloading a batch of urls via http connection.
-      
-    Attributes: 
-        url_list (list): a list of url to download.
+
+class _AIMDState:
+    """
+    The window of observations and the limit of one AdaptiveConcurrencyLimiter key, the whole downloader or a host.
+    """
+    __slots__ = ("limit", "slow_start", "min_latency", "window_start", "samples", "throttled", "latency_sum", "peak_in_flight")
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.slow_start = True
+        self.min_latency = None
+        self.window_start = time.monotonic()
+        self.samples = 0
+        self.throttled = 0
+        self.latency_sum = 0.0
+        self.peak_in_flight = 0
+
+
+class AdaptiveConcurrencyLimiter(HostConcurrencyLimiter):
+    """
+    This is a class for tuning the number of downloads in flight at runtime, see URLDownloader_v2(adaptive_concurrency=True).
+    It is fed by every attempt (observe is a DownloadMetrics hook) and adjusts the limit once per [interval] secs:
+        - throttled attempts (429, 503 or no response) above [max_throttle_rate]: limit *= [decrease_factor]
+        - otherwise the limit follows the latency gradient,
+          limit = limit * min(1, [latency_tolerance] * min_latency / latency) + increase,
+          where increase doubles the limit until the first decrease (slow start) and is 1 after it.
+    The limit only grows while it is used, so a slow input does not inflate it.
+    With per_host, every host also gets its own limit driven by the attempts of the host,
+    and throttling only lowers the limit of the host.
+
+    Attributes:
+        limit (float): the current limit of downloads in flight of the downloader.
+        min_limit (int): the lower bound of every limit.
+        max_limit (int): the upper bound of every limit, the number of workers.
+        per_host (boolean): whether every host gets its own limit.
+        history (list): (secs since start, limit) after every adjustment.
+    """
+    THROTTLE_STATUSES = (429, 503, None)
+
+    def __init__(self,
+                 min_limit: int=1,
+                 max_limit: int=64,
+                 initial_limit: Optional[int]=None,
+                 per_host: bool=False,
+                 max_per_host: Optional[int]=None,
+                 interval: float=0.25,
+                 decrease_factor: float=0.7,
+                 latency_tolerance: float=2.0,
+                 max_throttle_rate: float=0.01):
+        super().__init__(max_per_host)
+        assert 1 <= min_limit <= max_limit, "min_limit should be in [1, max_limit]"
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.initial_limit = max(min_limit, min(initial_limit or min_limit, max_limit))
+        self.per_host = per_host
+        self.interval = interval
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.max_throttle_rate = max_throttle_rate
+        self.total_in_flight = 0
+        self.history = []
+        self._state = _AIMDState(self.initial_limit)
+        self._host_states = {}
+        self._start = time.monotonic()
+
+    @property
+    def limit(self) -> float:
+        return self._state.limit
+
+    def get_host_limit(self, host: str) -> Optional[float]:
+        state = self._host_states.get(host)
+        return state.limit if state is not None else None
+
+    def has_capacity(self) -> bool:
+        return self.total_in_flight < int(self._state.limit)
+
+    def try_acquire(self, host: str) -> bool:
+        with self._lock:
+            if self.total_in_flight >= int(self._state.limit):
+                return False
+            if self.max_per_host is not None and self.in_flight[host] >= self.max_per_host:
+                return False
+            if self.per_host:
+                host_state = self._host_states.get(host)
+                if host_state is None:
+                    host_state = self._host_states[host] = _AIMDState(self.initial_limit)
+                if self.in_flight[host] >= int(host_state.limit):
+                    return False
+                host_state.peak_in_flight = max(host_state.peak_in_flight, self.in_flight[host] + 1)
+            self.in_flight[host] += 1
+            self.total_in_flight += 1
+            self._state.peak_in_flight = max(self._state.peak_in_flight, self.total_in_flight)
+            return True
+
+    def release(self, host: str):
+        with self._lock:
+            self.total_in_flight -= 1
+            self.in_flight[host] -= 1
+            if self.in_flight[host] <= 0:
+                del self.in_flight[host]
+
+    def observe(self, event: Dict):
+        """
+        This function records one attempt, a DownloadMetrics hook.
+
+        Parameters:
+            event (dict): the attempt, with the keys host, status and total_s.
+
+        Returns:
+            None
+        """
+        now = time.monotonic()
+        throttled = event["status"] in self.THROTTLE_STATUSES
+        with self._lock:
+            states = [(self._state, self.total_in_flight)]
+            if self.per_host and event["host"] in self._host_states:
+                states.append((self._host_states[event["host"]], self.in_flight[event["host"]]))
+            for state, in_flight in states:
+                if throttled and self.per_host and state is self._state:
+                    # a throttling host only lowers its own limit, the other hosts keep the downloader limit
+                    continue
+                state.samples += 1
+                if throttled:
+                    state.throttled += 1
+                else:
+                    state.latency_sum += event["total_s"]
+                if now - state.window_start >= self.interval:
+                    self._adjust(state, now, in_flight)
+            if self._state.window_start == now:
+                self.history.append((round(now - self._start, 3), round(self._state.limit, 2)))
+
+    def _adjust(self, state: _AIMDState, now: float, in_flight: int):
+        num_ok = state.samples - state.throttled
+        if state.throttled > self.max_throttle_rate * state.samples:
+            state.limit *= self.decrease_factor
+            state.slow_start = False
+        elif num_ok:
+            latency = state.latency_sum / num_ok
+            if state.min_latency is None or latency < state.min_latency:
+                state.min_latency = latency
+            else:
+                # let the baseline follow a slower network instead of pinning the limit down forever
+                state.min_latency *= 1.01
+            gradient = min(1.0, self.latency_tolerance * state.min_latency / latency)
+            if gradient < 1.0:
+                state.slow_start = False
+            increase = 0
+            if state.peak_in_flight >= int(state.limit):
+                increase = state.limit if state.slow_start else 1
+            state.limit = state.limit * gradient + increase
+        state.limit = max(self.min_limit, min(state.limit, self.max_limit))
+        state.window_start = now
+        state.samples = state.throttled = 0
+        state.peak_in_flight = in_flight
+        state.latency_sum = 0.0
+
+
+def get_saved_size(response, outpath: Optional[str]=None) -> Optional[int]:
+    """
+    This function returns the size of a saved body, from Content-Length or else from the saved file.
+
+    Parameters:
+        response (requests.Response): the response of the body.
+        outpath (string): the output path of the body, None if it is not saved yet.
+
+    Returns:
+        the size (int), None if it is unknown
+    """
+    content_length = response.headers.get("Content-Length")
+    if content_length and content_length.isdigit():
+        return int(content_length)
+    if outpath is not None and os.path.exists(outpath):
+        return os.path.getsize(outpath)
+    return None
+
+
+def get_thread_local_err_cntr():
+    if not hasattr(thread_local, "err_cntr"):
+        thread_local.err_cntr = 0
+    return thread_local.err_cntr
+
+
+def increment_thread_local_err_cntr():
+    if not hasattr(thread_local, "err_cntr"):
+        thread_local.err_cntr = 0
+    thread_local.err_cntr += 1
+
+
+def set_to_zero_thread_local_err_cntr():
+    thread_local.err_cntr = 0
+
+
+def get_thread_local_buffer(size):
+    """
+    This function returns a reusable bytearray of [size] bytes for the current thread,
+    so streaming downloads do not allocate a new buffer for every chunk.
+
+    Parameters:
+        size (int): the size of the buffer in bytes.
+
+    Returns:
+        buffer (bytearray)
+    """
+    buffer = getattr(thread_local, "buffer", None)
+    if buffer is None or len(buffer) != size:
+        buffer = bytearray(size)
+        thread_local.buffer = buffer
+    return buffer
+
+
+def iter_response_chunks(response, chunk_size=1 << 16, max_bytes=None):
+    """
+    This function reads a streamed response body into the thread-local buffer and yields it chunk by chunk.
+    Each yielded memoryview is only valid until the next chunk is requested; copy it if you need to keep it.
+
+    Parameters:
+        response (requests.Response): a response opened with stream=True.
+        chunk_size (int): the size of the reusable buffer.
+        max_bytes (int): raise DownloadSizeExceeded once the body grows beyond this number of bytes. None means no limit.
+
+    Returns:
+        an iterator of memoryview chunks
+    """
+    view = memoryview(get_thread_local_buffer(chunk_size))
+    raw = response.raw
+    # requests asks urllib3 not to decode the body, iter_content does it per call; do the same for readinto
+    raw.decode_content = True
+    total = 0
+    while True:
+        num = raw.readinto(view)
+        if not num:
+            break
+        total += num
+        if max_bytes is not None and total > max_bytes:
+            raise DownloadSizeExceeded("body of {} is larger than {} bytes".format(response.url, max_bytes))
+        yield view[:num]
+
+
+def read_response_body(response, chunk_size=1 << 16, max_bytes=None) -> bytes:
+    """
+    This function reads the whole body of a response into memory.
+
+    Parameters:
+        response (requests.Response): the response, opened with stream=True if [max_bytes] is given.
+        chunk_size (int): the size of the reusable buffer.
+        max_bytes (int): raise DownloadSizeExceeded once the body grows beyond this number of bytes, before the rest is read.
+            None reads response.content.
+
+    Returns:
+        the body (bytes)
+    """
+    if max_bytes is None:
+        return response.content
+    body = bytearray()
+    for chunk in iter_response_chunks(response, chunk_size, max_bytes):
+        body += chunk
+    # kept as response.content, as requests does, so a custom saver can still read it once the response is closed
+    response._content = bytes(body)
+    response._content_consumed = True
+    return response._content
+
+
+def stream_to_file(chunks, outpath):
+    """
+    This function writes the chunks to [outpath].part and renames it to [outpath] once the body is complete,
+    so an interrupted download never leaves a truncated file under the final name.
+
+    Parameters:
+        chunks (iterator): an iterator of bytes-like chunks.
+        outpath (string): the output path to save the content.
+
+    Returns:
+        the number of bytes written (int)
+    """
+    part_path = outpath + ".part"
+    total = 0
+    try:
+        with open(part_path, "wb") as f:
+            for chunk in chunks:
+                total += f.write(chunk)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    os.replace(part_path, outpath)
+    return total
+
+
+def parse_content_range(value: Optional[str]) -> Optional[Tuple[int, int, Optional[int]]]:
+    """
+    This function parses a Content-Range header like "bytes 0-1023/4096".
+
+    Parameters:
+        value (string): the header value.
+
+    Returns:
+        the first byte, the last byte (inclusive) and the total size (None for "*"), None if the header is not a byte range
+    """
+    if not value or not value.startswith("bytes "):
+        return None
+    byte_range, _, total = value[6:].partition("/")
+    start, _, end = byte_range.partition("-")
+    if not (start.isdigit() and end.isdigit()):
+        return None
+    return int(start), int(end), int(total) if total.isdigit() else None
+
+
+def write_chunks_at(chunks, path: str, offset: int, truncate: bool=False) -> int:
+    """
+    This function writes the chunks into a file starting at [offset], without touching the bytes before it.
+    The file is created if it does not exist.
+
+    Parameters:
+        chunks (iterator): an iterator of bytes-like chunks.
+        path (string): the path to the file.
+        offset (int): the position of the first chunk.
+        truncate (boolean): whether to cut the file after the last chunk.
+
+    Returns:
+        the number of bytes written (int)
+    """
+    total = 0
+    with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+        f.seek(offset)
+        for chunk in chunks:
+            total += f.write(chunk)
+        if truncate:
+            f.truncate()
+    return total
+
+
+class PartialDownload:
+    """
+    This is a class for the state of an interrupted download, so it can continue with Range requests.
+    The body is written to [outpath].part and the state is saved next to it as [outpath].part.meta,
+    one JSON object {"url", "etag", "last_modified", "total", "segment_size", "done"}.
+    A sequential download continues from the size of the part file; a segmented download keeps the part file at its
+    full size and records the finished segments in done. The validator is sent as If-Range, so a body that changed
+    on the server is downloaded again from scratch.
+
+    Attributes:
+        url (string): the url of the body.
+        outpath (string): the final output path.
+        part_path (string): the path to the part file.
+        meta_path (string): the path to the state file.
+        etag (string): the ETag of the body, None if the server sent none.
+        last_modified (string): the Last-Modified of the body, None if the server sent none.
+        total (int): the size of the body, None if it is unknown.
+        segment_size (int): the size of a segment in segmented mode, None for a sequential download.
+        done (set): the indexes of the finished segments.
+        invalid (boolean): whether the server answered a range request with a different body.
+    """
+    def __init__(self, url: str, outpath: str, etag: Optional[str]=None, last_modified: Optional[str]=None,
+                 total: Optional[int]=None, segment_size: Optional[int]=None, done: Iterable[int]=()):
+        self.url = url
+        self.outpath = outpath
+        self.part_path = outpath + ".part"
+        self.meta_path = outpath + ".part.meta"
+        self.etag = etag
+        self.last_modified = last_modified
+        self.total = total
+        self.segment_size = segment_size
+        self.done = set(done)
+        self.invalid = False
+        self._pending = 0
+        self._failed_status = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, url: str, outpath: str) -> Optional["PartialDownload"]:
+        """
+        This function loads the state of an interrupted download of the url, and removes the files of a stale one.
+
+        Parameters:
+            url (string): the url to download.
+            outpath (string): the output path of the url.
+
+        Returns:
+            the state (PartialDownload), None if there is nothing to continue
+        """
+        partial = cls(url, outpath)
+        if not os.path.exists(partial.meta_path):
+            return None
+        try:
+            with open(partial.meta_path, "r") as f:
+                meta = json.load(f)
+        except ValueError:
+            meta = {}
+        if meta.get("url") != url or not os.path.exists(partial.part_path) \
+                or cls.get_validator(meta.get("etag"), meta.get("last_modified")) is None:
+            partial.discard()
+            return None
+        return cls(url, outpath, meta.get("etag"), meta.get("last_modified"), meta.get("total"),
+                   meta.get("segment_size"), meta.get("done", ()))
+
+    @staticmethod
+    def get_validator(etag: Optional[str], last_modified: Optional[str]) -> Optional[str]:
+        # If-Range only takes a strong ETag or a date
+        if etag and not etag.startswith("W/"):
+            return etag
+        return last_modified
+
+    @property
+    def validator(self) -> Optional[str]:
+        return self.get_validator(self.etag, self.last_modified)
+
+    @property
+    def num_segments(self) -> int:
+        return -(-self.total // self.segment_size)
+
+    def segment_range(self, index: int) -> Tuple[int, int]:
+        """
+        This function returns the first and the last byte (inclusive) of a segment.
+
+        Parameters:
+            index (int): the index of the segment.
+
+        Returns:
+            the first byte (int) and the last byte (int)
+        """
+        start = index * self.segment_size
+        return start, min(start + self.segment_size, self.total) - 1
+
+    def missing_segments(self) -> List[int]:
+        return [i for i in range(self.num_segments) if i not in self.done]
+
+    def save(self):
+        """
+        This function writes the state to a temp file and renames it over the state file.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        # the workers of the segments save in turn, they share the temp file
+        with self._lock:
+            meta = {"url": self.url, "etag": self.etag, "last_modified": self.last_modified, "total": self.total,
+                    "segment_size": self.segment_size, "done": sorted(self.done)}
+            tmp_path = self.meta_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_path, self.meta_path)
+
+    def mark_done(self, index: int):
+        with self._lock:
+            self.done.add(index)
+        self.save()
+
+    def begin_segments(self, num_segments: int):
+        self._pending = num_segments
+
+    def resolve_segment(self, ok: bool, status_code: Optional[int]=None) -> Optional[bool]:
+        """
+        This function counts a segment that will not be tried again, in the pipeline that downloads the segments.
+
+        Parameters:
+            ok (boolean): whether the segment is downloaded.
+            status_code (int): the status code of the last attempt of the segment.
+
+        Returns:
+            None while other segments are pending, then whether every segment is downloaded (boolean)
+        """
+        with self._lock:
+            if not ok:
+                self._failed_status = status_code
+            self._pending -= 1
+            if self._pending:
+                return None
+            return len(self.done) == self.num_segments
+
+    @property
+    def failed_status(self) -> Optional[int]:
+        return self._failed_status
+
+    def finish(self):
+        """
+        This function moves the complete part file to the output path and removes the state file.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        os.replace(self.part_path, self.outpath)
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+
+    def discard(self):
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def url_fingerprint(url: str) -> int:
+    """
+    This function hashes an url to a non-zero 64-bit fingerprint.
+
+    Parameters:
+        url (string)
+
+    Returns:
+        the fingerprint (int)
+    """
+    fp = int.from_bytes(hashlib.blake2b(url.encode("utf-8"), digest_size=8).digest(), "little")
+    return fp or 1
+
+
+class FingerprintTable:
+    """
+    This is a class for mapping 64-bit fingerprints to small counters, stored in two flat arrays with linear probing.
+    It takes about 18 bytes per entry instead of the ~100+ bytes of a Python set or dict of url strings.
+
+    Attributes:
+        None
+    """
+    def __init__(self, capacity: int=1024):
+        size = 1 << max(10, (capacity * 3 // 2).bit_length())
+        self._keys = array("Q", bytes(8 * size))
+        self._values = array("I", bytes(4 * size))
+        self._mask = size - 1
+        self._len = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __contains__(self, fp: int) -> bool:
+        return self._keys[self._slot(fp)] != 0
+
+    def _slot(self, fp: int) -> int:
+        keys = self._keys
+        mask = self._mask
+        i = fp & mask
+        while True:
+            key = keys[i]
+            if key == fp or key == 0:
+                return i
+            i = (i + 1) & mask
+
+    def get(self, fp: int, default: Optional[int]=None) -> Optional[int]:
+        i = self._slot(fp)
+        return self._values[i] if self._keys[i] else default
+
+    def set(self, fp: int, value: int):
+        i = self._slot(fp)
+        self._values[i] = value
+        if not self._keys[i]:
+            self._keys[i] = fp
+            self._len += 1
+            if self._len * 3 > len(self._keys) * 2:
+                self._grow()
+
+    def add(self, fp: int) -> bool:
+        """
+        This function adds a fingerprint with the value 0 if it is not in the table yet.
+
+        Parameters:
+            fp (int): the fingerprint.
+
+        Returns:
+            whether the fingerprint is new (boolean)
+        """
+        if fp in self:
+            return False
+        self.set(fp, 0)
+        return True
+
+    def items(self) -> Iterator[Tuple[int, int]]:
+        for key, value in zip(self._keys, self._values):
+            if key:
+                yield key, value
+
+    def _grow(self):
+        old_keys = self._keys
+        old_values = self._values
+        size = len(old_keys) * 2
+        self._keys = array("Q", bytes(8 * size))
+        self._values = array("I", bytes(4 * size))
+        self._mask = size - 1
+        # re-insert straight from the old arrays, a list of the items would cost ~100 bytes per entry at the peak
+        for key, value in zip(old_keys, old_values):
+            if key:
+                i = self._slot(key)
+                self._keys[i] = key
+                self._values[i] = value
+
+
+def get_shard_of_url(url: str, shard_count: int, fp: Optional[int]=None) -> int:
+    """
+    This function returns the shard of an url. It only depends on the url, so every process and every node
+    that reads the same manifest agrees on it.
+
+    Parameters:
+        url (string)
+        shard_count (int): the number of shards.
+        fp (int): the fingerprint of the url if the caller already has it.
+
+    Returns:
+        the shard index (int), in [0, shard_count)
+    """
+    if fp is None:
+        fp = url_fingerprint(url)
+    # the high bits pick the shard, the low bits stay uniform for the FingerprintTable slots of the shard
+    return (fp >> 32) % shard_count
+
+
+def get_shard_suffix(shard_index: int, shard_count: int) -> str:
+    return ".shard-{:05d}-of-{:05d}".format(shard_index, shard_count)
+
+
+def iter_manifest(path: str) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    This function reads a url manifest lazily, one line at a time.
+    The format is picked by the file extension:
+        .jsonl/.ndjson: one object per line with a "url" and an optional "output_name".
+        .csv/.tsv: the url in the first column and an optional output name in the second, a header row starting with "url" is skipped.
+        otherwise: one url per line, blank lines and lines starting with "#" are skipped.
+
+    Parameters:
+        path (string): the path to the manifest.
+
+    Returns:
+        an iterator of (url, output_name), output_name is None when the manifest does not give one
+    """
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, "r", newline="") as f:
+        if ext in (".jsonl", ".ndjson"):
+            for line in f:
+                if line.strip():
+                    item = json.loads(line)
+                    yield item["url"], item.get("output_name")
+        elif ext in (".csv", ".tsv"):
+            for row in csv.reader(f, delimiter="\t" if ext == ".tsv" else ","):
+                if not row or not row[0] or row[0].strip().lower() == "url":
+                    continue
+                yield row[0].strip(), (row[1].strip() or None) if len(row) > 1 else None
+        else:
+            for line in f:
+                url = line.strip()
+                if url and not url.startswith("#"):
+                    yield url, None
+
+
+LOG_FORMATS = ("text", "binary")
+LOG_FSYNC_POLICIES = ("none", "log", "data")
+# the first bytes of a binary log; a text log starts with an url, so the formats cannot be confused
+BINARY_LOG_MAGIC = b"\x00UDLOG1\n"
+# a binary log record: url length, url fingerprint, status ("o" or "x"), then the utf-8 url
+_BINARY_LOG_RECORD = struct.Struct("<IQc")
+
+
+def fsync_file(path: str):
+    """
+    This function flushes a file and the directory entry that points to it to disk, so both survive a power loss.
+
+    Parameters:
+        path (string): the path to the file.
+
+    Returns:
+        None
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def get_file_sha256(path: str, chunk_size: int=1 << 20) -> Tuple[str, int]:
+    """
+    This function hashes a file without reading it into memory at once.
+
+    Parameters:
+        path (string): the path to the file.
+        chunk_size (int): the size of every read.
+
+    Returns:
+        the sha256 hex digest (string) and the size (int) of the file
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha256.update(chunk)
+            size += len(chunk)
+    return sha256.hexdigest(), size
+
+
+def get_log_format(path: str) -> Optional[str]:
+    """
+    This function detects the format of a log file from its first bytes.
+
+    Parameters:
+        path (string): the path to the log file.
+
+    Returns:
+        "text" or "binary", None if the file is missing or empty
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(len(BINARY_LOG_MAGIC))
+    except FileNotFoundError:
+        return None
+    if not head:
+        return None
+    return "binary" if BINARY_LOG_MAGIC.startswith(head) else "text"
+
+
+def encode_log_entries(entries: List[Tuple[str, bool]], log_format: str, fps: Optional[List[int]]=None) -> bytes:
+    """
+    This function encodes log entries in the text ("url\tstatus\n") or the binary log format.
+
+    Parameters:
+        entries (list): (url, failed) of every entry.
+        log_format (string): "text" or "binary".
+        fps (list): the fingerprints of the urls if the caller already has them, only used by the binary format.
+
+    Returns:
+        the encoded entries (bytes)
+    """
+    if log_format == "text":
+        return "".join(["{}\t{}\n".format(url, "x" if failed else "o") for url, failed in entries]).encode("utf-8")
+    if fps is None:
+        fps = [url_fingerprint(url) for url, _ in entries]
+    parts = []
+    pack = _BINARY_LOG_RECORD.pack
+    for (url, failed), fp in zip(entries, fps):
+        url_bytes = url.encode("utf-8")
+        parts.append(pack(len(url_bytes), fp, b"x" if failed else b"o"))
+        parts.append(url_bytes)
+    return b"".join(parts)
+
+
+class LogReader:
+    """
+    This is a class for reading the entries of a log file in the text or the binary format.
+    A record that is cut off at the end of the file, left by a crash in the middle of a write, is not read;
+    valid_size tells where the complete records end, so the caller can cut the rest off before appending.
+
+    Attributes:
+        path (string): the path to the log file.
+        log_format (string): the detected format, None for a missing or empty file.
+        valid_size (int): the number of bytes of the complete records read so far.
+        read_urls (boolean): whether to decode the urls of a binary log, a reader that only needs the fingerprints skips it.
+    """
+    def __init__(self, path: str, read_size: int=1 << 20, read_urls: bool=True):
+        self.path = path
+        self.log_format = get_log_format(path)
+        self.read_size = read_size
+        self.read_urls = read_urls
+        self.valid_size = 0
+
+    def __iter__(self) -> Iterator[Tuple[str, bool, int]]:
+        """
+        This function reads the log entries in file order.
+
+        Parameters:
+            None
+
+        Returns:
+            an iterator of (url, failed, url fingerprint), the url is None for a binary log if read_urls is False
+        """
+        if self.log_format == "text":
+            return self._iter_text()
+        if self.log_format == "binary":
+            return self._iter_binary()
+        return iter(())
+
+    def _iter_text(self) -> Iterator[Tuple[str, bool, int]]:
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return
+                self.valid_size += len(line)
+                if b"batch above" in line:
+                    continue
+                fields = line.decode("utf-8", "replace").rstrip("\n").split("\t")
+                if fields[0]:
+                    yield fields[0], len(fields) > 1 and fields[1] == "x", url_fingerprint(fields[0])
+
+    def _iter_binary(self) -> Iterator[Tuple[str, bool, int]]:
+        header_size = _BINARY_LOG_RECORD.size
+        unpack_from = _BINARY_LOG_RECORD.unpack_from
+        read_urls = self.read_urls
+        with open(self.path, "rb") as f:
+            if f.read(len(BINARY_LOG_MAGIC)) != BINARY_LOG_MAGIC:
+                return
+            self.valid_size = len(BINARY_LOG_MAGIC)
+            buf = b""
+            while True:
+                data = f.read(self.read_size)
+                if not data:
+                    return
+                buf = buf + data if buf else data
+                pos = 0
+                while pos + header_size <= len(buf):
+                    url_size, fp, status = unpack_from(buf, pos)
+                    end = pos + header_size + url_size
+                    if end > len(buf):
+                        break
+                    url = buf[pos + header_size:end].decode("utf-8", "replace") if read_urls else None
+                    yield url, status == b"x", fp
+                    pos = end
+                self.valid_size += pos
+                buf = buf[pos:]
+
+
+class LogWriter:
+    """
+    This is a class for appending log entries to a log file through one buffer and one open file,
+    instead of opening the file for every url.
+    The buffer is written when it holds [batch_size] entries and at the latest [flush_interval] secs after
+    its first entry, by a daemon thread that stops while nothing is buffered. Every write appends whole records.
+    The fsync policy decides what survives a power loss, not only a crash of the process:
+        "none": the OS writes the log to disk when it wants.
+        "log": the log is fsynced after every write of the buffer.
+        "data": like "log", and the caller fsyncs every saved file before its entry is buffered (see fsync_file),
+                so an url in the log always has its data on disk.
+    Entries still in the buffer are lost if the process crashes, so their urls are downloaded again on the next run.
+
+    Attributes:
+        path (string): the path to the log file.
+        log_format (string): "text" or "binary".
+        flush_interval (float): the max secs an entry waits in the buffer, 0 writes every entry at once.
+        batch_size (int): the number of buffered entries that triggers a write.
+        fsync (string): the fsync policy, "none", "log" or "data".
+        num_flushes (int): the number of writes to the file.
+    """
+    def __init__(self, path: str, log_format: str="text", flush_interval: float=1.0, batch_size: int=1024,
+                 fsync: str="none"):
+        assert log_format in LOG_FORMATS, "log_format should be one of {}".format(LOG_FORMATS)
+        assert fsync in LOG_FSYNC_POLICIES, "fsync should be one of {}".format(LOG_FSYNC_POLICIES)
+        self.path = path
+        self.log_format = log_format
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.num_flushes = 0
+        self._buffer = []
+        self._num_buffered = 0
+        self._lock = threading.Lock()
+        # held while the file is written, so the buffer can take new entries during a slow write or fsync
+        self._io_lock = threading.Lock()
+        self._file = None
+        self._thread = None
+        self._closed = threading.Event()
+
+    def write(self, entries: List[Tuple[str, bool]], fps: Optional[List[int]]=None):
+        """
+        This function buffers log entries and writes the buffer if it is full.
+
+        Parameters:
+            entries (list): (url, failed) of every entry.
+            fps (list): the fingerprints of the urls if the caller already has them.
+
+        Returns:
+            None
+        """
+        if not entries:
+            return
+        data = encode_log_entries(entries, self.log_format, fps)
+        with self._lock:
+            self._buffer.append(data)
+            self._num_buffered += len(entries)
+            full = self._num_buffered >= self.batch_size or not self.flush_interval
+            if not full and self._thread is None:
+                self._closed.clear()
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        This function writes the buffered entries to the log file, and fsyncs it unless the fsync policy is "none".
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        with self._io_lock:
+            with self._lock:
+                if not self._buffer:
+                    return
+                data = b"".join(self._buffer)
+                self._buffer = []
+                self._num_buffered = 0
+            if self._file is None:
+                self._file = open(self.path, "ab")
+                if self.log_format == "binary" and self._file.tell() == 0:
+                    self._file.write(BINARY_LOG_MAGIC)
+            self._file.write(data)
+            self._file.flush()
+            if self.fsync != "none":
+                os.fsync(self._file.fileno())
+            self.num_flushes += 1
+
+    def close(self):
+        """
+        This function writes the buffered entries and closes the file. The writer can still be used, it opens the file again.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._closed.set()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.flush()
+        with self._io_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _run(self):
+        while True:
+            closed = self._closed.wait(self.flush_interval)
+            self.flush()
+            with self._lock:
+                # stop while nothing is buffered, write starts a new thread
+                if closed or not self._buffer:
+                    if self._thread is threading.current_thread():
+                        self._thread = None
+                    return
+
+
+class ResumeIndex:
+    """
+    This is a class for keeping the downloading status of the log file in memory.
+    The log file is read once when the index is created; after that every new entry is appended to the log
+    and recorded in memory, so resuming never re-scans the whole log.
+    Urls are kept as 64-bit fingerprints in a FingerprintTable, the value of a fingerprint is
+    (number of log entries << 1) | (1 if the latest entry is an error). An entry that follows an error entry
+    of the same url is counted as its retry, not as a new entry.
+    New entries go through a buffered LogWriter, see LogWriter for when they reach the file. A binary log
+    stores the fingerprint of every url, so loading it does not hash the urls again.
+
+    Attributes:
+        log_file (string): the path to the append-only log file.
+        log_format (string): the format of the log file, "text" or "binary".
+        writer (LogWriter): the buffered writer of new entries.
+        done (FingerprintTable): the status of every url in the log.
+        num_lines (int): the number of entries in the log file, including stale entries that compact can drop.
+    """
+    def __init__(self, log_file: str, log_format: str="text", flush_interval: float=1.0, batch_size: int=1024,
+                 fsync: str="none"):
+        """
+        The constructor for ResumeIndex Class. It creates the log file if it does not exist and loads it.
+
+        Parameters:
+            log_file (string): the path to the log file.
+            log_format (string): the format of a new log file, "text" or "binary". An existing log keeps its format.
+            flush_interval (float): the max secs a new entry is buffered, see LogWriter.
+            batch_size (int): the number of buffered entries that triggers a write, see LogWriter.
+            fsync (string): the fsync policy of the log, "none", "log" or "data", see LogWriter.
+
+        Returns:
+            The ResumeIndex object
+        """
+        self.log_file = log_file
+        self.done = FingerprintTable()
+        self.num_lines = 0
+        self._lock = threading.Lock()
+        if not os.path.exists(self.log_file):
+            logger.info("Creating log_file")
+            f = open(self.log_file, "w")
+            f.close()
+        existing_format = get_log_format(self.log_file)
+        if existing_format is not None and existing_format != log_format:
+            logger.info(f"{self.log_file} is a {existing_format} log, new entries are appended in that format")
+        self.log_format = existing_format or log_format
+        self.writer = LogWriter(self.log_file, self.log_format, flush_interval, batch_size, fsync)
+        self.load()
+
+    def load(self):
+        """
+        This function reads the whole log file into memory. It is called once by the constructor.
+        A record cut off by a crash at the end of the log is dropped from the file.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self.writer.flush()
+        with self._lock:
+            self.done = FingerprintTable()
+            self.num_lines = 0
+            reader = LogReader(self.log_file, read_urls=False)
+            for _, failed, fp in reader:
+                self.num_lines += 1
+                self._record(fp, failed)
+            size = os.path.getsize(self.log_file)
+            if size > reader.valid_size:
+                logger.warning(f"Dropping {size - reader.valid_size} bytes of an incomplete entry at the end of {self.log_file}")
+                self.writer.close()
+                os.truncate(self.log_file, reader.valid_size)
+
+    def _record(self, fp: int, failed: bool):
+        value = self.done.get(fp, 0)
+        # an entry after an error is a retry of the same url, it replaces the error instead of adding an entry
+        cnt = (value >> 1) + (0 if value & 1 else 1)
+        self.done.set(fp, (cnt << 1) | failed)
+
+    def count(self, url: str, fp: Optional[int]=None) -> int:
+        """
+        This function returns the number of log entries of an url.
+
+        Parameters:
+            url (string)
+            fp (int): the fingerprint of the url if the caller already has it.
+
+        Returns:
+            the number of entries (int)
+        """
+        if fp is None:
+            fp = url_fingerprint(url)
+        with self._lock:
+            return self.done.get(fp, 0) >> 1
+
+    def is_failed(self, url: str, fp: Optional[int]=None) -> bool:
+        """
+        This function returns whether the latest log entry of an url is an error.
+
+        Parameters:
+            url (string)
+            fp (int): the fingerprint of the url if the caller already has it.
+
+        Returns:
+            whether it failed (boolean)
+        """
+        if fp is None:
+            fp = url_fingerprint(url)
+        with self._lock:
+            return bool(self.done.get(fp, 0) & 1)
+
+    def append(self, lines: List[str]):
+        """
+        This function appends log lines to the log and records them in memory.
+
+        Parameters:
+            lines (list): the log lines, formatted as "url\tstatus\n".
+
+        Returns:
+            None
+        """
+        entries = []
+        for line in lines:
+            fields = line.rstrip("\n").split("\t")
+            if fields[0] and "batch above" not in line:
+                entries.append((fields[0], len(fields) > 1 and fields[1] == "x"))
+        self.append_entries(entries)
+
+    def append_entries(self, entries: List[Tuple[str, bool]]):
+        """
+        This function appends one log entry per url and records them in memory, without parsing lines back.
+
+        Parameters:
+            entries (list): (url, failed) of every entry.
+
+        Returns:
+            None
+        """
+        if not entries:
+            return
+        fps = [url_fingerprint(url) for url, _ in entries]
+        with self._lock:
+            for (_, failed), fp in zip(entries, fps):
+                self._record(fp, failed)
+            self.num_lines += len(entries)
+            self.writer.write(entries, fps)
+
+    def flush(self):
+        """
+        This function writes the buffered entries to the log file, see LogWriter.flush.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self.writer.flush()
+
+    def close(self):
+        """
+        This function writes the buffered entries and closes the log file, see LogWriter.close.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self.writer.close()
+
+    def compact(self):
+        """
+        This function rewrites the log file with only the entries that matter for resuming.
+        Marker and malformed lines are dropped and every url keeps its number of entries and latest status.
+        The new log is written to a temp file in the same format and renamed, so a crash during compaction keeps the old log.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.writer.close()
+            tmp_file = self.log_file + ".compact"
+            emitted = FingerprintTable()
+            num_lines = 0
+            writer = LogWriter(tmp_file, self.log_format, flush_interval=0, batch_size=1 << 16)
+            batch = []
+            batch_fps = []
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            for url, _, fp in LogReader(self.log_file):
+                value = self.done.get(fp, 0)
+                cnt = emitted.get(fp, 0)
+                if cnt >= value >> 1:
+                    continue
+                batch.append((url, bool(value & 1) and cnt == (value >> 1) - 1))
+                batch_fps.append(fp)
+                emitted.set(fp, cnt + 1)
+                num_lines += 1
+                if len(batch) >= writer.batch_size:
+                    writer.write(batch, batch_fps)
+                    batch, batch_fps = [], []
+            writer.write(batch, batch_fps)
+            writer.close()
+            if not os.path.exists(tmp_file):
+                open(tmp_file, "w").close()
+            os.replace(tmp_file, self.log_file)
+            logger.info(f"Compacted {self.log_file} from {self.num_lines} to {num_lines} lines")
+            self.num_lines = num_lines
+
+
+class ContentStore:
+    """
+    This is a class for storing downloaded bodies by the sha256 of their content, so the same bytes are stored once.
+    Every unique body is written once to blobs/<2 hex>/<2 hex>/<sha256>, and the output path of each url becomes
+    a hardlink to its blob (or, with link_mode "none", only an entry in the index).
+    The index file has one "url\tsha256\tsize" line per stored url and is loaded on start,
+    so duplicates are still found after a resume.
+
+    Attributes:
+        root (string): the folder of the blobs.
+        index_file (string): the path to the index file.
+        link_mode (string): "hardlink" to link the output path to the blob, "none" to only record the url in the index.
+        num_blobs (int): the number of unique blobs written in this run.
+        num_duplicates (int): the number of bodies that were already stored.
+        bytes_deduplicated (int): the bytes of the duplicated bodies that were not stored again.
+    """
+    def __init__(self, root: str, index_file: str, link_mode: str="hardlink"):
+        assert link_mode in ("hardlink", "none")
+        self.root = root
+        self.index_file = index_file
+        self.link_mode = link_mode
+        self.num_blobs = 0
+        self.num_duplicates = 0
+        self.bytes_deduplicated = 0
+        self._known = FingerprintTable()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+        if os.path.exists(index_file):
+            with open(index_file, "r") as f:
+                for line in f:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) == 3:
+                        self._known.add(self._digest_fingerprint(fields[1]))
+        self._index_f = open(index_file, "a")
+
+    @staticmethod
+    def _digest_fingerprint(digest: str) -> int:
+        return int(digest[:16], 16) or 1
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def contains(self, digest: str) -> bool:
+        """
+        This function returns whether a blob is already stored. The in-memory index answers most lookups
+        without touching the disk; a hit is confirmed by the blob file.
+
+        Parameters:
+            digest (string): the sha256 hex digest.
+
+        Returns:
+            whether it is stored (boolean)
+        """
+        with self._lock:
+            known = self._digest_fingerprint(digest) in self._known
+        return known and os.path.exists(self.blob_path(digest))
+
+    def open_writer(self, url: str, outpath: str) -> "BlobWriter":
+        """
+        This function starts storing a body that arrives chunk by chunk.
+
+        Parameters:
+            url (string): the url of the body.
+            outpath (string): the output path of the url.
+
+        Returns:
+            the writer (BlobWriter), call write for every chunk and then commit, or abort on error
+        """
+        return BlobWriter(self, url, outpath)
+
+    def put_bytes(self, url: str, outpath: str, body: bytes) -> bool:
+        """
+        This function stores a body that is already in memory. A duplicated body is not written at all.
+
+        Parameters:
+            url (string): the url of the body.
+            outpath (string): the output path of the url.
+            body (bytes): the body.
+
+        Returns:
+            whether the body was a duplicate (boolean)
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        tmp_path = None
+        if not self.contains(digest):
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+        return self.commit(url, outpath, tmp_path, digest, len(body))
+
+    def put_file(self, url: str, outpath: str, path: str) -> bool:
+        """
+        This function stores a body that is in a file, the file is moved into the store or removed.
+
+        Parameters:
+            url (string): the url of the body.
+            outpath (string): the output path of the url.
+            path (string): the file, on the file system of the store.
+
+        Returns:
+            whether the body was a duplicate (boolean)
+        """
+        digest, size = get_file_sha256(path)
+        return self.commit(url, outpath, path, digest, size)
+
+    def commit(self, url: str, outpath: str, tmp_path: Optional[str], digest: str, size: int) -> bool:
+        """
+        This function moves a temp file into the store unless its blob exists, links the output path and records the url.
+
+        Parameters:
+            url (string): the url of the body.
+            outpath (string): the output path of the url.
+            tmp_path (string): the temp file with the body, None if the caller already knows it is a duplicate.
+            digest (string): the sha256 hex digest of the body.
+            size (int): the size of the body.
+
+        Returns:
+            whether the body was a duplicate (boolean)
+        """
+        blob_path = self.blob_path(digest)
+        fp = self._digest_fingerprint(digest)
+        # the check and the move are one step, otherwise two threads storing the same body both move a blob
+        # and the output path linked first no longer shares its inode with the later ones
+        with self._lock:
+            duplicate = fp in self._known and os.path.exists(blob_path)
+            if duplicate:
+                if tmp_path is not None:
+                    os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+            self._known.add(fp)
+        if self.link_mode == "hardlink":
+            self._link(blob_path, outpath)
+        with self._lock:
+            if duplicate:
+                self.num_duplicates += 1
+                self.bytes_deduplicated += size
+            else:
+                self.num_blobs += 1
+            self._index_f.write("{}\t{}\t{}\n".format(url, digest, size))
+            self._index_f.flush()
+        return duplicate
+
+    def _link(self, blob_path: str, outpath: str):
+        if os.path.lexists(outpath):
+            os.remove(outpath)
+        try:
+            os.link(blob_path, outpath)
+        except OSError as e:
+            logger.debug(f"Cannot hardlink {outpath} to {blob_path}, copying it instead: {e!r}")
+            shutil.copyfile(blob_path, outpath)
+
+    def close(self):
+        self._index_f.close()
+
+
+class BlobWriter:
+    """
+    This is a class for storing one body into a ContentStore while it is downloaded, hashing it on the way.
+
+    Attributes:
+        size (int): the number of bytes written so far.
+    """
+    def __init__(self, store: ContentStore, url: str, outpath: str):
+        self.store = store
+        self.url = url
+        self.outpath = outpath
+        self.size = 0
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=os.path.join(store.root, "tmp"))
+        self._f = os.fdopen(fd, "wb")
+
+    def write(self, chunk) -> int:
+        self._hash.update(chunk)
+        self.size += len(chunk)
+        return self._f.write(chunk)
+
+    def commit(self) -> bool:
+        """
+        This function finishes the body and stores it.
+
+        Parameters:
+            None
+
+        Returns:
+            whether the body was a duplicate (boolean)
+        """
+        self._f.close()
+        return self.store.commit(self.url, self.outpath, self._tmp_path, self._hash.hexdigest(), self.size)
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class HttpCache:
+    """
+    This is a class for remembering the validators of downloaded urls, so a refresh run can send conditional requests.
+    Every fetch appends one JSON line {"url", "etag", "last_modified", "size", "fetched_at"} to the cache file;
+    the latest line of an url wins. The file is compacted on load when most of its lines are stale.
+
+    Attributes:
+        cache_file (string): the path to the cache file.
+        entries (dict): url fingerprint -> (etag, last_modified, size, fetched_at).
+    """
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self.entries = {}
+        self._lock = threading.Lock()
+        num_lines = 0
+        if os.path.exists(cache_file):
+            with open(cache_file, "r") as f:
+                for line in f:
+                    item = self._parse_line(line)
+                    if item is not None:
+                        num_lines += 1
+                        self.entries[url_fingerprint(item["url"])] = \
+                            (item.get("etag"), item.get("last_modified"), item.get("size"), item.get("fetched_at", 0))
+        if num_lines > 1000 and num_lines > 2 * len(self.entries):
+            self.compact()
+        self._f = open(cache_file, "a")
+
+    @staticmethod
+    def _parse_line(line: str) -> Optional[Dict]:
+        try:
+            item = json.loads(line)
+        except ValueError:
+            # a torn last line after a crash
+            return None
+        return item if isinstance(item, dict) and "url" in item else None
+
+    def get(self, url: str, fp: Optional[int]=None) -> Optional[Tuple]:
+        with self._lock:
+            return self.entries.get(url_fingerprint(url) if fp is None else fp)
+
+    def get_conditional_headers(self, url: str) -> Dict:
+        """
+        This function returns the If-None-Match/If-Modified-Since headers of an url.
+
+        Parameters:
+            url (string)
+
+        Returns:
+            the headers (dict), empty if nothing is cached
+        """
+        entry = self.get(url)
+        headers = {}
+        if entry is not None:
+            etag, last_modified = entry[0], entry[1]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def is_fresh(self, url: str, max_age: Optional[float], fp: Optional[int]=None) -> bool:
+        """
+        This function returns whether an url was fetched less than [max_age] secs ago.
+
+        Parameters:
+            url (string)
+            max_age (float): the max age in secs. None means never fresh.
+            fp (int): the fingerprint of the url if the caller already has it.
+
+        Returns:
+            whether it is fresh (boolean)
+        """
+        if max_age is None:
+            return False
+        entry = self.get(url, fp)
+        return entry is not None and time.time() - entry[3] < max_age
+
+    def record(self, url: str, etag: Optional[str], last_modified: Optional[str], size: Optional[int]):
+        """
+        This function saves the validators of a fetched url.
+
+        Parameters:
+            url (string)
+            etag (string): the ETag header.
+            last_modified (string): the Last-Modified header.
+            size (int): the size of the body.
+
+        Returns:
+            None
+        """
+        fetched_at = time.time()
+        line = json.dumps({"url": url, "etag": etag, "last_modified": last_modified, "size": size, "fetched_at": fetched_at})
+        with self._lock:
+            self.entries[url_fingerprint(url)] = (etag, last_modified, size, fetched_at)
+            self._f.write(line + "\n")
+            self._f.flush()
+
+    def touch(self, url: str):
+        """
+        This function renews the fetch time of an url that the server reported as not modified.
+
+        Parameters:
+            url (string)
+
+        Returns:
+            None
+        """
+        entry = self.get(url)
+        if entry is not None:
+            self.record(url, entry[0], entry[1], entry[2])
+
+    def compact(self):
+        """
+        This function rewrites the cache file with only the latest line of every url.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        tmp_file = self.cache_file + ".compact"
+        emitted = FingerprintTable()
+        with open(self.cache_file, "r") as fin, open(tmp_file, "w") as fout:
+            for line in fin:
+                item = self._parse_line(line)
+                if item is None:
+                    continue
+                fp = url_fingerprint(item["url"])
+                entry = self.entries.get(fp)
+                if entry is not None and entry[3] == item.get("fetched_at", 0) and emitted.add(fp):
+                    fout.write(line if line.endswith("\n") else line + "\n")
+        os.replace(tmp_file, self.cache_file)
+
+    def close(self):
+        self._f.close()
+
+
+class StorageBackend:
+    """
+    This is a class for the interface of the places where URLDownloader_v2 and AsyncURLDownloader save the bodies.
+    A body is addressed by its output path; a backend that does not keep one file per url uses the output path
+    relative to the data folder as the key (get_key). Backends are called from many threads at once.
+    put_bytes saves a body that is in memory, open_writer returns a writer with write(chunk), commit() and abort()
+    for a body that arrives chunk by chunk. A save that fails raises OSError (requests.RequestException is one),
+    and its url is logged as an error.
+
+    Attributes:
+        root (string): the data folder the keys are relative to, set by attach.
+        suffix (string): the shard suffix of the downloader, set by attach.
+    """
+    def __init__(self):
+        self.root = None
+        self.suffix = ""
+
+    def attach(self, root: str, suffix: str=""):
+        """
+        This function is called by the downloader before the first save.
+
+        Parameters:
+            root (string): the data folder of the downloader.
+            suffix (string): the shard suffix of the downloader, so the processes of run_sharded keep their own files.
+
+        Returns:
+            None
+        """
+        if self.root is None:
+            self.root = root
+        self.suffix = suffix
+
+    def get_key(self, outpath: str) -> str:
+        if self.root is None:
+            return os.path.basename(outpath)
+        return os.path.relpath(outpath, self.root).replace(os.sep, "/")
+
+    def put_bytes(self, url: str, outpath: str, body: bytes):
+        raise NotImplementedError
+
+    def put_file(self, url: str, outpath: str, path: str):
+        """
+        This function saves a body that is in a local file, e.g. the output of a processor (see ProcessingStage).
+        A backend may move the file; the caller removes it if it is still there.
+
+        Parameters:
+            url (string): the url of the body.
+            outpath (string): the output path of the body.
+            path (string): the file.
+
+        Returns:
+            None
+        """
+        with open(path, "rb") as f:
+            self.put_bytes(url, outpath, f.read())
+
+    def open_writer(self, url: str, outpath: str):
+        raise NotImplementedError
+
+    def exists(self, outpath: str) -> bool:
+        raise NotImplementedError
+
+    def read(self, outpath: str) -> bytes:
+        raise NotImplementedError
+
+    def sync(self, outpath: str):
+        """
+        This function makes a saved body durable, it is called before the url is logged if log_fsync is "data".
+
+        Parameters:
+            outpath (string): the output path of the body.
+
+        Returns:
+            None
+        """
+        pass
+
+    def close(self):
+        """
+        This function finishes the open files of the backend, it is called at the end of every run. A later save opens them again.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        pass
+
+
+class FileStorage(StorageBackend):
+    """
+    This is a class for saving every body as one file at its output path, the default backend.
+    Bodies that arrive chunk by chunk are written to [outpath].part and renamed on commit.
+    """
+    def put_bytes(self, url: str, outpath: str, body: bytes):
+        _write_file(outpath, body)
+
+    def put_file(self, url: str, outpath: str, path: str):
+        os.replace(path, outpath)
+
+    def open_writer(self, url: str, outpath: str) -> "_PartFileWriter":
+        return _PartFileWriter(outpath)
+
+    def exists(self, outpath: str) -> bool:
+        return os.path.exists(outpath)
+
+    def read(self, outpath: str) -> bytes:
+        with open(outpath, "rb") as f:
+            return f.read()
+
+    def sync(self, outpath: str):
+        # a custom saver may not create the output path
+        if os.path.exists(outpath):
+            fsync_file(outpath)
+
+
+class _SpooledWriter:
+    """
+    This is a class for collecting a body that arrives chunk by chunk in memory, or in a temp file above [spool_size]
+    bytes, and handing it to [commit_fn](file object, size, sha256 hex digest) on commit.
+    """
+    def __init__(self, commit_fn: Callable[[object, int, str], None], spool_size: int=1 << 20):
+        self._commit_fn = commit_fn
+        self._f = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk) -> int:
+        self._sha256.update(chunk)
+        num_bytes = self._f.write(chunk)
+        self.size += num_bytes
+        return num_bytes
+
+    def commit(self):
+        try:
+            self._f.seek(0)
+            self._commit_fn(self._f, self.size, self._sha256.hexdigest())
+        finally:
+            self._f.close()
+
+    def abort(self):
+        self._f.close()
+
+
+class TarShardStorage(StorageBackend):
+    """
+    This is a class for packing the bodies into tar shards instead of one file per url, in the layout of WebDataset:
+    every body is a tar member named by its key, so millions of small bodies take a few large files.
+    Every run appends to new shards, shard-<n><suffix>.tar, started again after [max_shard_size] bytes.
+    Every member gets a line "key\tshard\toffset\tsize" in index<suffix>.tsv after its bytes are written,
+    so read() finds a body with one seek and the index never points to a body that is not in its shard.
+    A shard is finished with the tar end-of-archive blocks by close(); a shard left by a crash has complete
+    members up to the last indexed one, which tar readers accept.
+
+    Attributes:
+        root (string): the folder of the shards and the index, the data folder of the downloader by default.
+        max_shard_size (int): the size after which the next member starts a new shard.
+        num_members (int): the number of members written by this object.
+    """
+    def __init__(self, root: Optional[str]=None, max_shard_size: int=1 << 30):
+        super().__init__()
+        self.root = root
+        self.max_shard_size = max_shard_size
+        self.num_members = 0
+        self._lock = threading.Lock()
+        self._file = None
+        self._shard_name = None
+        self._index_f = None
+        self._index = None
+
+    @property
+    def index_file(self) -> str:
+        return os.path.join(self.root, "index{}.tsv".format(self.suffix))
+
+    def _open_shard(self):
+        os.makedirs(self.root, exist_ok=True)
+        numbers = [int(os.path.basename(path)[len("shard-"):].split(".")[0].split("-")[0])
+                   for path in glob.glob(os.path.join(self.root, "shard-*{}.tar".format(self.suffix)))]
+        self._shard_name = "shard-{:06d}{}.tar".format(max(numbers, default=-1) + 1, self.suffix)
+        self._file = open(os.path.join(self.root, self._shard_name), "xb")
+        if self._index_f is None:
+            self._index_f = open(self.index_file, "a")
+
+    def _finish_shard(self):
+        if self._file is not None:
+            self._file.write(bytes(2 * tarfile.BLOCKSIZE))
+            self._file.close()
+            self._file = None
+
+    def _append(self, key: str, fileobj, size: int):
+        info = tarfile.TarInfo(key)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        with self._lock:
+            if self._file is None or self._file.tell() >= self.max_shard_size:
+                self._finish_shard()
+                self._open_shard()
+            offset = self._file.tell() + len(header)
+            self._file.write(header)
+            if isinstance(fileobj, (bytes, bytearray, memoryview)):
+                self._file.write(fileobj)
+            else:
+                shutil.copyfileobj(fileobj, self._file)
+            self._file.write(bytes(-size % tarfile.BLOCKSIZE))
+            self._file.flush()
+            self._index_f.write("{}\t{}\t{}\t{}\n".format(key, self._shard_name, offset, size))
+            self._index_f.flush()
+            if self._index is not None:
+                self._index[key] = (self._shard_name, offset, size)
+            self.num_members += 1
+
+    def put_bytes(self, url: str, outpath: str, body: bytes):
+        self._append(self.get_key(outpath), body, len(body))
+
+    def put_file(self, url: str, outpath: str, path: str):
+        with open(path, "rb") as f:
+            self._append(self.get_key(outpath), f, os.fstat(f.fileno()).st_size)
+
+    def open_writer(self, url: str, outpath: str) -> _SpooledWriter:
+        key = self.get_key(outpath)
+        return _SpooledWriter(lambda f, size, digest: self._append(key, f, size))
+
+    def _get_index(self) -> Dict[str, Tuple[str, int, int]]:
+        # loaded on the first lookup only, a download that never reads does not keep the index in memory
+        with self._lock:
+            if self._index is None:
+                self._index = {}
+                if os.path.exists(self.index_file):
+                    with open(self.index_file, "r") as f:
+                        for line in f:
+                            fields = line.rstrip("\n").split("\t")
+                            if len(fields) == 4:
+                                self._index[fields[0]] = (fields[1], int(fields[2]), int(fields[3]))
+            return self._index
+
+    def exists(self, outpath: str) -> bool:
+        return self.get_key(outpath) in self._get_index()
+
+    def read(self, outpath: str) -> bytes:
+        """
+        This function reads a body back from its shard.
+
+        Parameters:
+            outpath (string): the output path of the body.
+
+        Returns:
+            the body (bytes)
+        """
+        entry = self._get_index().get(self.get_key(outpath))
+        if entry is None:
+            raise FileNotFoundError(outpath)
+        shard_name, offset, size = entry
+        with open(os.path.join(self.root, shard_name), "rb") as f:
+            f.seek(offset)
+            return f.read(size)
+
+    def sync(self, outpath: str):
+        with self._lock:
+            for f in (self._file, self._index_f):
+                if f is not None:
+                    os.fsync(f.fileno())
+
+    def close(self):
+        with self._lock:
+            self._finish_shard()
+            if self._index_f is not None:
+                self._index_f.close()
+                self._index_f = None
+
+
+def sign_s3_request(method: str, url: str, headers: Dict, payload_hash: str, access_key: str, secret_key: str,
+                    region: str="us-east-1", service: str="s3", now: Optional[float]=None) -> Dict:
+    """
+    This function signs a request with AWS Signature Version 4, the scheme of S3 and its compatible stores.
+
+    Parameters:
+        method (string): the http method.
+        url (string): the url, with the path already percent-encoded.
+        headers (dict): the headers to sign, besides host and the x-amz headers.
+        payload_hash (string): the sha256 hex digest of the body.
+        access_key (string): the access key id.
+        secret_key (string): the secret access key.
+        region (string): the region of the store.
+        service (string): the service name.
+        now (float): the time.time() of the signature, the current time by default.
+
+    Returns:
+        the headers to add to the request (dict): Authorization, x-amz-date and x-amz-content-sha256
+    """
+    parsing = urlparse(url)
+    amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime(time.time() if now is None else now))
+    date = amz_date[:8]
+    signed = {key.lower(): " ".join(str(value).split()) for key, value in headers.items()}
+    signed.update({"host": parsing.netloc, "x-amz-content-sha256": payload_hash, "x-amz-date": amz_date})
+    names = sorted(signed)
+    query = "&".join(sorted("{}={}".format(quote(k, safe="-_.~"), quote(v, safe="-_.~"))
+                            for k, _, v in (part.partition("=") for part in parsing.query.split("&") if part)))
+    canonical_request = "\n".join([method, parsing.path or "/", query,
+                                   "".join("{}:{}\n".format(name, signed[name]) for name in names),
+                                   ";".join(names), payload_hash])
+    scope = "{}/{}/{}/aws4_request".format(date, region, service)
+    string_to_sign = "\n".join(["AWS4-HMAC-SHA256", amz_date, scope,
+                                hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()])
+    key = ("AWS4" + secret_key).encode("utf-8")
+    for part in (date, region, service, "aws4_request"):
+        key = hmac.new(key, part.encode("utf-8"), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode("utf-8"), hashlib.sha256).hexdigest()
+    return {
+        "Authorization": "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+            access_key, scope, ";".join(names), signature),
+        "x-amz-date": amz_date,
+        "x-amz-content-sha256": payload_hash,
+    }
+
+
+class S3Storage(StorageBackend):
+    """
+    This is a class for uploading the bodies to an S3-compatible object store, one PUT per body, in path style
+    ([endpoint_url]/[bucket]/[key]). Requests are signed with AWS Signature Version 4 when credentials are given.
+    The key of a body is [prefix] + its output path relative to the data folder. A body that arrives chunk by chunk
+    is spooled to a temp file and uploaded on commit, so a failed download never leaves a partial object.
+
+    Attributes:
+        endpoint_url (string): the url of the store, e.g. https://s3.us-east-1.amazonaws.com or a local stand-in.
+        bucket (string): the bucket.
+        prefix (string): the prefix of every key.
+        region (string): the region in the signature.
+        num_uploads (int): the number of bodies uploaded.
+    """
+    def __init__(self, endpoint_url: str, bucket: str, prefix: str="", access_key: Optional[str]=None,
+                 secret_key: Optional[str]=None, region: str="us-east-1", timeout: float=60, pool_maxsize: int=32):
+        super().__init__()
+        self.endpoint_url = endpoint_url.rstrip("/")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.timeout = timeout
+        self.num_uploads = 0
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.session.mount(self.endpoint_url, HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize))
+
+    def get_object_url(self, outpath: str) -> str:
+        return "{}/{}/{}".format(self.endpoint_url, self.bucket, quote(self.prefix + self.get_key(outpath), safe="/-_.~"))
+
+    def _request(self, method: str, outpath: str, data=b"", payload_hash: Optional[str]=None,
+                 headers: Optional[Dict]=None) -> requests.Response:
+        url = self.get_object_url(outpath)
+        headers = dict(headers or {})
+        if self._access_key is not None:
+            if payload_hash is None:
+                payload_hash = hashlib.sha256(data).hexdigest()
+            headers.update(sign_s3_request(method, url, headers, payload_hash, self._access_key, self._secret_key, self.region))
+        return self.session.request(method, url, data=data, headers=headers, timeout=self.timeout)
+
+    def _put(self, outpath: str, data, size: int, payload_hash: Optional[str]=None):
+        response = self._request("PUT", outpath, data, payload_hash, {"Content-Length": str(size)})
+        if not response.ok:
+            raise OSError("Failed to upload {}: {} {}".format(self.get_key(outpath), response.status_code, response.text[:200]))
+        with self._lock:
+            self.num_uploads += 1
+
+    def put_bytes(self, url: str, outpath: str, body: bytes):
+        self._put(outpath, body, len(body))
+
+    def put_file(self, url: str, outpath: str, path: str):
+        digest, size = get_file_sha256(path)
+        with open(path, "rb") as f:
+            self._put(outpath, f, size, digest)
+
+    def open_writer(self, url: str, outpath: str) -> _SpooledWriter:
+        return _SpooledWriter(lambda f, size, digest: self._put(outpath, f, size, digest))
+
+    def exists(self, outpath: str) -> bool:
+        return self._request("HEAD", outpath).status_code == 200
+
+    def read(self, outpath: str) -> bytes:
+        response = self._request("GET", outpath)
+        if response.status_code == 404:
+            raise FileNotFoundError(outpath)
+        response.raise_for_status()
+        return response.content
+
+
+class IOPool:
+    """
+    This is a class for running the saves of downloaded bodies on dedicated threads, so a download worker goes back
+    to the network as soon as a body is received. At most [max_pending] saves wait or run; a worker that would
+    exceed it waits for a free slot, which bounds the memory of the bodies waiting to be saved.
+
+    Attributes:
+        num_thread (int): the number of I/O threads.
+        max_pending (int): the max number of saves waiting or running.
+    """
+    def __init__(self, num_thread: int, max_pending: Optional[int]=None):
+        self.num_thread = num_thread
+        self.max_pending = max_pending or 4 * num_thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_thread, thread_name_prefix="downloader-io")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+
+    def submit(self, fn: Callable, *args) -> concurrent.futures.Future:
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self):
+        """
+        This function waits for every submitted save, including the callbacks of their futures.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self._executor.shutdown(wait=True)
+
+
+def _run_processor(processor: Callable, url: str, path: str) -> Tuple[object, float]:
+    # runs in a worker process, the secs are the processing time without the wait in the queue
+    start = time.perf_counter()
+    result = processor(url, path)
+    return result, time.perf_counter() - start
+
+
+def _finish_processing(url: str, path: str, get_result: Callable[[], Tuple[object, float]],
+                       save: Callable[[str], bool], metrics: "DownloadMetrics") -> bool:
+    """
+    This function takes the result of a processor and saves the processed file unless the processor rejected it.
+    The temp file is removed in any case.
+
+    Parameters:
+        url (string): the url of the body.
+        path (string): the temp file with the processed body.
+        get_result (callable): returns the result of _run_processor, or raises the error of the processor.
+        save (callable): called with [path], returns whether the body is saved.
+        metrics (DownloadMetrics): gets the processing time.
+
+    Returns:
+        whether the body is saved (boolean)
+    """
+    try:
+        try:
+            result, secs = get_result()
+            metrics.record_stage("process", secs)
+        except Exception:
+            logger.exception(f"Failed to process {url}")
+            return False
+        if result is False:
+            logger.debug(f"Skip {url}, rejected by the processor")
+            return False
+        return save(path)
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class ProcessingStage:
+    """
+    This is a class for running a CPU-heavy processor (decode, resize, verify, convert) on the downloaded bodies in
+    worker processes, so it never holds the GIL of the download threads. Every body is handed over as a temp file,
+    only its path is pickled. The processor changes the file in place, and the file is then saved on one of
+    [num_process] finishing threads. At most [max_pending] bodies wait or are processed; a download worker that would
+    exceed it waits for a free slot, so the downloads slow down to the speed of the processes instead of piling up.
+
+    Attributes:
+        processor (callable): called with (url, path) in a worker process, see URLDownloader_v2 processor.
+        num_process (int): the number of worker processes.
+        max_pending (int): the max number of bodies waiting or being processed and saved.
+        num_pending (int): the number of bodies waiting or being processed and saved.
+    """
+    def __init__(self, processor: Callable[[str, str], Optional[bool]], num_process: int, metrics: "DownloadMetrics",
+                 max_pending: Optional[int]=None):
+        self.processor = processor
+        self.num_process = num_process
+        self.max_pending = max_pending or 2 * num_process
+        self.num_pending = 0
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        # spawn, the locks held by the download threads are not copied into the workers
+        self._executor = concurrent.futures.ProcessPoolExecutor(num_process, mp_context=multiprocessing.get_context("spawn"))
+        self._finisher = concurrent.futures.ThreadPoolExecutor(max_workers=num_process,
+                                                               thread_name_prefix="downloader-process")
+
+    def submit(self, url: str, path: str, save: Callable[[str], bool]) -> concurrent.futures.Future:
+        """
+        This function hands a body to the worker processes, it waits while [max_pending] bodies are pending.
+
+        Parameters:
+            url (string): the url of the body.
+            path (string): the temp file with the body, it is removed when the body is saved or rejected.
+            save (callable): called with [path] after processing, returns whether the body is saved.
+
+        Returns:
+            a Future of whether the body is saved
+        """
+        start = time.perf_counter()
+        self._slots.acquire()
+        self.metrics.record_blocked("process", time.perf_counter() - start)
+        with self._lock:
+            self.num_pending += 1
+        future = concurrent.futures.Future()
+        try:
+            process_future = self._executor.submit(_run_processor, self.processor, url, path)
+        except BaseException:
+            self._release()
+            raise
+        # the callback runs on the thread that manages the processes, the file is saved on the finishing threads
+        process_future.add_done_callback(lambda f: self._finisher.submit(self._finish, url, path, save, f, future))
+        return future
+
+    def _finish(self, url: str, path: str, save: Callable[[str], bool], process_future: concurrent.futures.Future,
+                future: concurrent.futures.Future):
+        try:
+            future.set_result(_finish_processing(url, path, process_future.result, save, self.metrics))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            self._release()
+
+    def _release(self):
+        with self._lock:
+            self.num_pending -= 1
+        self._slots.release()
+
+    def shutdown(self):
+        """
+        This function waits for every submitted body, including the callbacks of their futures, and stops the processes.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self._executor.shutdown(wait=True)
+        self._finisher.shutdown(wait=True)
+
+
+class URLDownloader_v1:
+    """ 
+    This is a class for downloading a batch of urls via http connection.
+      
+    Attributes: 
+        url_list (list): a list of url to download.
+        out_path (string): the path to the output folder /
+        outpath_list (list): appending the outname with outpath.
+        num_thread (int): the number of thread used for download.
+        err_tolerance_num (int): the number of error tolerance for downloading.
+        stop_interval (int): the secs to stop after error number exceeds the  err_tolerance_num
+        time_out_for_GET (int): the time limit for http GET
+        http_headers (dict): the header for http.
+        outname_list (list): the list for the output file name. The default behaviour is using the file name in the url. If this is specified, it will overwrite the default name.
+        err_cnter (int): counter for counting consecutive errors.
+        log_file (string): a file name for logging, saving inside the out_path.
+        log_writer (LogWriter): the buffered writer of log_file.
+        _errs_cnter_lock (RLock): avoid race condition. this lock is for err_cnter
+    """
+    def __init__(self, url_list,
+                 out_path,
+                 num_thread=4,
+                 err_tolerance_num=1000,
+                 stop_interval=0,
+                 time_out_for_GET=600,
+                 http_headers={},
+                 remove_dup_img=False,
+                 outname_list=None,
+                 verbose=True,
+                 log_flush_interval=1,
+                 log_batch_size=1024,
+                 log_fsync='none'
+                 ):
+        """ 
+        The constructor for URLDownloader Class. It saves the parameters as attributes, set some attributes, and call update_downloading_status
+        
+        Parameters: 
+            url_list (list): a list of url to download.
+            out_path (string): the path to the output folder 
+            num_thread (int): the number of thread used for download.
+            err_tolerance_num (int): the number of error tolerance for downloading.
+            stop_interval (int): the secs to stop after error number exceeds the  err_tolerance_num
+            time_out_for_GET (int): the time limit for http GET
+            http_headers (dict): the header for http.
+            remove_dup_img (boolean): whether to remove the same image with different urls.
+                The bodies are stored once in a ContentStore under out_path/blobs and the output paths are hardlinks to them.
+            outname_list (list): the list for the output file name. The default behaviour is using the file name in the url. If this is specified, it will overwrite the default name.
+            log_flush_interval (float): the max secs a finished url waits in the log buffer, see LogWriter.
+            log_batch_size (int): the number of buffered log entries that triggers a write of the log.
+            log_fsync (string): the fsync policy of the log, "none", "log" or "data", see LogWriter.
+                    
+        Returns: 
+            The URLDownloader object
+        """
+        self.out_path = out_path
+        if outname_list:
+            assert(len(url_list) == len(outname_list))
+            url2oname = {url: oname for url, oname in zip(url_list, outname_list)}
+            url_list = [k for k in url2oname.keys()]
+            outname_list = [v for v in url2oname.values()]
+        else:
+            url_list = list(set(url_list))
+        if outname_list:
+            self.outpath_list = [os.path.join(out_path, name) for name in outname_list]
+        else:
+            self.outpath_list = [self.get_outpath_from_url(i) for i in url_list]
+        self.url_list = url_list
+        self.num_thread = num_thread
+        self.err_tolerance_num = err_tolerance_num
+        self.stop_interval = stop_interval
+        self.time_out_for_GET = time_out_for_GET
+        self.http_headers = http_headers
+        self.verbose = verbose
+        self.remove_dup_img = remove_dup_img
+
+        self.err_cnter = 0
+        self.url_cnter = 0
+        self.log_file = os.path.join(out_path, 'downloaded.log')
+        self._errs_cnter_lock = threading.Lock()
+        self._url_cnter_lock = threading.Lock()
+        self.log_writer = LogWriter(self.log_file, 'text', log_flush_interval, log_batch_size, log_fsync)
+        # self._check_url_lock = threading.Lock()
+        if not os.path.exists(out_path): 
+            print('output folder is not exist, create "{}" folder'.format(out_path))
+            os.makedirs(out_path)
+        if not os.path.exists(self.log_file): 
+            f = open(self.log_file, 'w')
+            f.close()
+        self.content_store = None
+        if remove_dup_img:
+            self.content_store = ContentStore(os.path.join(out_path, 'blobs'), os.path.join(out_path, 'content.index'))
+        #self.adapter = HTTPAdapter(max_retries=3)
+        #self.check_urls()
+        self.update_downloading_status()
+
+    def update_downloading_status(self):
+        """ 
+        The function to update the url_list, outpaht_list, and img_hash_set, based on the log in the folder.
+        This is useful when you already have some urls downloaded in the output folder.
+        This function depnds on the log file in the output folder.
+
+        Parameters: 
+            None  
+
+        Returns: 
+            None
+        """
+        tmp = []
+        self.log_writer.flush()
+        with open(self.log_file, 'r') as f:
+            downloaded_url = collections.Counter([line.split('\t')[0] for line in f])
+        for url, outpath in zip(self.url_list, self.outpath_list):
+            if url in downloaded_url:
+                downloaded_url[url] -= 1
+                if downloaded_url[url] == 0:
+                    downloaded_url.pop(url)
+            else:
+                tmp.append((url, outpath))
+        # random.shuffle(tmp)
+        self.url_list = [i[0] for i in tmp]
+        self.outpath_list = [i[1] for i in tmp]
+
+    def get_num_urls_needed(self):
+        """ 
+        This function returns the number of urls needs to download to the output folder.
+        
+        Parameters: 
+            None  
+
+        Returns: 
+            len(self.url_list) (int)
+        """
+        self.update_downloading_status()
+        return len(self.url_list)
+
+    def get_outpath_from_url(self, url):
+        """ 
+        This function generate output path for an url, based on the filename in an url.
+        
+        Parameters: 
+            url (string)  
+
+        Returns: 
+            outpath (string): output path for the given url
+        """
+        parsing = urlparse(url)
+        if os.path.basename(parsing.path):
+            fname = os.path.basename(parsing.path)
+        else:
+            fname = parsing.netloc
+        outpath = os.path.join(self.out_path, fname)
+        return outpath
+
+    def download_site(self, url, outpath):
+        """
+        This function download an url and save its content to the outpath.
+
+        Parameters:
+            url (string): the url to downalod.
+            outpath (string): the output path to save the content.
+
+        Returns:
+            None
+        """
+        session = get_session()
+        session.headers.update(self.http_headers)
+        #session.mount(url, self.adapter) #for retry
+        #print('url: {}, outpath: {}'.format(url, outpath))
+        with session.get(url, timeout=self.time_out_for_GET) as response:
+            if response:
+                if self.verbose:
+                    print('o', end='', file=sys.stderr, flush=True)
+                with self._url_cnter_lock:
+                    self.url_cnter += 1
+                if self.url_cnter % 1000 == 0 and self.verbose:
+                    print('# processed url: {}...'.format(self.url_cnter), end='', file=sys.stderr, flush=True)
+                #print(f"Read {len(response.content)} from {url}")
+                if self.content_store:
+                    self.content_store.put_bytes(url, outpath, response.content)
+                else:
+                    with open(outpath, 'wb') as f:
+                        f.write(response.content)
+                if self.log_writer.fsync == 'data':
+                    fsync_file(outpath)
+                self.log_writer.write([(url, False)])
+                with self._errs_cnter_lock:
+                    self.err_cnter = 0
+            else:
+                print('x', end='', file=sys.stderr, flush=True)
+                with self._url_cnter_lock:
+                    self.url_cnter += 1
+                if self.url_cnter % 1000 == 0:
+                    print('# processed url: {}...'.format(self.url_cnter), end='', file=sys.stderr, flush=True)
+                with self._errs_cnter_lock:
+                    if self.err_cnter >= self.err_tolerance_num:
+                        time.sleep(self.stop_interval)
+                        self.err_cnter = 0
+                        print('last error code is {}, error url: {}'.format(response.status_code, url), file=sys.stderr, flush=True)
+                    else:
+                        self.err_cnter += 1
+                self.log_writer.write([(url, True)])
+
+    def download_all_sites(self):
+        """ 
+        This function calls [self.num_thread] threads to download urls.
+        Its a multithread version of download_site
+        
+        Parameters: 
+            None
+        Returns: 
+            None
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_thread) as executor:
+            executor.map(self.download_site, self.url_list, self.outpath_list)
+        self.log_writer.flush()
+
+    def batch_download_sites(self, num):
+        """ 
+        This function calls [self.num_thread] threads to download urls.
+        Its a multithread version of download_site
+        
+        Parameters: 
+            None
+        Returns: 
+            None
+        """
+        print('# files to download: {}'.format(len( self.url_list[:num])))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_thread) as executor:
+            executor.map(self.download_site, self.url_list[:num], self.outpath_list[:num])
+        self.update_downloading_status()
+
+
+class Histogram:
+    """
+    This is a class for counting observations in fixed buckets, the same layout as a Prometheus histogram.
+
+    Attributes:
+        bounds (list): the upper bounds of the buckets, the last bucket is +Inf.
+        counts (list): the number of observations of every bucket, not cumulative.
+        sum (float): the sum of the observations.
+        count (int): the number of observations.
+    """
+    DEFAULT_BOUNDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self, bounds: Optional[List[float]]=None):
+        self.bounds = list(bounds or self.DEFAULT_BOUNDS)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        This function estimates a quantile as the upper bound of the bucket that holds it.
+
+        Parameters:
+            q (float): the quantile, between 0 and 1.
+
+        Returns:
+            the estimate (float), None if nothing is observed
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, cnt in zip(self.bounds + [float("inf")], self.counts):
+            cumulative += cnt
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> Dict:
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99)}
+
+
+class DownloadMetrics:
+    """
+    This is a class for collecting thread-safe metrics of a downloader.
+    Every attempt is recorded with its status, size and latencies: connect (DNS + TCP + TLS of a new connection),
+    ttfb (time to the response headers, without connect) and transfer (reading the body).
+    Callers can attach hooks that receive every attempt as a dict, e.g. to feed a profiler.
+    The stages of a url (download, save, process) are timed separately, so each pool can be sized on its own.
+
+    Attributes:
+        start_time (float): the time.time() when the metrics were created.
+        counters (Counter): urls_ok, urls_failed, attempts, retries and bytes, and filtered_<stage> and filtered_bytes of the content filter.
+        status_codes (Counter): the number of attempts of every status code, "error" for connection errors.
+        latencies (dict): phase -> Histogram, the phases are connect, ttfb, transfer and total.
+        per_host (dict): host -> Counter with attempts, ok, failed, bytes and latency_sum.
+        active_workers (int): the number of workers in a request.
+        queue_depth (callable): returns the number of tasks waiting for a worker.
+        stages (dict): stage -> Counter with items, busy_s and blocked_s, the stages are download (every attempt), save
+            and process. blocked_s is the time the download workers waited for the stage to have room, it is part of
+            the busy_s of the download stage.
+        stage_workers (dict): stage -> the number of workers of the stage, set by the downloader, see set_stage.
+        stage_pending (dict): stage -> a callable that returns the number of items waiting in the stage.
+    """
+    PHASES = ("connect", "ttfb", "transfer", "total")
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = collections.Counter()
+        self.status_codes = collections.Counter()
+        self.latencies = {phase: Histogram() for phase in self.PHASES}
+        self.per_host = collections.defaultdict(collections.Counter)
+        self.active_workers = 0
+        self.queue_depth = lambda: 0
+        self.stages = collections.defaultdict(collections.Counter)
+        self.stage_workers = {}
+        self.stage_pending = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._last_rate_sample = (time.monotonic(), 0, 0)
+
+    def add_hook(self, hook: Callable[[Dict], None]):
+        """
+        This function adds a callback that is called with every recorded attempt, on the thread that made it.
+        The dict has the keys url, host, status, saved, bytes, connect_s, ttfb_s, transfer_s and total_s.
+
+        Parameters:
+            hook (callable)
+
+        Returns:
+            None
+        """
+        self._hooks.append(hook)
+
+    def worker_started(self):
+        with self._lock:
+            self.active_workers += 1
+
+    def worker_finished(self):
+        with self._lock:
+            self.active_workers -= 1
+
+    def record_attempt(self, url: str, host: str, status: Optional[int], saved: bool, num_bytes: int,
+                       connect: float, ttfb: float, transfer: float):
+        """
+        This function records one request.
+
+        Parameters:
+            url (string): the url.
+            host (string): the host of the url.
+            status (int): the status code, None for connection errors and timeouts.
+            saved (boolean): whether the body is saved.
+            num_bytes (int): the size of the body.
+            connect (float): the secs spent opening a connection, 0 if one is reused.
+            ttfb (float): the secs until the response headers, without connect.
+            transfer (float): the secs spent reading the body.
+
+        Returns:
+            None
+        """
+        total = connect + ttfb + transfer
+        with self._lock:
+            self.counters["attempts"] += 1
+            self.counters["bytes"] += num_bytes
+            self.status_codes["error" if status is None else str(status)] += 1
+            if connect:
+                self.latencies["connect"].observe(connect)
+            self.latencies["ttfb"].observe(ttfb)
+            self.latencies["transfer"].observe(transfer)
+            self.latencies["total"].observe(total)
+            host_stats = self.per_host[host]
+            host_stats["attempts"] += 1
+            host_stats["bytes"] += num_bytes
+            host_stats["latency_sum"] += total
+            self.stages["download"]["items"] += 1
+            self.stages["download"]["busy_s"] += total
+        if self._hooks:
+            event = {"url": url, "host": host, "status": status, "saved": saved, "bytes": num_bytes,
+                     "connect_s": connect, "ttfb_s": ttfb, "transfer_s": transfer, "total_s": total}
+            for hook in self._hooks:
+                try:
+                    hook(event)
+                except Exception:
+                    logger.exception("Metrics hook failed")
+
+    def record_retry(self):
+        with self._lock:
+            self.counters["retries"] += 1
+
+    def record_filtered(self, stage: str, num_bytes: int=0):
+        """
+        This function records an url dropped by the content filter.
+
+        Parameters:
+            stage (string): "url" for the preflight check, "headers" for the header check, "body" for a body without
+                size headers that is under min_size.
+            num_bytes (int): the bytes that were not downloaded, from the size headers.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.counters["filtered_" + stage] += 1
+            self.counters["filtered_bytes"] += num_bytes
+
+    def set_stage(self, stage: str, num_workers: int, pending: Optional[Callable[[], int]]=None):
+        """
+        This function sets the number of workers of a stage, which the utilization in the snapshot is relative to.
+
+        Parameters:
+            stage (string): "download", "save" or "process".
+            num_workers (int): the number of threads or processes of the stage.
+            pending (callable): returns the number of items waiting in the stage, None if it is not known.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.stage_workers[stage] = num_workers
+            if pending is not None:
+                self.stage_pending[stage] = pending
+
+    def record_stage(self, stage: str, secs: float):
+        """
+        This function records one item that a stage worked on for [secs], the download stage is recorded by record_attempt.
+
+        Parameters:
+            stage (string): "save" or "process".
+            secs (float): the secs the worker spent on the item.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self.stages[stage]["items"] += 1
+            self.stages[stage]["busy_s"] += secs
+
+    def record_blocked(self, stage: str, secs: float):
+        with self._lock:
+            self.stages[stage]["blocked_s"] += secs
+
+    def _stage_snapshot(self, elapsed: float) -> Dict:
+        # busy_s / items is the secs a worker needs per item, so a target rate needs rate * secs_per_item workers;
+        # a stage with a utilization close to 1 is the one that holds back the others
+        stages = {}
+        for stage, stats in self.stages.items():
+            items = stats["items"]
+            num_workers = self.stage_workers.get(stage)
+            stages[stage] = {
+                "items": items,
+                "busy_s": round(stats["busy_s"], 3),
+                "blocked_s": round(stats["blocked_s"], 3),
+                "items_per_s": round(items / elapsed, 3),
+                "secs_per_item": round(stats["busy_s"] / items, 6) if items else None,
+                "workers": num_workers,
+                "utilization": round(stats["busy_s"] / (elapsed * num_workers), 3) if num_workers else None,
+            }
+        return stages
+
+    def record_url(self, host: str, ok: bool) -> int:
+        """
+        This function records a finished url.
+
+        Parameters:
+            host (string): the host of the url.
+            ok (boolean): whether the url is downloaded.
+
+        Returns:
+            the number of finished urls so far (int)
+        """
+        with self._lock:
+            self.counters["urls_ok" if ok else "urls_failed"] += 1
+            self.per_host[host]["ok" if ok else "failed"] += 1
+            return self.counters["urls_ok"] + self.counters["urls_failed"]
+
+    def snapshot(self) -> Dict:
+        """
+        This function returns every metric as a JSON-serializable dict.
+        The rates are given since the start and since the previous snapshot.
+
+        Parameters:
+            None
+
+        Returns:
+            the metrics (dict)
+        """
+        now = time.monotonic()
+        with self._lock:
+            urls = self.counters["urls_ok"] + self.counters["urls_failed"]
+            num_bytes = self.counters["bytes"]
+            last_time, last_urls, last_bytes = self._last_rate_sample
+            self._last_rate_sample = (now, urls, num_bytes)
+            elapsed = max(time.time() - self.start_time, 1e-9)
+            window = max(now - last_time, 1e-9)
+            snapshot = {
+                "time": time.time(),
+                "elapsed_s": round(elapsed, 3),
+                "counters": dict(self.counters),
+                "urls_per_s": round(urls / elapsed, 3),
+                "bytes_per_s": round(num_bytes / elapsed, 3),
+                "recent_urls_per_s": round((urls - last_urls) / window, 3),
+                "recent_bytes_per_s": round((num_bytes - last_bytes) / window, 3),
+                "status_codes": dict(self.status_codes),
+                "latency_s": {phase: hist.to_dict() for phase, hist in self.latencies.items()},
+                "active_workers": self.active_workers,
+                "per_host": {host: dict(stats) for host, stats in self.per_host.items()},
+                "stages": self._stage_snapshot(elapsed),
+            }
+            stage_pending = list(self.stage_pending.items())
+        snapshot["queue_depth"] = self.queue_depth()
+        for stage, pending in stage_pending:
+            if stage in snapshot["stages"]:
+                snapshot["stages"][stage]["pending"] = pending()
+        return snapshot
+
+    def to_prometheus(self) -> str:
+        """
+        This function renders the metrics in the Prometheus text exposition format.
+
+        Parameters:
+            None
+
+        Returns:
+            the text (string)
+        """
+        lines = []
+        with self._lock:
+            lines.append("# TYPE downloader_urls_total counter")
+            lines.append('downloader_urls_total{{result="ok"}} {}'.format(self.counters["urls_ok"]))
+            lines.append('downloader_urls_total{{result="failed"}} {}'.format(self.counters["urls_failed"]))
+            for name in ("attempts", "retries", "bytes"):
+                lines.append("# TYPE downloader_{}_total counter".format(name))
+                lines.append("downloader_{}_total {}".format(name, self.counters[name]))
+            lines.append("# TYPE downloader_status_total counter")
+            for code, cnt in sorted(self.status_codes.items()):
+                lines.append('downloader_status_total{{code="{}"}} {}'.format(code, cnt))
+            lines.append("# TYPE downloader_latency_seconds histogram")
+            for phase, hist in self.latencies.items():
+                cumulative = 0
+                for bound, cnt in zip(hist.bounds + ["+Inf"], hist.counts):
+                    cumulative += cnt
+                    lines.append('downloader_latency_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, bound, cumulative))
+                lines.append('downloader_latency_seconds_sum{{phase="{}"}} {}'.format(phase, hist.sum))
+                lines.append('downloader_latency_seconds_count{{phase="{}"}} {}'.format(phase, hist.count))
+            lines.append("# TYPE downloader_host_attempts_total counter")
+            for host, stats in sorted(self.per_host.items()):
+                lines.append('downloader_host_attempts_total{{host="{}"}} {}'.format(host, stats["attempts"]))
+            lines.append("# TYPE downloader_stage_items_total counter")
+            for stage, stats in sorted(self.stages.items()):
+                lines.append('downloader_stage_items_total{{stage="{}"}} {}'.format(stage, stats["items"]))
+            lines.append("# TYPE downloader_stage_busy_seconds_total counter")
+            for stage, stats in sorted(self.stages.items()):
+                lines.append('downloader_stage_busy_seconds_total{{stage="{}"}} {}'.format(stage, stats["busy_s"]))
+            lines.append("# TYPE downloader_active_workers gauge")
+            lines.append("downloader_active_workers {}".format(self.active_workers))
+        lines.append("# TYPE downloader_queue_depth gauge")
+        lines.append("downloader_queue_depth {}".format(self.queue_depth()))
+        return "\n".join(lines) + "\n"
+
+
+class MetricsReporter:
+    """
+    This is a class for appending a metrics snapshot as one JSON line to a file every [interval] secs.
+
+    Attributes:
+        metrics (DownloadMetrics): the metrics to report.
+        path (string): the path to the JSON-lines file.
+        interval (float): the secs between two snapshots.
+    """
+    def __init__(self, metrics: DownloadMetrics, path: str, interval: float=10):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-reporter", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        This function stops the reporter and writes a last snapshot.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        with open(self.path, "a") as f:
+            while True:
+                stopping = self._stop.wait(self.interval)
+                f.write(json.dumps(self.metrics.snapshot()) + "\n")
+                f.flush()
+                if stopping:
+                    return
+
+
+def start_prometheus_server(metrics: DownloadMetrics, port: int, host: str="127.0.0.1") -> http.server.ThreadingHTTPServer:
+    """
+    This function serves the metrics in the Prometheus text format on http://host:port/metrics from a daemon thread.
+
+    Parameters:
+        metrics (DownloadMetrics): the metrics to serve.
+        port (int): the port, 0 picks a free one.
+        host (string): the interface to listen on.
+
+    Returns:
+        the server (ThreadingHTTPServer), call shutdown() to stop it
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
+
+
+class RetryPolicy:
+    """
+    This is a class for deciding whether and when a failed download is tried again.
+    The delay of the n-th retry is min(backoff_max, backoff_base * backoff_factor ** (n - 1)), of which a random
+    [jitter] fraction is dropped, so retries of many urls do not hit the server at the same moment.
+    A Retry-After header of 429/503 responses overrides the delay, capped by max_retry_after.
+
+    Attributes:
+        max_attempts (int): the number of attempts of an url, including the first one.
+        status_max_attempts (dict): status code -> the number of attempts for that status, only these statuses are retried.
+        retry_on_connection_error (boolean): whether to retry connection errors and timeouts, with max_attempts attempts.
+        backoff_base (float): the delay of the first retry in secs.
+        backoff_factor (float): the growth of the delay per retry.
+        backoff_max (float): the max delay in secs.
+        jitter (float): the fraction of the delay that is randomized, between 0 and 1.
+        respect_retry_after (boolean): whether to follow the Retry-After header.
+        max_retry_after (float): the max delay in secs taken from a Retry-After header.
+    """
+    def __init__(self,
+                 max_attempts: int=3,
+                 status_max_attempts: Optional[Dict[int, int]]=None,
+                 retry_on_connection_error: bool=True,
+                 backoff_base: float=1,
+                 backoff_factor: float=2,
+                 backoff_max: float=60,
+                 jitter: float=1,
+                 respect_retry_after: bool=True,
+                 max_retry_after: float=300):
+        self.max_attempts = max_attempts
+        if status_max_attempts is None:
+            status_max_attempts = {code: max_attempts for code in (408, 429, 500, 502, 503, 504)}
+        self.status_max_attempts = status_max_attempts
+        self.retry_on_connection_error = retry_on_connection_error
+        self.backoff_base = backoff_base
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.respect_retry_after = respect_retry_after
+        self.max_retry_after = max_retry_after
+
+    def should_retry(self, status_code: Optional[int], attempt: int) -> bool:
+        """
+        This function decides whether a failed attempt is tried again.
+
+        Parameters:
+            status_code (int): the status code of the response, None for connection errors and timeouts.
+            attempt (int): the number of attempts made so far.
+
+        Returns:
+            whether to retry (boolean)
+        """
+        if status_code is None:
+            return self.retry_on_connection_error and attempt < self.max_attempts
+        return attempt < self.status_max_attempts.get(status_code, 0)
+
+    def get_delay(self, attempt: int, retry_after: Optional[str]=None) -> float:
+        """
+        This function returns the secs to wait before the next attempt.
+
+        Parameters:
+            attempt (int): the number of attempts made so far.
+            retry_after (string): the Retry-After header of the failed response, if any.
+
+        Returns:
+            the delay in secs (float)
+        """
+        if self.respect_retry_after and retry_after:
+            delay = parse_retry_after(retry_after)
+            if delay is not None:
+                return min(delay, self.max_retry_after)
+        delay = min(self.backoff_max, self.backoff_base * self.backoff_factor ** (attempt - 1))
+        return delay * (1 - self.jitter * random.random())
+
+
+def parse_retry_after(value: str) -> Optional[float]:
+    """
+    This function parses a Retry-After header, given either in secs or as an http date.
+
+    Parameters:
+        value (string)
+
+    Returns:
+        the delay in secs (float), None if the header cannot be parsed
+    """
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_time = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_time.timestamp() - time.time(), 0.0)
+
+
+class TokenBucket:
+    """
+    This is a class for a token bucket that refills [rate] tokens per sec up to [burst] tokens.
+    Tokens can be taken beyond zero, e.g. bytes that are only known after a download; the debt is paid by the refill.
+    It is not thread-safe, RateLimiter guards its buckets with a lock.
+
+    Attributes:
+        rate (float): the tokens added per sec.
+        burst (float): the max number of tokens.
+        tokens (float): the tokens at the last update, negative while in debt.
+    """
+    def __init__(self, rate: float, burst: Optional[float]=None):
+        assert rate > 0, "the rate of a token bucket should be positive"
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    def _refill(self, now: float):
+        # a bucket created after the caller took [now] is not refilled backwards
+        if now > self._updated:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def get_wait(self, amount: float, now: float) -> float:
+        """
+        This function returns the secs until the bucket holds [amount] tokens.
+
+        Parameters:
+            amount (float): the tokens needed, 0 to wait only for the debt to be paid.
+            now (float): the time.monotonic() now.
+
+        Returns:
+            the wait in secs (float), 0 if the tokens are there
+        """
+        self._refill(now)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.tokens -= amount
+
+
+class RateLimiter:
+    """
+    This is a class for keeping the downloads under request and byte rates, globally and per host.
+    The dispatcher of URLDownloader_v2 asks try_acquire before it hands out a url. A host over its rate is skipped
+    and its urls wait in the dispatcher while the urls of other hosts go ahead, so no worker sleeps on a limit.
+    A request takes a token from the request buckets when it starts; its bytes are only known when it ends,
+    so they are taken from the byte buckets afterwards (observe is a DownloadMetrics hook) and the host waits
+    until the debt is paid.
+    A per-host rate is either one number for every host or a dict host -> rate, hosts missing from the dict have no limit.
+
+    Attributes:
+        requests_per_sec (float): the global request rate, None means no limit.
+        bytes_per_sec (float): the global byte rate, None means no limit.
+        requests_per_sec_per_host (float or dict): the request rate of every host, None means no limit.
+        bytes_per_sec_per_host (float or dict): the byte rate of every host, None means no limit.
+        burst_secs (float): the size of every bucket, in secs of its rate.
+        num_delayed (Counter): host -> the number of times a url of the host was held back.
+    """
+    def __init__(self,
+                 requests_per_sec: Optional[float]=None,
+                 bytes_per_sec: Optional[float]=None,
+                 requests_per_sec_per_host: Union[float, Dict[str, float], None]=None,
+                 bytes_per_sec_per_host: Union[float, Dict[str, float], None]=None,
+                 burst_secs: float=1.0):
+        self.requests_per_sec = requests_per_sec
+        self.bytes_per_sec = bytes_per_sec
+        self.requests_per_sec_per_host = requests_per_sec_per_host
+        self.bytes_per_sec_per_host = bytes_per_sec_per_host
+        self.burst_secs = burst_secs
+        self.num_delayed = collections.Counter()
+        self._global_requests = self._make_bucket(requests_per_sec)
+        self._global_bytes = self._make_bucket(bytes_per_sec)
+        self._host_requests = {}
+        self._host_bytes = {}
+        self._lock = threading.Lock()
+
+    def _make_bucket(self, rate: Optional[float]) -> Optional[TokenBucket]:
+        if rate is None:
+            return None
+        return TokenBucket(rate, max(rate * self.burst_secs, 1))
+
+    def _get_host_bucket(self, buckets: Dict, rates: Union[float, Dict[str, float], None], host: str) -> Optional[TokenBucket]:
+        if host not in buckets:
+            rate = rates.get(host) if isinstance(rates, dict) else rates
+            buckets[host] = self._make_bucket(rate)
+        return buckets[host]
+
+    def _get_wait(self, host: Optional[str], now: float) -> float:
+        waits = [0.0]
+        if self._global_requests is not None:
+            waits.append(self._global_requests.get_wait(1, now))
+        if self._global_bytes is not None:
+            waits.append(self._global_bytes.get_wait(0, now))
+        if host is not None:
+            host_requests = self._get_host_bucket(self._host_requests, self.requests_per_sec_per_host, host)
+            if host_requests is not None:
+                waits.append(host_requests.get_wait(1, now))
+            host_bytes = self._get_host_bucket(self._host_bytes, self.bytes_per_sec_per_host, host)
+            if host_bytes is not None:
+                waits.append(host_bytes.get_wait(0, now))
+        return max(waits)
+
+    def get_global_wait(self) -> float:
+        """
+        This function returns the secs until the global buckets let any request start.
+
+        Parameters:
+            None
+
+        Returns:
+            the wait in secs (float), 0 if a request can start now
+        """
+        with self._lock:
+            return self._get_wait(None, time.monotonic())
+
+    def try_acquire(self, host: str) -> float:
+        """
+        This function takes a request token of the host and of the whole downloader if every bucket allows it.
+
+        Parameters:
+            host (string): the host of the url.
+
+        Returns:
+            0 if the request can start now, else the secs to wait before asking again (float)
+        """
+        with self._lock:
+            now = time.monotonic()
+            wait = self._get_wait(host, now)
+            if wait > 0:
+                self.num_delayed[host] += 1
+                return wait
+            if self._global_requests is not None:
+                self._global_requests.take(1, now)
+            host_requests = self._host_requests.get(host)
+            if host_requests is not None:
+                host_requests.take(1, now)
+            return 0.0
+
+    def observe(self, event: Dict):
+        """
+        This function takes the bytes of a finished request from the byte buckets, a DownloadMetrics hook.
+
+        Parameters:
+            event (dict): the attempt, with the keys host and bytes.
+
+        Returns:
+            None
+        """
+        if not event["bytes"] or (self.bytes_per_sec is None and self.bytes_per_sec_per_host is None):
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._global_bytes is not None:
+                self._global_bytes.take(event["bytes"], now)
+            host_bytes = self._get_host_bucket(self._host_bytes, self.bytes_per_sec_per_host, event["host"])
+            if host_bytes is not None:
+                host_bytes.take(event["bytes"], now)
+
+
+class ContentFilter:
+    """
+    This is a class for deciding which urls and responses are worth downloading, so junk is dropped before its bytes
+    cross the wire or touch the disk. It checks in two stages:
+        preflight: the mimetype guessed from the extension of the url (see guess_url_mimetype), before any request.
+            An url without a known extension passes, its response headers decide.
+        headers: the Content-Type and the size (Content-Length, or the total of a Content-Range) as soon as the
+            response headers arrive. A rejected response is closed without reading its body.
+    A body without a size in its headers is cut off once it grows beyond max_size, and one smaller than min_size is not saved.
+
+    Attributes:
+        allowed_types (tuple): the allowed mimetypes; an entry ending with "/" or "/*" allows the whole type,
+            e.g. "image/". None allows every type.
+        min_size (int): the min size of a body in bytes, None for no limit.
+        max_size (int): the max size of a body in bytes, None for no limit.
+        preflight (boolean): whether urls are checked by their extension before they are requested.
+        allow_missing_type (boolean): whether a response without a Content-Type passes.
+    """
+    def __init__(self,
+                 allowed_types: Optional[Iterable[str]]=("image/",),
+                 min_size: Optional[int]=None,
+                 max_size: Optional[int]=None,
+                 preflight: bool=True,
+                 allow_missing_type: bool=True):
+        self.allowed_types = None if allowed_types is None else \
+            tuple(t.lower()[:-1] if t.endswith("/*") else t.lower() for t in allowed_types)
+        assert min_size is None or max_size is None or min_size <= max_size, "min_size should not exceed max_size"
+        self.min_size = min_size
+        self.max_size = max_size
+        self.preflight = preflight
+        self.allow_missing_type = allow_missing_type
+
+    def is_type_allowed(self, mimetype: str) -> bool:
+        if self.allowed_types is None:
+            return True
+        mimetype = mimetype.split(";", 1)[0].strip().lower()
+        return any(mimetype.startswith(t) if t.endswith("/") else mimetype == t for t in self.allowed_types)
+
+    def check_url(self, url: str) -> Optional[str]:
+        """
+        This function runs the preflight check of an url.
+
+        Parameters:
+            url (string)
+
+        Returns:
+            why the url is rejected (string), None if it passes
+        """
+        if not self.preflight or self.allowed_types is None:
+            return None
+        mimetype = guess_url_mimetype(url)
+        if mimetype is not None and not self.is_type_allowed(mimetype):
+            return "the url looks like {}".format(mimetype)
+        return None
+
+    def check_headers(self, content_type: Optional[str], size: Optional[int]) -> Optional[str]:
+        """
+        This function runs the header check of a response.
+
+        Parameters:
+            content_type (string): the Content-Type header, None if it is missing.
+            size (int): the size of the whole body from the headers, None if it is unknown.
+
+        Returns:
+            why the response is rejected (string), None if it passes
+        """
+        if content_type is None:
+            if not self.allow_missing_type:
+                return "no Content-Type"
+        elif not self.is_type_allowed(content_type):
+            return "Content-Type {}".format(content_type)
+        if size is not None:
+            return self.check_size(size)
+        return None
+
+    def check_size(self, size: int) -> Optional[str]:
+        if self.min_size is not None and size < self.min_size:
+            return "size {} is under {}".format(size, self.min_size)
+        if self.max_size is not None and size > self.max_size:
+            return "size {} is over {}".format(size, self.max_size)
+        return None
+
+
+def parse_content_length(value: Optional[str]) -> Optional[int]:
+    return int(value) if value and value.isdigit() else None
+
+
+class ResultColumns:
+    """
+    This is a class for a batch of finished urls stored column by column, collected by the writer of the pipeline.
+    The workers only pass plain rows; the log entries and the progress output are formatted once per batch
+    by URLDownloader_v2.write_results.
+
+    Attributes:
+        urls (list): the urls.
+        saved (array): 1 if the body is saved, else 0.
+        status_codes (array): the status code of the last attempt, 0 for connection errors and timeouts.
+        sizes (array): the bytes received by the last attempt.
+        elapsed (array): the secs of the last attempt.
+        messages (list): the stderr messages that come with the rows, e.g. the error report after err_tolerance_num errors.
+        outpaths (list): the output paths, None where a row does not give one.
+    """
+    __slots__ = ("urls", "saved", "status_codes", "sizes", "elapsed", "messages", "outpaths")
+
+    def __init__(self):
+        self.urls = []
+        self.saved = array("b")
+        self.status_codes = array("h")
+        self.sizes = array("q")
+        self.elapsed = array("f")
+        self.messages = []
+        self.outpaths = []
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def append(self, url: str, saved: bool, status_code: Optional[int], size: int=0, elapsed: float=0.0,
+               message: Optional[str]=None, outpath: Optional[str]=None):
+        self.urls.append(url)
+        self.outpaths.append(outpath)
+        self.saved.append(1 if saved else 0)
+        self.status_codes.append(status_code or 0)
+        self.sizes.append(size)
+        self.elapsed.append(elapsed)
+        if message is not None:
+            self.messages.append(message)
+
+    def clear(self):
+        self.urls.clear()
+        del self.saved[:], self.status_codes[:], self.sizes[:], self.elapsed[:]
+        self.messages.clear()
+        self.outpaths.clear()
+
+
+class DownloadResult:
+    """
+    This is a class for the outcome of one url, yielded by URLDownloader_v2.iter_downloads once the url is logged.
+
+    Attributes:
+        url (string): the url.
+        outpath (string): the output path of the body, which is the key of the body for a StorageBackend other than FileStorage.
+        ok (boolean): whether the body is saved.
+        status_code (int): the status code of the last attempt, None for connection errors, timeouts and expired deadlines.
+        size (int): the bytes received by the last attempt.
+        elapsed (float): the secs of the last attempt.
+        finished_time (float): the time.time() when the url was logged.
+        body (bytes): the saved body, read through the storage backend if iter_downloads is asked to, else None.
+    """
+    __slots__ = ("url", "outpath", "ok", "status_code", "size", "elapsed", "finished_time", "body")
+
+    def __init__(self, url: str, outpath: Optional[str], ok: bool, status_code: Optional[int], size: int=0,
+                 elapsed: float=0.0, finished_time: float=0.0, body: Optional[bytes]=None):
+        self.url = url
+        self.outpath = outpath
+        self.ok = ok
+        self.status_code = status_code
+        self.size = size
+        self.elapsed = elapsed
+        self.finished_time = finished_time
+        self.body = body
+
+    def __repr__(self) -> str:
+        return "DownloadResult(url={!r}, ok={}, status_code={}, size={})".format(self.url, self.ok, self.status_code, self.size)
+
+    @classmethod
+    def from_columns(cls, columns: ResultColumns) -> List["DownloadResult"]:
+        """
+        This function turns a batch of finished urls into result records.
+
+        Parameters:
+            columns (ResultColumns): the finished urls.
+
+        Returns:
+            the records (list of DownloadResult)
+        """
+        now = time.time()
+        return [cls(url, outpath, bool(saved), status_code or None, size, elapsed, now)
+                for url, outpath, saved, status_code, size, elapsed
+                in zip(columns.urls, columns.outpaths, columns.saved, columns.status_codes, columns.sizes, columns.elapsed)]
+
+
+class DownloadTask:
+    """
+    This is a class for one url going through the download pipeline.
+
+    Attributes:
+        url (string): the url to download.
+        outpath (string): the output path to save the content.
+        host (string): the host of the url.
+        attempt (int): the number of attempts made so far.
+        segment (tuple): (PartialDownload, segment index) for a segment of a large body, None for a whole url.
+        seq (int): the position of the url in the input, set by HostScheduler.
+        priority (float): the priority of the url, higher goes first.
+        deadline (float): the time.monotonic() after which the url is not dispatched any more, None for no deadline.
+    """
+    __slots__ = ("url", "outpath", "host", "attempt", "segment", "seq", "priority", "deadline")
+
+    def __init__(self, url: str, outpath: str, attempt: int=0, segment: Optional[Tuple["PartialDownload", int]]=None,
+                 seq: int=0, priority: float=0, deadline: Optional[float]=None):
+        self.url = url
+        self.outpath = outpath
+        # interned, the tasks of a host held by HostScheduler share one string
+        self.host = sys.intern(get_host(url))
+        self.attempt = attempt
+        self.segment = segment
+        self.seq = seq
+        self.priority = priority
+        self.deadline = deadline
+
+    def __lt__(self, other: "DownloadTask") -> bool:
+        return self.url < other.url
+
+
+class HostScheduler:
+    """
+    This is a class for choosing the order in which urls are dispatched.
+    It reads up to [window] tasks ahead of the dispatcher into one queue per host and hands out the task with the
+    highest priority, then the earliest deadline; between hosts whose next tasks are equal the host served least
+    recently goes first, so the urls of one host are interleaved with the other hosts instead of queueing on its limits,
+    and within a host the urls keep their input order. A host that cannot start a download now is skipped and keeps its turn.
+    The order only depends on the input and on which hosts can start, never on hashes or timing, so runs are reproducible.
+    Priorities and deadlines only reorder the tasks inside the window; a window of None reads the whole input ahead.
+    A task whose deadline passes before it is dispatched is moved to [expired] instead.
+
+    Attributes:
+        window (int): the max number of tasks held by the scheduler, None for no limit.
+        exhausted (boolean): whether the input is read to the end.
+        expired (deque): the tasks whose deadline passed, taken out by the caller.
+    """
+    def __init__(self,
+                 tasks: Iterator[DownloadTask],
+                 window: Optional[int]=65536,
+                 priority_fn: Optional[Callable[[str], float]]=None,
+                 deadline_fn: Optional[Callable[[str], Optional[float]]]=None):
+        """
+        The constructor for HostScheduler Class.
+
+        Parameters:
+            tasks (iterator): the tasks of the input, in input order.
+            window (int): the max number of tasks held by the scheduler, None for no limit.
+            priority_fn (callable): called with an url, returns its priority (float, higher goes first). None gives every url 0.
+            deadline_fn (callable): called with an url, returns the secs after the start of the run after which the url
+                is not dispatched any more, or None for no deadline. None gives no url a deadline.
+
+        Returns:
+            The HostScheduler object
+        """
+        assert window is None or window > 0, "window should be positive"
+        self.window = window
+        self.exhausted = False
+        self.expired = collections.deque()
+        self._tasks = tasks
+        self._priority_fn = priority_fn
+        self._deadline_fn = deadline_fn
+        self._start = time.monotonic()
+        self._num_read = 0
+        self._num_tasks = 0
+        self._turn = 0
+        # host -> heap of (task key..., task), flat so a held task costs one tuple; host -> its valid entry in _heap
+        self._queues = {}
+        self._entries = {}
+        # (-priority, deadline, turn, host) of the next task of every host, with stale entries skipped on pop
+        self._heap = []
+
+    def __len__(self) -> int:
+        return self._num_tasks
+
+    @staticmethod
+    def _get_item(task: DownloadTask) -> Tuple:
+        deadline = float("inf") if task.deadline is None else task.deadline
+        return -task.priority, deadline, task.seq, task.segment[1] if task.segment is not None else -1, task
+
+    def _push_entry(self, host: str, turn: int):
+        item = self._queues[host][0]
+        entry = (item[0], item[1], turn, host)
+        self._entries[host] = entry
+        heapq.heappush(self._heap, entry)
+
+    def push(self, task: DownloadTask):
+        """
+        This function adds a task, e.g. a retry or a segment, which keeps the place of its url.
+
+        Parameters:
+            task (DownloadTask): the task.
+
+        Returns:
+            None
+        """
+        item = self._get_item(task)
+        host_queue = self._queues.get(task.host)
+        self._num_tasks += 1
+        if host_queue is None:
+            self._queues[task.host] = [item]
+            self._push_entry(task.host, self._next_turn())
+            return
+        heapq.heappush(host_queue, item)
+        if host_queue[0] is item:
+            self._push_entry(task.host, self._entries[task.host][2])
+
+    def _next_turn(self) -> int:
+        self._turn += 1
+        return self._turn
+
+    def _fill(self):
+        while not self.exhausted and (self.window is None or self._num_tasks < self.window):
+            task = next(self._tasks, None)
+            if task is None:
+                self.exhausted = True
+                return
+            task.seq = self._num_read
+            self._num_read += 1
+            if self._priority_fn is not None:
+                task.priority = self._priority_fn(task.url)
+            if self._deadline_fn is not None:
+                deadline = self._deadline_fn(task.url)
+                task.deadline = None if deadline is None else self._start + deadline
+            self.push(task)
+
+    def _pop(self, host: str) -> DownloadTask:
+        host_queue = self._queues[host]
+        task = heapq.heappop(host_queue)[-1]
+        self._num_tasks -= 1
+        if host_queue:
+            self._push_entry(host, self._next_turn())
+        else:
+            del self._queues[host]
+            del self._entries[host]
+        return task
+
+    def next(self, try_start: Callable[[str], bool]=lambda host: True) -> Optional[DownloadTask]:
+        """
+        This function takes the next task whose host can start a download.
+
+        Parameters:
+            try_start (callable): called with a host, returns whether a download of the host can start now and, if so,
+                takes its slot. Hosts are tried in scheduling order until one starts.
+
+        Returns:
+            the task (DownloadTask), None if no host can start now or no task is left
+        """
+        self._fill()
+        now = time.monotonic()
+        skipped = []
+        task = None
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            host = entry[3]
+            if self._entries.get(host) is not entry:
+                continue
+            if entry[1] <= now:
+                # the next task of the host is past its deadline, so it is not started
+                self.expired.append(self._pop(host))
+                continue
+            if try_start(host):
+                task = self._pop(host)
+                break
+            skipped.append(entry)
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return task
+
+
+class _DownloadPipeline:
+    """
+    This is a class for running the downloads of URLDownloader_v2 as a continuous producer/consumer pipeline.
+    The calling thread dispatches tasks into a bounded work queue, [num_thread] workers download them,
+    and one writer thread appends every finished url to the log as soon as it arrives.
+    There is no batch barrier, so a slow url only occupies its own worker.
+    The bodies are saved on the threads of an IOPool (see URLDownloader_v2 io_threads), whose futures report the url.
+    With a processor the bodies go to the worker processes of a ProcessingStage first, which save and report them.
+    The dispatcher takes the urls in the order of a HostScheduler: round-robin between hosts, by priority and deadline.
+    A failed attempt that the retry policy wants to repeat goes back to the dispatcher with a ready time,
+    and the dispatcher keeps other urls flowing until it is due, so no worker sleeps on a backoff.
+    The segments of a large body (see URLDownloader_v2 segment_size) go back to the dispatcher the same way,
+    so they are downloaded in parallel by the workers; the last finished segment reports the url.
+
+    Attributes:
+        downloader (URLDownloader_v2): the downloader that owns the settings, the session and the resume index.
+        work_queue (Queue): the bounded queue of tasks waiting for a worker.
+        result_queue (Queue): the bounded queue of finished results waiting for the writer, so a writer that waits for
+            the consumer of iter_downloads holds back the workers.
+        retry_queue (Queue): the queue of (ready time, task) of the failed attempts to repeat.
+        wakeup (Event): set by the workers when a task finishes, wakes up the dispatcher.
+        num_dispatched (int): the number of urls dispatched, retries excluded.
+        num_retries (int): the number of retries dispatched.
+        num_expired (int): the number of urls not dispatched because their deadline passed.
+    """
+    def __init__(self, downloader: "URLDownloader_v2", queue_size: int):
+        self.downloader = downloader
+        self.work_queue = queue.Queue(maxsize=max(queue_size, 1))
+        self.result_queue = queue.Queue(maxsize=max(queue_size, downloader.num_thread))
+        self.retry_queue = queue.Queue()
+        self.wakeup = threading.Event()
+        self.num_dispatched = 0
+        self.num_retries = 0
+        self.num_expired = 0
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+        self._next_ready = float("inf")
+
+    def run(self, tasks: Iterable[Tuple[str, str]]):
+        """
+        This function downloads every task and returns when all of them are logged.
+
+        Parameters:
+            tasks (iterable): an iterable of (url, outpath).
+
+        Returns:
+            None
+        """
+        workers = [threading.Thread(target=self._work, name="downloader-worker-{}".format(i), daemon=True)
+                   for i in range(self.downloader.num_thread)]
+        writer = threading.Thread(target=self._write, name="downloader-writer", daemon=True)
+        downloader = self.downloader
+        metrics = downloader.metrics
+        metrics.queue_depth = self.work_queue.qsize
+        io_pool = IOPool(downloader.io_threads) if downloader.io_threads > 0 else None
+        downloader.io_pool = io_pool
+        metrics.set_stage("download", downloader.num_thread)
+        metrics.set_stage("save", downloader.io_threads or downloader.num_thread)
+        processing = None
+        if downloader.processor is not None:
+            processing = ProcessingStage(downloader.processor, downloader.process_workers, metrics,
+                                         downloader.process_max_pending)
+            metrics.set_stage("process", processing.num_process, lambda: processing.num_pending)
+        downloader.processing = processing
+        for thread in workers + [writer]:
+            thread.start()
+        scheduler = HostScheduler((DownloadTask(url, outpath) for url, outpath in tasks), downloader.schedule_window,
+                                  downloader.priority_fn, downloader.deadline_fn)
+        try:
+            self._dispatch(scheduler)
+        except BaseException:
+            self._drop_queued_tasks()
+            raise
+        finally:
+            for _ in workers:
+                self.work_queue.put(None)
+            for thread in workers:
+                thread.join()
+            if processing is not None:
+                # the rows of the bodies still processed are put by their futures
+                processing.shutdown()
+                downloader.processing = None
+            if io_pool is not None:
+                # the rows of the saves still running are put by their futures
+                io_pool.shutdown()
+                self.downloader.io_pool = None
+            self.result_queue.put(None)
+            writer.join()
+
+    def _dispatch(self, scheduler: HostScheduler):
+        retries = []
+        while True:
+            if self.downloader.stop_event.is_set():
+                # see URLDownloader_v2.stop, the urls in flight still finish and are logged
+                self._drop_queued_tasks()
+                return
+            self.wakeup.clear()
+            while True:
+                try:
+                    heapq.heappush(retries, self.retry_queue.get_nowait())
+                except queue.Empty:
+                    break
+            now = time.monotonic()
+            while retries and retries[0][0] <= now:
+                scheduler.push(heapq.heappop(retries)[1])
+            task = None
+            self._next_ready = float("inf")
+            if self.downloader.paused_until > now:
+                # too many consecutive errors, see format_result
+                self._next_ready = self.downloader.paused_until
+            elif self.downloader.host_limiter.has_capacity() and not self._rate_limited_and_busy():
+                rate_wait = 0.0 if self.downloader.rate_limiter is None else self.downloader.rate_limiter.get_global_wait()
+                if rate_wait > 0:
+                    self._next_ready = now + rate_wait
+                else:
+                    task = scheduler.next(self._try_start)
+            while scheduler.expired:
+                self._expire(scheduler.expired.popleft())
+            if task is not None:
+                with self._in_flight_lock:
+                    self._in_flight += 1
+                # counted before the put, a worker increments task.attempt as soon as it takes the task
+                if task.attempt:
+                    self.num_retries += 1
+                elif task.segment is None:
+                    self.num_dispatched += 1
+                self.work_queue.put(task)
+                continue
+            with self._in_flight_lock:
+                in_flight = self._in_flight
+            if scheduler.exhausted and not scheduler and not retries and not in_flight and self.retry_queue.empty():
+                return
+            # nothing can go now: wait for a worker to finish, the next retry to be due or a rate limit to refill
+            ready = min(retries[0][0] if retries else float("inf"), self._next_ready)
+            self.wakeup.wait(timeout=min(max(ready - now, 0), 1))
+
+    def _expire(self, task: DownloadTask):
+        self.num_expired += 1
+        if task.segment is not None:
+            self._resolve_segment(task.segment[0], False, None)
+        else:
+            self.result_queue.put(self.downloader.make_expired_row(task.url, task.outpath))
+
+    def _rate_limited_and_busy(self) -> bool:
+        # under a rate limit a url is dispatched only when a worker is free, so its tokens are taken when it starts
+        # and the bytes of the urls before it are already charged
+        if self.downloader.rate_limiter is None:
+            return False
+        with self._in_flight_lock:
+            return self._in_flight >= self.downloader.num_thread
+
+    def _try_start(self, host: str) -> bool:
+        host_limiter = self.downloader.host_limiter
+        rate_limiter = self.downloader.rate_limiter
+        if not host_limiter.try_acquire(host):
+            return False
+        if rate_limiter is not None:
+            wait = rate_limiter.try_acquire(host)
+            if wait > 0:
+                host_limiter.release(host)
+                self._next_ready = min(self._next_ready, time.monotonic() + wait)
+                return False
+        return True
+
+    def _drop_queued_tasks(self):
+        while True:
+            try:
+                task = self.work_queue.get_nowait()
+            except queue.Empty:
+                return
+            if task is not None:
+                self.downloader.host_limiter.release(task.host)
+
+    def _work(self):
+        downloader = self.downloader
+        while True:
+            task = self.work_queue.get()
+            if task is None:
+                return
+            # a task queued before the dispatcher paused waits for the pause too, see format_result
+            pause = downloader.paused_until - time.monotonic()
+            while pause > 0:
+                time.sleep(pause)
+                pause = downloader.paused_until - time.monotonic()
+            downloader.metrics.worker_started()
+            try:
+                task.attempt += 1
+                if task.segment is not None:
+                    saved, status_code, retry_after = downloader.fetch_segment(*task.segment)
+                else:
+                    saved, status_code, retry_after = downloader.fetch(task.url, task.outpath,
+                                                                       functools.partial(self._schedule_segments, task))
+                if saved is None:
+                    # the segments of a large body are scheduled, the last one of them reports the url
+                    pass
+                elif not saved and downloader.retry_policy is not None \
+                        and not (task.segment is not None and task.segment[0].invalid) \
+                        and downloader.retry_policy.should_retry(status_code, task.attempt):
+                    delay = downloader.retry_policy.get_delay(task.attempt, retry_after)
+                    downloader.metrics.record_retry()
+                    self.retry_queue.put((time.monotonic() + delay, task))
+                elif task.segment is not None:
+                    self._resolve_segment(task.segment[0], saved, status_code)
+                elif isinstance(saved, concurrent.futures.Future):
+                    # the body is received, the url is reported once the io_pool (or the processor) has saved it
+                    set_to_zero_thread_local_err_cntr()
+                    saved.add_done_callback(functools.partial(self._report_save, task.url, task.outpath, status_code,
+                                                              thread_local.last_attempt))
+                else:
+                    self.result_queue.put(downloader.make_result_row(task.url, saved, status_code, outpath=task.outpath))
+            except Exception:
+                # an unexpected error is not logged as a failed url, so the url is tried again on the next run
+                logger.exception(f"Unexpected error when downloading {task.url}")
+                if task.segment is not None:
+                    # the other segments still report the url, as an error
+                    self._resolve_segment(task.segment[0], False, None)
+            finally:
+                downloader.metrics.worker_finished()
+                downloader.host_limiter.release(task.host)
+                with self._in_flight_lock:
+                    self._in_flight -= 1
+                self.wakeup.set()
+
+    def _report_save(self, url: str, outpath: str, status_code: Optional[int], last_attempt: Tuple[int, float],
+                     future: concurrent.futures.Future):
+        try:
+            saved = future.result()
+        except Exception:
+            # as in _work, the url is not logged as a failed url, so it is tried again on the next run
+            logger.exception(f"Unexpected error when saving {url}")
+            return
+        self.result_queue.put(self.downloader.make_result_row(url, saved, status_code, last_attempt, outpath))
+
+    def _schedule_segments(self, parent: DownloadTask, partial: "PartialDownload", indexes: List[int]):
+        # the segments keep the place, priority and deadline of their url
+        ready = time.monotonic()
+        for index in indexes:
+            self.retry_queue.put((ready, DownloadTask(partial.url, partial.outpath, segment=(partial, index), seq=parent.seq,
+                                                      priority=parent.priority, deadline=parent.deadline)))
+
+    def _resolve_segment(self, partial: "PartialDownload", ok: bool, status_code: Optional[int]):
+        done = partial.resolve_segment(ok, status_code)
+        if done is not None:
+            self.result_queue.put(self.downloader.finish_segments(partial, done))
+
+    def _write(self):
+        columns = ResultColumns()
+        stopping = False
+        while not stopping:
+            row = self.result_queue.get()
+            while True:
+                if row is None:
+                    stopping = True
+                    break
+                columns.append(*row)
+                try:
+                    row = self.result_queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.downloader.write_results(columns)
+            if self.downloader.result_sink is not None:
+                self.downloader.result_sink(columns)
+            columns.clear()
+        print("\n", end="", file=sys.stderr, flush=True)
+
+
+class URLDownloader_v2:
+    """ 
+    This is a class for downloading a batch of urls via http connection.
+      
+    Attributes: 
+        url_list (list): the urls that still need to be downloaded, built from the input on every access.
         local_output_path (string): the path to the output folder /
-        output_path_list (list): appending the outname with outpath.
+        output_path_list (list): the output paths of url_list, built from the input on every access.
         num_thread (int): the number of thread used for download.
         err_tolerance_num (int): the number of error tolerance for downloading.
         stop_interval (int): the secs to stop after error number exceeds the  err_tolerance_num
@@ -307,174 +3908,1079 @@ class URLDownloader_v2:
         output_name_list (list): the list for the output file name. The default behaviour is using the file name in the url. If this is specified, it will overwrite the default name.
         err_cnter (int): counter for counting consecutive errors.
         log_file (string): a file name for logging, saving inside the out_path.
+        shard_index (int): the shard downloaded by this object, None if the input is not sharded.
+        shard_count (int): the number of shards.
+        stream (boolean): whether to stream response bodies to disk instead of buffering them in memory.
+        chunk_size (int): the size of the reusable buffer used in stream mode.
+        max_bytes_per_file (int): the byte cap of a single file in stream mode. None means no limit.
+        session (requests.Session): the session shared by all threads, with one connection pool per host.
+        pool_stats (ConnectionPoolStats): the usage counters of the connection pools.
+        host_limiter (HostConcurrencyLimiter): the per-host limit of downloads in flight, an AdaptiveConcurrencyLimiter in adaptive mode.
+        retry_policy (RetryPolicy): how failed attempts are retried. None means no retry.
+        rate_limiter (RateLimiter): the request and byte rates the dispatcher keeps to, None means no limit.
+        paused_until (float): the time.monotonic() until which no url is dispatched, after err_tolerance_num consecutive errors.
+        content_store (ContentStore): the content-addressed store of the bodies, None if it is not used.
+        http_cache (HttpCache): the saved validators of the urls, None if it is not used.
+        refresh (boolean): whether urls in the log are fetched again with conditional requests.
+        max_age (float): in refresh mode, the age in secs under which an url is not fetched again.
+        metrics (DownloadMetrics): the throughput, latency, status and per-host metrics of this downloader.
+        resume_partial (boolean): whether interrupted downloads continue with Range requests.
+        segment_size (int): the size of the range requests of a large body, None if bodies are not segmented.
+        log_fsync (string): the fsync policy of the log, see LogWriter.
+        storage (StorageBackend): where the bodies are saved, a FileStorage by default.
+        io_threads (int): the number of threads that save the bodies, 0 if the workers save them.
+        io_pool (IOPool): the threads that save the bodies while a pipeline runs, None otherwise.
+        name_collision (string): "rename" or "overwrite", what happens when two urls get the same output path.
+        priority_fn (callable): the priority of an url, None if every url has the same priority.
+        deadline_fn (callable): the deadline of an url in secs after the start of a run, None if no url has one.
+        schedule_window (int): the number of urls the scheduler reads ahead of the dispatcher, see HostScheduler.
+        content_filter (ContentFilter): which urls and responses are downloaded, None if everything is.
+        processor (callable): the function that processes every body in a worker process before it is saved, None if bodies are saved as they are.
+        process_workers (int): the number of worker processes of the processor.
+        process_max_pending (int): the max number of bodies waiting for or in processing, None for 2 * process_workers.
+        processing (ProcessingStage): the worker processes of the processor while a pipeline runs, None otherwise.
+        processing_dir (string): the folder of the temp files handed to the processor.
+        result_sink (callable): called by the writer with every batch of logged urls (ResultColumns), see iter_downloads.
+        stop_event (Event): set by stop to end the running download early.
     """
     def __init__(self,
-                 url_list: List,
+                 url_list: Union[Iterable, str],
                  local_output_path: str,
                  num_thread: int=4,
                  err_tolerance_num: int=1000,
                  stop_interval: int=0,
                  timeout: int=600,
                  http_headers: Dict={},
-                 output_name_list: Optional[List]=None,
+                 output_name_list: Optional[Iterable]=None,
                  verbose: bool=True,
-                 custom_img_saver: Optional[Callable[[str, bytes], None]]=None
+                 custom_img_saver: Optional[Callable[[str, bytes], None]]=None,
+                 stream: bool=False,
+                 chunk_size: int=1 << 16,
+                 max_bytes_per_file: Optional[int]=None,
+                 custom_stream_saver: Optional[Callable[[str, Iterator[memoryview]], None]]=None,
+                 pool_num_hosts: int=64,
+                 pool_maxsize_per_host: int=16,
+                 max_connections_per_host: Optional[int]=None,
+                 keep_alive: bool=True,
+                 max_in_flight_per_host: Optional[int]=None,
+                 retry_policy: Optional[RetryPolicy]=None,
+                 rate_limiter: Optional[RateLimiter]=None,
+                 content_store: bool=False,
+                 content_link_mode: str="hardlink",
+                 http_cache: bool=False,
+                 refresh: bool=False,
+                 max_age: Optional[float]=None,
+                 metrics_file: Optional[str]=None,
+                 metrics_interval: float=10,
+                 prometheus_port: Optional[int]=None,
+                 adaptive_concurrency: bool=False,
+                 min_thread: int=1,
+                 adaptive_per_host: bool=False,
+                 shard_index: Optional[int]=None,
+                 shard_count: int=1,
+                 resume_partial: bool=False,
+                 segment_size: Optional[int]=None,
+                 log_format: str="text",
+                 log_flush_interval: float=1.0,
+                 log_batch_size: int=1024,
+                 log_fsync: str="none",
+                 storage: Optional[StorageBackend]=None,
+                 io_threads: int=4,
+                 name_collision: str="rename",
+                 priority_fn: Optional[Callable[[str], float]]=None,
+                 deadline_fn: Optional[Callable[[str], Optional[float]]]=None,
+                 schedule_window: Optional[int]=65536,
+                 content_filter: Optional[ContentFilter]=None,
+                 processor: Optional[Callable[[str, str], Optional[bool]]]=None,
+                 process_workers: Optional[int]=None,
+                 process_max_pending: Optional[int]=None
                  ):
         """ 
         The constructor for URLDownloader Class. It saves the parameters as attributes, set some attributes, and call update_downloading_status
         
         Parameters: 
-            url_list (list): a list of url to download.
+            url_list (iterable or string): the urls to download, or the path to a newline/JSONL/CSV manifest (see iter_manifest).
+                The input is read lazily, so pass a list or a manifest path rather than a one-shot iterator if it is read more than once.
+                Without output names, duplicated urls are dropped in input order.
             local_output_path (string): the path to the output folder
             num_thread (int): the number of thread used for download.
             err_tolerance_num (int): the number of error tolerance for downloading.
             stop_interval (int): the secs to stop after error number exceeds the  err_tolerance_num
             timeout (int): the time limit for http GET
             http_headers (dict): the header for http.
-            output_name_list (list): the list for the output file name. The default behaviour is using the file name in the url. If this is specified, it will overwrite the default name.
-                    
+            output_name_list (iterable): the output file names, read in step with url_list. The default behaviour is using the file name in the url. If this is specified, it will overwrite the default name.
+            verbose (boolean): whether to print the progress to stderr.
+            custom_img_saver (callable): a function called with (outpath, response) to save the response instead of the default writer.
+            stream (boolean): whether to stream response bodies to disk instead of buffering them in memory.
+                The peak memory for bodies is then bounded by num_thread * chunk_size.
+            chunk_size (int): the size of the reusable buffer used in stream mode.
+            max_bytes_per_file (int): the byte cap of a single file in stream mode, larger files are dropped and logged as errors. None means no limit.
+            custom_stream_saver (callable): the stream mode variant of custom_img_saver. It is called with (outpath, chunks),
+                where chunks is an iterator of memoryview objects that are only valid until the next chunk is read.
+            pool_num_hosts (int): the number of per-host connection pools to keep.
+            pool_maxsize_per_host (int): the number of idle connections to keep per host.
+            max_connections_per_host (int): the hard limit of open connections per host. None means no limit.
+            keep_alive (boolean): whether to keep connections open between requests.
+            max_in_flight_per_host (int): the max number of downloads of one host in flight, the scheduler dispatches
+                urls of other hosts instead of letting one slow host occupy every thread. None means no limit.
+            retry_policy (RetryPolicy): how failed attempts are retried before an url is logged as an error. None means no retry.
+            rate_limiter (RateLimiter): the global and per-host request and byte rates to keep to, see RateLimiter. None means no limit.
+            content_store (boolean): whether to store bodies by content hash, see ContentStore. Each unique body is stored
+                once under local_output_path/blobs and urls with the same bytes share it. It cannot be used with custom savers.
+            content_link_mode (string): "hardlink" to hardlink the output paths to their blobs, "none" to only record
+                url -> hash in local_output_path/content.index.
+            http_cache (boolean): whether to save the ETag, Last-Modified, size and fetch time of every url in
+                local_output_path/http_cache.jsonl, see HttpCache.
+            refresh (boolean): whether to fetch urls again even if they are in the log. Saved files are requested with
+                If-None-Match/If-Modified-Since and a 304 counts as a success without rewriting the file. It implies http_cache.
+            max_age (float): in refresh mode, urls fetched less than [max_age] secs ago are skipped without any request.
+            metrics_file (string): the path to a JSON-lines file that gets a metrics snapshot every [metrics_interval] secs while downloading.
+            metrics_interval (float): the secs between two snapshots in metrics_file.
+            prometheus_port (int): serve the metrics in the Prometheus text format on http://127.0.0.1:[port]/metrics.
+            adaptive_concurrency (boolean): whether to tune the number of downloads in flight at runtime between [min_thread]
+                and [num_thread] from the observed latency and throttling, see AdaptiveConcurrencyLimiter.
+            min_thread (int): the lower bound of the adaptive limit.
+            adaptive_per_host (boolean): in adaptive mode, whether every host also gets its own limit.
+            shard_index (int): only download the urls of this shard, see get_shard_of_url. The shard gets its own log
+                downloaded.shard-<index>-of-<count>.log (and http cache), so shards can run in separate processes or on
+                separate nodes that share local_output_path, see run_sharded and merge_shard_logs.
+            shard_count (int): the number of shards the input is split into.
+            resume_partial (boolean): whether to keep the .part file of an interrupted download with its state
+                (see PartialDownload) and continue it with a Range request on the next attempt or run. It needs stream=True.
+            segment_size (int): split bodies larger than [segment_size] bytes into range requests that the workers
+                download in parallel. It needs stream=True and implies resume_partial. None means no segmentation.
+            log_format (string): the format of a new log, "text" (url\tstatus lines) or "binary" (length-prefixed
+                records with the url fingerprint, faster to load on resume), see LogReader. An existing log keeps its format.
+            log_flush_interval (float): the max secs a finished url waits in the log buffer, see LogWriter.
+            log_batch_size (int): the number of buffered log entries that triggers a write of the log.
+            log_fsync (string): "none", "log" to fsync the log on every write, or "data" to also fsync every saved
+                file before its url is logged, so a logged url has its data on disk even after a power loss.
+            storage (StorageBackend): where the bodies are saved: FileStorage (one file per url, the default),
+                TarShardStorage (tar shards with an offset index) or S3Storage (an S3-compatible object store).
+                resume_partial, segment_size, content_store and the custom savers need a FileStorage.
+            io_threads (int): the number of threads that save the bodies, so a worker goes back to the network as soon
+                as a body is received, see IOPool. In stream mode the chunks are still written by the worker and the
+                commit runs on the I/O threads. 0 saves on the workers.
+            name_collision (string): "rename" gives an url whose output path is already taken by another url of the
+                input the name [stem].[8 hex digits of the url fingerprint][ext], "overwrite" lets the later url
+                overwrite the file. The first url in input order keeps the name, so the names are the same in every run.
+            priority_fn (callable): called with an url, returns its priority (float). Urls with a higher priority are
+                dispatched first, among the [schedule_window] urls read ahead. None gives every url the priority 0.
+            deadline_fn (callable): called with an url, returns the secs after the start of the run after which the url is
+                not dispatched any more, or None for no deadline. Urls of the same priority go by earliest deadline, and an
+                url whose deadline passes before it is dispatched is logged as an error, so retry_failed can fetch it later.
+            schedule_window (int): the number of urls read ahead of the dispatcher and interleaved round-robin between
+                their hosts, see HostScheduler. None reads the whole input ahead, 1 dispatches in input order.
+            content_filter (ContentFilter): drops urls whose extension is not an allowed type before any request, and
+                closes responses whose Content-Type or size is not allowed as soon as their headers arrive, see ContentFilter.
+                Urls dropped before the request are not logged and are checked again on every run, rejected responses are
+                logged as errors. The requests are streamed, so a rejected body is never read.
+            processor (callable): called with (url, path) in a worker process for every downloaded body, where path is a
+                temp file with the body. It changes the file in place (decode, resize, verify, convert...) and returns
+                False to reject the body, which is then logged as an error; an exception is logged as an error too.
+                The processed file is saved through the storage backend. It runs in spawned processes, so it must be
+                picklable, e.g. a function at module level. See ProcessingStage.
+            process_workers (int): the number of worker processes of the processor, None for os.cpu_count().
+            process_max_pending (int): the max number of bodies waiting for or in processing; the download workers
+                wait when it is reached. None means 2 * process_workers.
+
         Returns: 
             The URLDownloader object
         """
-        self.local_output_path = local_output_path
-        if output_name_list:
-            assert(len(url_list) == len(output_name_list))
-            self.output_path_list = [os.path.join(local_output_path, "data", name) for name in output_name_list]
+        self.local_output_path = local_output_path
+        if hasattr(output_name_list, "__len__") and len(output_name_list) == 0:
+            # an empty list means the default names, as it always did
+            output_name_list = None
+        if output_name_list is not None and hasattr(url_list, "__len__") and hasattr(output_name_list, "__len__"):
+            assert(len(url_list) == len(output_name_list))
+        self.url_source = url_list
+        self.output_name_source = output_name_list
+
+        self.num_thread = num_thread
+        self.err_tolerance_num = err_tolerance_num
+        self.stop_interval = stop_interval
+        self.timeout = timeout
+        self.http_headers = http_headers
+        self.verbose = verbose
+        self.custom_img_saver = custom_img_saver
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_bytes_per_file = max_bytes_per_file
+        self.custom_stream_saver = custom_stream_saver
+        self.keep_alive = keep_alive
+        self.max_connections_per_host = max_connections_per_host
+        self.resume_partial = resume_partial or bool(segment_size)
+        self.segment_size = segment_size
+        if self.resume_partial:
+            assert stream, "resume_partial and segment_size need stream=True"
+            assert not (custom_img_saver or custom_stream_saver or content_store), \
+                "resume_partial and segment_size cannot be used with custom savers or content_store"
+            assert storage is None or isinstance(storage, FileStorage), "resume_partial and segment_size need a FileStorage"
+        if storage is not None and not isinstance(storage, FileStorage):
+            assert not (custom_img_saver or custom_stream_saver or content_store), \
+                "custom savers and content_store cannot be used with a storage other than FileStorage"
+        if processor is not None:
+            assert not (custom_img_saver or custom_stream_saver), "processor cannot be used with custom savers"
+            assert not self.resume_partial, "processor cannot be used with resume_partial or segment_size"
+        assert name_collision in ("rename", "overwrite"), "name_collision should be rename or overwrite"
+        self.name_collision = name_collision
+        self.priority_fn = priority_fn
+        self.deadline_fn = deadline_fn
+        self.schedule_window = schedule_window
+        self.content_filter = content_filter
+        self.pool_stats = ConnectionPoolStats()
+        self.session = create_shared_session(http_headers, self.pool_stats, pool_num_hosts, pool_maxsize_per_host,
+                                             max_connections_per_host, keep_alive)
+        if adaptive_concurrency:
+            self.host_limiter = AdaptiveConcurrencyLimiter(min_thread, num_thread, per_host=adaptive_per_host,
+                                                           max_per_host=max_in_flight_per_host)
+        else:
+            self.host_limiter = HostConcurrencyLimiter(max_in_flight_per_host)
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.paused_until = 0.0
+
+        self.err_cnter = 0
+        self.url_cnter = 0
+        self.num_written = 0
+        if shard_index is not None:
+            assert 0 <= shard_index < shard_count, "shard_index should be in [0, shard_count)"
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        shard_suffix = get_shard_suffix(shard_index, shard_count) if shard_index is not None else ""
+        self.log_file = os.path.join(local_output_path, "downloaded{}.log".format(shard_suffix))
+        data_path = os.path.join(local_output_path, "data")
+        if not os.path.exists(data_path):
+            logger.info(f"Output folder is not exist, create folder: {data_path}")
+            # exist_ok: the shards of run_sharded create the folder at the same time
+            os.makedirs(data_path, exist_ok=True)
+        self.log_fsync = log_fsync
+        self.storage = storage or FileStorage()
+        self.storage.attach(data_path, shard_suffix)
+        self.io_threads = io_threads
+        self.io_pool = None
+        self.processor = processor
+        self.process_workers = process_workers or os.cpu_count() or 1
+        self.process_max_pending = process_max_pending
+        self.processing = None
+        self.result_sink = None
+        self.stop_event = threading.Event()
+        self.processing_dir = os.path.join(local_output_path, "processing{}".format(shard_suffix))
+        if processor is not None:
+            # the temp files left by an interrupted run are not in the log, their urls are downloaded again
+            shutil.rmtree(self.processing_dir, ignore_errors=True)
+            os.makedirs(self.processing_dir, exist_ok=True)
+        self.resume_index = ResumeIndex(self.log_file, log_format, log_flush_interval, log_batch_size, log_fsync)
+        self.content_store = None
+        if content_store:
+            assert not (custom_img_saver or custom_stream_saver), "content_store cannot be used with custom savers"
+            self.content_store = ContentStore(os.path.join(local_output_path, "blobs"),
+                                              os.path.join(local_output_path, "content.index"),
+                                              content_link_mode)
+        self.refresh = refresh
+        self.max_age = max_age
+        self.http_cache = None
+        if http_cache or refresh:
+            self.http_cache = HttpCache(os.path.join(local_output_path, "http_cache{}.jsonl".format(shard_suffix)))
+        self.metrics = DownloadMetrics()
+        if adaptive_concurrency:
+            self.metrics.add_hook(self.host_limiter.observe)
+        if rate_limiter is not None:
+            self.metrics.add_hook(rate_limiter.observe)
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        self.metrics_server = None
+        if prometheus_port is not None:
+            self.metrics_server = start_prometheus_server(self.metrics, prometheus_port)
+
+    def update_downloading_status(self):
+        """ 
+        The function to reload the downloading status from the log in the folder.
+        The resume index is kept up to date as urls finish, so this is only needed when another process wrote the log.
+
+        Parameters: 
+            None  
+
+        Returns: 
+            None
+        """
+        self.resume_index.load()
+
+    def iter_input(self) -> Iterator[Tuple[str, Optional[str]]]:
+        """
+        This function reads the input lazily.
+
+        Parameters:
+            None
+
+        Returns:
+            an iterator of (url, output_name), output_name is None when no name is given
+        """
+        items = self._iter_all_input()
+        if self.shard_index is None:
+            return items
+        return (item for item in items if get_shard_of_url(item[0], self.shard_count) == self.shard_index)
+
+    def _iter_all_input(self) -> Iterator[Tuple[str, Optional[str]]]:
+        if isinstance(self.url_source, str):
+            return iter_manifest(self.url_source)
+        if self.output_name_source is not None:
+            return zip(self.url_source, self.output_name_source)
+        return ((url, None) for url in self.url_source)
+
+    def iter_outpaths(self) -> Iterator[Tuple[str, int, bool, str]]:
+        """
+        This function reads the input lazily and gives every url its output path, logged or not.
+        With name_collision="rename" every output path is claimed by the first url of the input that gets it,
+        in a FingerprintTable of output path -> url fingerprint, and a later url gets a renamed path (see claim_outpath).
+        The claims cover the whole input before the shard filter, so the shards and the runs agree on the names.
+
+        Parameters:
+            None
+
+        Returns:
+            an iterator of (url, url fingerprint, whether the url has an output name, outpath)
+        """
+        claims = FingerprintTable() if self.name_collision == "rename" else None
+        data_path = os.path.join(self.local_output_path, "data")
+        for url, output_name in self._iter_all_input():
+            in_shard = self.shard_index is None or get_shard_of_url(url, self.shard_count) == self.shard_index
+            if claims is None and not in_shard:
+                continue
+            fp = url_fingerprint(url)
+            outpath = self.get_outpath_from_url(url) if output_name is None else os.path.join(data_path, output_name)
+            if claims is not None:
+                outpath = self.claim_outpath(claims, fp, outpath)
+            if in_shard:
+                yield url, fp, output_name is not None, outpath
+
+    @staticmethod
+    def claim_outpath(claims: FingerprintTable, fp: int, outpath: str) -> str:
+        """
+        This function claims an output path for an url, or renames it if another url claimed it first.
+
+        Parameters:
+            claims (FingerprintTable): output path fingerprint -> low 32 bits of the url fingerprint (0 is stored as 1).
+            fp (int): the url fingerprint.
+            outpath (string): the output path of the url.
+
+        Returns:
+            the output path (string): outpath, or [stem].[8 hex digits of fp][ext] if another url has it
+        """
+        tag = fp & 0xffffffff
+        path_fp = url_fingerprint(outpath)
+        owner = claims.get(path_fp)
+        if owner is None:
+            claims.set(path_fp, tag or 1)
+            return outpath
+        if owner == (tag or 1):
+            return outpath
+        stem, ext = os.path.splitext(outpath)
+        return "{}.{:08x}{}".format(stem, tag, ext)
+
+    def iter_pending(self) -> Iterator[Tuple[str, str]]:
+        """
+        This function reads the input lazily and yields the urls that still need to be downloaded, with the output
+        paths of iter_outpaths.
+        Urls without an output name are deduplicated; a url with output names that appears n times in the log
+        skips its first n occurrences. Both are tracked with FingerprintTable, so memory stays small per url.
+        In refresh mode the log is ignored and only urls fetched less than max_age secs ago are skipped.
+
+        Parameters:
+            None
+
+        Returns:
+            an iterator of (url, outpath)
+        """
+        seen_urls = FingerprintTable()
+        skips_left = FingerprintTable()
+        for url, fp, named, outpath in self.iter_outpaths():
+            if self.refresh:
+                if (not named and not seen_urls.add(fp)) or self.http_cache.is_fresh(url, self.max_age, fp):
+                    continue
+                yield url, outpath
+                continue
+            if not named:
+                if not seen_urls.add(fp) or self.resume_index.count(url, fp):
+                    continue
+                yield url, outpath
+                continue
+            # the stored value is (skips left + 1), so 0 still means the url is not seen in this pass
+            left = skips_left.get(fp)
+            left = self.resume_index.count(url, fp) if left is None else left - 1
+            if left > 0:
+                skips_left.set(fp, left)
+                continue
+            skips_left.set(fp, 1)
+            yield url, outpath
+
+    def iter_failed(self) -> Iterator[Tuple[str, str]]:
+        """
+        This function reads the input lazily and yields the urls whose latest log entry is an error.
+
+        Parameters:
+            None
+
+        Returns:
+            an iterator of (url, outpath)
+        """
+        seen_urls = FingerprintTable()
+        for url, fp, named, outpath in self.iter_outpaths():
+            if not named:
+                if seen_urls.add(fp) and self.resume_index.is_failed(url, fp):
+                    yield url, outpath
+            elif self.resume_index.is_failed(url, fp):
+                yield url, outpath
+
+    @property
+    def url_list(self) -> List:
+        return [url for url, _ in self.iter_pending()]
+
+    @property
+    def output_path_list(self) -> List:
+        return [outpath for _, outpath in self.iter_pending()]
+
+    def compact_log(self):
+        """
+        This function compacts the log file, useful when it has grown over many restarts.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self.resume_index.compact()
+
+    def get_num_urls_needed(self) -> int:
+        """ 
+        This function returns the number of urls needs to download to the output folder.
+        
+        Parameters: 
+            None  
+
+        Returns: 
+            the number of pending urls (int)
+        """
+        return sum(1 for _ in self.iter_pending())
+
+    def get_outpath_from_url(self, url: str) -> str:
+        """ 
+        This function generate output path for an url, based on the filename in an url.
+        
+        Parameters: 
+            url (string)  
+
+        Returns: 
+            outpath (string): output path for the given url
+        """
+        netloc, path = split_url(url)
+        # the last path segment without its ;params, as urlparse splits them
+        fname = path[path.rfind("/") + 1:].split(";", 1)[0]
+        outpath = os.path.join(self.local_output_path, "data", fname or netloc)
+        return outpath
+
+    def download_site(self, url: str, outpath: str, log_flag: bool=False) -> Tuple[List, List]:
+        """
+        This function download an url and save its content to the outpath.
+
+        Parameters:
+            url (string): the url to downalod.
+            outpath (string): the output path to save the content.
+            log_flag (boolean): whether to print the progress and append the log right away.
+
+        Returns:
+            the log lines (list) and the stderr outputs (list)
+        """
+        saved, status_code, _ = self.fetch(url, outpath)
+        print_to_log_file, print_to_stderr = self.format_result(url, saved, status_code)
+        if log_flag:
+            for to_print in print_to_stderr:
+                print(to_print, end="", file=sys.stderr)
+            print("\n", end="", file=sys.stderr, flush=True)
+            self.resume_index.append(print_to_log_file)
+            self.resume_index.flush()
+
+        return (print_to_log_file, print_to_stderr)
+
+    def fetch(self, url: str, outpath: str,
+              schedule_segments: Optional[Callable[[PartialDownload, List[int]], None]]=None
+              ) -> Tuple[Optional[bool], Optional[int], Optional[str]]:
+        """
+        This function sends one GET request for the url and saves the body to the outpath if it succeeds.
+        With resume_partial or segment_size the body goes through _fetch_ranged instead.
+
+        Parameters:
+            url (string): the url to download.
+            outpath (string): the output path to save the content.
+            schedule_segments (callable): called with (PartialDownload, segment indexes) to download the remaining
+                segments of a large body elsewhere, e.g. by the pipeline workers. None downloads them in this call.
+
+        Returns:
+            whether the body is saved (boolean, None if its segments are handed to schedule_segments, a Future of it
+            if the save runs on the io_pool), the status code (int, None for connection errors and timeouts)
+            and the Retry-After header (string, None if absent)
+        """
+        status_code = None
+        retry_after = None
+        saved = False
+        headers = None
+        if self.refresh and (self.storage.exists(outpath) or self.content_store):
+            headers = self.http_cache.get_conditional_headers(url)
+        num_bytes = 0
+        headers_time = None
+        thread_local.connect_time = 0.0
+        start = time.perf_counter()
+        try:
+            if self.resume_partial and not headers:
+                saved, status_code, retry_after, num_bytes, headers_time = self._fetch_ranged(url, outpath, schedule_segments)
+                if saved:
+                    self.sync_saved(outpath)
+            else:
+                stream = self.stream or self.content_filter is not None
+                with self.session.get(url, timeout=self.timeout, stream=stream, headers=headers) as response:
+                    headers_time = start + response.elapsed.total_seconds()
+                    status_code = response.status_code
+                    retry_after = response.headers.get("Retry-After")
+                    if status_code == 304 and headers:
+                        saved = True
+                        self.http_cache.touch(url)
+                    elif response and self.is_rejected(url, response.headers.get("Content-Type"),
+                                                       parse_content_length(response.headers.get("Content-Length"))):
+                        saved = False
+                    else:
+                        saved = bool(response) and self.save_response(outpath, response, url)
+                        if isinstance(saved, concurrent.futures.Future):
+                            # added before the callback of the pipeline, so it runs before the url is reported
+                            saved.add_done_callback(functools.partial(self._record_saved, url, outpath, response))
+                            num_bytes = get_saved_size(response) or 0
+                        elif saved:
+                            num_bytes = self._record_saved(url, outpath, response)
+        except (requests.RequestException, urllib3.exceptions.HTTPError) as e:
+            logger.debug(f"Failed to download {url}: {e!r}")
+        self._record_attempt(url, start, headers_time, status_code, saved, num_bytes)
+        return saved, status_code, retry_after
+
+    def _record_saved(self, url: str, outpath: str, response: requests.Response,
+                      future: Optional[concurrent.futures.Future]=None) -> int:
+        # the size and the validators of a saved body; as the callback of a save on the io_pool, only if it succeeded
+        if future is not None and (future.cancelled() or future.exception() is not None or not future.result()):
+            return 0
+        num_bytes = get_saved_size(response, outpath) or 0
+        if self.http_cache is not None:
+            self.http_cache.record(url, response.headers.get("ETag"), response.headers.get("Last-Modified"), num_bytes)
+        return num_bytes
+
+    def is_rejected(self, url: str, content_type: Optional[str], size: Optional[int]) -> bool:
+        """
+        This function runs the header check of the content filter on a response, see ContentFilter.check_headers.
+
+        Parameters:
+            url (string): the url of the response.
+            content_type (string): the Content-Type header, None if it is missing.
+            size (int): the size of the whole body from the headers, None if it is unknown.
+
+        Returns:
+            whether the response is rejected (boolean)
+        """
+        if self.content_filter is None:
+            return False
+        reason = self.content_filter.check_headers(content_type, size)
+        if reason is None:
+            return False
+        logger.debug(f"Skip {url}: {reason}")
+        self.metrics.record_filtered("headers", size or 0)
+        return True
+
+    def get_max_body_size(self) -> Optional[int]:
+        """
+        This function returns the size after which a streamed body is cut off: the smaller of max_bytes_per_file and
+        the max_size of the content filter.
+
+        Parameters:
+            None
+
+        Returns:
+            the size (int), None for no limit
+        """
+        sizes = [self.max_bytes_per_file, self.content_filter.max_size if self.content_filter is not None else None]
+        return min((size for size in sizes if size is not None), default=None)
+
+    def _is_too_small(self, url: str, size: int) -> bool:
+        # the min_size check of a body whose size was not in its headers
+        if self.content_filter is None or self.content_filter.min_size is None or size >= self.content_filter.min_size:
+            return False
+        logger.debug(f"Skip {url}: size {size} is under {self.content_filter.min_size}")
+        self.metrics.record_filtered("body")
+        return True
+
+    def _record_attempt(self, url: str, start: float, headers_time: Optional[float], status_code: Optional[int],
+                        saved: Optional[bool], num_bytes: int):
+        end = time.perf_counter()
+        connect = min(thread_local.connect_time, end - start)
+        if headers_time is None:
+            headers_time = end
+        self.metrics.record_attempt(url, get_host(url), status_code, bool(saved), num_bytes, connect,
+                                    max(headers_time - start - connect, 0.0), max(end - headers_time, 0.0))
+        # read by make_result_row on the same thread
+        thread_local.last_attempt = (num_bytes, end - start)
+
+    def _fetch_ranged(self, url: str, outpath: str, schedule_segments: Optional[Callable]
+                      ) -> Tuple[Optional[bool], Optional[int], Optional[str], int, Optional[float]]:
+        """
+        This function downloads an url into [outpath].part with Range requests, see PartialDownload.
+        A part file with a valid state continues from where it stopped, with If-Range so a changed body starts over.
+        With segment_size the first request asks for the first segment only; if the body is larger, the other
+        segments are downloaded by fetch_segment, in this call or by whoever schedule_segments hands them to.
+
+        Parameters:
+            url (string): the url to download.
+            outpath (string): the output path to save the content.
+            schedule_segments (callable): see fetch.
+
+        Returns:
+            whether the body is saved (boolean, None if its segments are scheduled), the status code (int),
+            the Retry-After header (string), the number of bytes received (int) and the time.perf_counter() when
+            the response headers arrived (float)
+        """
+        partial = PartialDownload.load(url, outpath)
+        if partial is not None and partial.segment_size:
+            saved, status_code = self._run_segments(partial, schedule_segments)
+            return saved, status_code, None, 0, None
+        offset = 0
+        headers = {}
+        if partial is not None:
+            offset = os.path.getsize(partial.part_path)
+            headers["Range"] = "bytes={}-".format(offset)
+            headers["If-Range"] = partial.validator
+        elif self.segment_size:
+            headers["Range"] = "bytes=0-{}".format(self.segment_size - 1)
+        with self.session.get(url, timeout=self.timeout, stream=True, headers=headers) as response:
+            headers_time = time.perf_counter()
+            status_code = response.status_code
+            retry_after = response.headers.get("Retry-After")
+            if status_code == 416 and partial is not None:
+                # the part file already holds the whole body, or the state does not match the server any more
+                if partial.total is not None and offset == partial.total:
+                    self._finish_partial(partial)
+                    return True, status_code, None, 0, headers_time
+                partial.discard()
+                return False, status_code, retry_after, 0, headers_time
+            content_range = parse_content_range(response.headers.get("Content-Range")) if status_code == 206 else None
+            if not response or (status_code == 206 and content_range is None):
+                return False, status_code, retry_after, 0, headers_time
+            total = content_range[2] if content_range is not None \
+                else parse_content_length(response.headers.get("Content-Length"))
+            if self.is_rejected(url, response.headers.get("Content-Type"), total):
+                if partial is not None:
+                    partial.discard()
+                return False, status_code, retry_after, 0, headers_time
+            # before the segments, which are written by fetch_segment and never see the cap
+            if self.max_bytes_per_file is not None and total is not None and total > self.max_bytes_per_file:
+                logger.warning(f"Skip {url}, size {total} exceeds max_bytes_per_file")
+                if partial is not None:
+                    partial.discard()
+                return False, status_code, retry_after, 0, headers_time
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if content_range is None:
+                # a full body, also when the server ignored the range because the body changed
+                offset = 0
+                partial = None
+            else:
+                first_byte, last_byte, _ = content_range
+                if first_byte != offset:
+                    if partial is not None:
+                        partial.discard()
+                    return False, status_code, retry_after, 0, headers_time
+                if partial is None and total is not None and last_byte + 1 < total:
+                    # the first segment of a body larger than segment_size
+                    partial = PartialDownload(url, outpath, etag, last_modified, total, self.segment_size)
+                    with open(partial.part_path, "wb") as f:
+                        f.truncate(total)
+                    try:
+                        num_bytes = write_chunks_at(iter_response_chunks(response, self.chunk_size, last_byte + 1),
+                                                    partial.part_path, 0)
+                    except BaseException:
+                        partial.discard()
+                        raise
+                    partial.mark_done(0)
+                    saved, status_code = self._run_segments(partial, schedule_segments)
+                    return saved, status_code, None, num_bytes, headers_time
+            if partial is None:
+                partial = PartialDownload(url, outpath, etag, last_modified, total)
+                # a small body is read at once, only a body that can be cut off halfway gets a state file
+                if partial.validator is not None and (total is None or total > self.chunk_size):
+                    partial.save()
+            max_bytes = self.get_max_body_size()
+            max_bytes = None if max_bytes is None else max_bytes - offset
+            try:
+                num_bytes = write_chunks_at(iter_response_chunks(response, self.chunk_size, max_bytes),
+                                            partial.part_path, offset, truncate=True)
+            except DownloadSizeExceeded as e:
+                logger.warning(str(e))
+                partial.discard()
+                return False, status_code, retry_after, 0, headers_time
+            except BaseException:
+                # keep what arrived for the next attempt, unless it cannot be continued
+                if not os.path.exists(partial.meta_path):
+                    partial.discard()
+                raise
+            if total is not None and offset + num_bytes != total:
+                return False, status_code, retry_after, num_bytes, headers_time
+            if total is None and self._is_too_small(url, offset + num_bytes):
+                partial.discard()
+                return False, status_code, retry_after, num_bytes, headers_time
+            self._finish_partial(partial)
+            return True, status_code, retry_after, num_bytes, headers_time
+
+    def _run_segments(self, partial: PartialDownload, schedule_segments: Optional[Callable]) -> Tuple[Optional[bool], Optional[int]]:
+        missing = partial.missing_segments()
+        if not missing:
+            self._finish_partial(partial)
+            return True, 206
+        if schedule_segments is not None:
+            partial.begin_segments(len(missing))
+            schedule_segments(partial, missing)
+            return None, 206
+        for index in missing:
+            for attempt in itertools.count(1):
+                ok, status_code, retry_after = self.fetch_segment(partial, index)
+                if ok:
+                    break
+                if partial.invalid or self.retry_policy is None or not self.retry_policy.should_retry(status_code, attempt):
+                    if partial.invalid:
+                        partial.discard()
+                    return False, status_code
+                time.sleep(self.retry_policy.get_delay(attempt, retry_after))
+        self._finish_partial(partial)
+        return True, 206
+
+    def sync_saved(self, outpath: str):
+        """
+        This function makes a saved body durable before its url is logged, if the log_fsync policy is "data",
+        see StorageBackend.sync. An output path that a custom saver did not create is skipped.
+
+        Parameters:
+            outpath (string): the output path of the saved url.
+
+        Returns:
+            None
+        """
+        if self.log_fsync == "data":
+            self.storage.sync(outpath)
+
+    def _save_and_sync(self, outpath: str, save: Callable, *args) -> bool:
+        start = time.perf_counter()
+        try:
+            save(*args)
+            self.sync_saved(outpath)
+        except OSError as e:
+            logger.warning(f"Failed to save {outpath}: {e!r}")
+            return False
+        finally:
+            self.metrics.record_stage("save", time.perf_counter() - start)
+        return True
+
+    def _submit_save(self, outpath: str, save: Callable, *args) -> Union[bool, concurrent.futures.Future]:
+        if self.io_pool is None:
+            return self._save_and_sync(outpath, save, *args)
+        return self.io_pool.submit(self._save_and_sync, outpath, save, *args)
+
+    def _save_processed(self, url: str, outpath: str, path: str) -> bool:
+        store = self.content_store or self.storage
+        return self._save_and_sync(outpath, store.put_file, url, outpath, path)
+
+    def _submit_processing(self, url: str, outpath: str, path: str) -> Union[bool, concurrent.futures.Future]:
+        """
+        This function runs the processor on a downloaded body and then saves it, see ProcessingStage.
+        While a pipeline runs, the body goes to the worker processes and the caller gets a Future of the result,
+        otherwise the processor runs in this thread.
+
+        Parameters:
+            url (string): the url of the body.
+            outpath (string): the output path of the body.
+            path (string): the temp file with the body, in processing_dir.
+
+        Returns:
+            whether the body is saved (boolean, or a Future of it)
+        """
+        save = functools.partial(self._save_processed, url, outpath)
+        if self.processing is not None:
+            return self.processing.submit(url, path, save)
+        return _finish_processing(url, path, functools.partial(_run_processor, self.processor, url, path), save,
+                                  self.metrics)
+
+    def _finish_partial(self, partial: PartialDownload):
+        partial.finish()
+        if self.http_cache is not None:
+            self.http_cache.record(partial.url, partial.etag, partial.last_modified, partial.total)
+
+    def fetch_segment(self, partial: PartialDownload, index: int) -> Tuple[bool, Optional[int], Optional[str]]:
+        """
+        This function downloads one segment of a large body into its place in the part file.
+        A server that answers with anything but that exact range marks the download invalid,
+        since the segments already saved may belong to another version of the body.
+
+        Parameters:
+            partial (PartialDownload): the segmented download.
+            index (int): the index of the segment.
+
+        Returns:
+            whether the segment is saved (boolean), the status code (int, None for connection errors and timeouts)
+            and the Retry-After header (string, None if absent)
+        """
+        first_byte, last_byte = partial.segment_range(index)
+        headers = {"Range": "bytes={}-{}".format(first_byte, last_byte)}
+        if partial.validator is not None:
+            headers["If-Range"] = partial.validator
+        status_code = None
+        retry_after = None
+        saved = False
+        num_bytes = 0
+        headers_time = None
+        thread_local.connect_time = 0.0
+        start = time.perf_counter()
+        try:
+            with self.session.get(partial.url, timeout=self.timeout, stream=True, headers=headers) as response:
+                headers_time = time.perf_counter()
+                status_code = response.status_code
+                retry_after = response.headers.get("Retry-After")
+                content_range = parse_content_range(response.headers.get("Content-Range"))
+                if status_code == 206 and content_range is not None and content_range[:2] == (first_byte, last_byte):
+                    num_bytes = write_chunks_at(iter_response_chunks(response, self.chunk_size, last_byte - first_byte + 1),
+                                                partial.part_path, first_byte)
+                    saved = num_bytes == last_byte - first_byte + 1
+                    if saved:
+                        partial.mark_done(index)
+                elif response:
+                    partial.invalid = True
+                    logger.warning(f"{partial.url} changed while its segments were downloaded, it starts over on the next attempt")
+        except (requests.RequestException, urllib3.exceptions.HTTPError, DownloadSizeExceeded) as e:
+            logger.debug(f"Failed to download segment {index} of {partial.url}: {e!r}")
+        self._record_attempt(partial.url, start, headers_time, status_code, saved, num_bytes)
+        return saved, status_code, retry_after
+
+    def finish_segments(self, partial: PartialDownload, ok: bool) -> Tuple[List, List]:
+        """
+        This function completes a segmented download once none of its segments is pending.
+
+        Parameters:
+            partial (PartialDownload): the segmented download.
+            ok (boolean): whether every segment is saved.
+
+        Returns:
+            the result row of the url, see make_result_row
+        """
+        if ok:
+            self._finish_partial(partial)
+            self.sync_saved(partial.outpath)
+            return self.make_result_row(partial.url, True, 206, outpath=partial.outpath)
+        if partial.invalid:
+            partial.discard()
+        return self.make_result_row(partial.url, False, partial.failed_status, outpath=partial.outpath)
+
+    def format_result(self, url: str, saved: bool, status_code: Optional[int]) -> Tuple[List, List]:
+        """
+        This function counts a finished url and formats its log lines and stderr outputs.
+        The pipeline does not call it, its workers pass rows (make_result_row) and the writer formats them (write_results).
+
+        Parameters:
+            url (string): the downloaded url.
+            saved (boolean): whether the body is saved.
+            status_code (int): the status code of the last attempt.
+
+        Returns:
+            the log lines (list) and the stderr outputs (list)
+        """
+        print_to_log_file = []
+        print_to_stderr = []
+        message = self.count_result(url, saved, status_code)
+        if saved:
+            if self.verbose:
+                print_to_stderr.append("o")
+            if self.url_cnter % 1000 == 0 and self.verbose:
+                print_to_stderr.append("# processed url: {}...".format(self.url_cnter))
+            if not self._is_refreshed(url):
+                print_to_log_file.append("{}\t{}\n".format(url, "o"))
         else:
-            url_list = list(set(url_list))
-            self.output_path_list = [self.get_outpath_from_url(i) for i in url_list]
-        self.url_list = url_list
+            print_to_stderr.append("x")
+            if self.url_cnter % 1000 == 0:
+                print_to_stderr.append("# processed url: {}...".format(self.url_cnter))
+            if message is not None:
+                print_to_stderr.append(message)
+            print_to_log_file.append("{}\t{}\n".format(url, "x"))
+        return print_to_log_file, print_to_stderr
 
-        self.num_thread = num_thread
-        self.err_tolerance_num = err_tolerance_num
-        self.stop_interval = stop_interval
-        self.timeout = timeout
-        self.http_headers = http_headers
-        self.verbose = verbose
-        self.custom_img_saver = custom_img_saver
+    def _is_refreshed(self, url: str) -> bool:
+        # a refreshed url that is already logged as done keeps its single log entry
+        return self.refresh and self.resume_index.count(url) and not self.resume_index.is_failed(url)
 
-        self.err_cnter = 0
-        self.url_cnter = 0
-        self.log_file = os.path.join(local_output_path, "downloaded.log")
-        data_path = os.path.join(local_output_path, "data")
-        if not os.path.exists(data_path):
-            logger.info(f"Output folder is not exist, create folder: {data_path}")
-            os.makedirs(data_path)
-        if not os.path.exists(self.log_file):
-            logger.info("Creating log_file")
-            f = open(self.log_file, "w")
-            f.close()
-        self.update_downloading_status()
+    def count_result(self, url: str, saved: bool, status_code: Optional[int]) -> Optional[str]:
+        """
+        This function counts a finished url on the thread that downloaded it: the url counter, the metrics and the
+        consecutive errors of the thread. After err_tolerance_num consecutive errors the dispatcher pauses for stop_interval secs.
 
-    def update_downloading_status(self):
-        """ 
-        The function to update the url_list, outpaht_list, and img_hash_set, based on the log in the folder.
-        This is useful when you already have some urls downloaded in the output folder.
-        This function depnds on the log file in the output folder.
+        Parameters:
+            url (string): the downloaded url.
+            saved (boolean): whether the body is saved.
+            status_code (int): the status code of the last attempt.
 
-        Parameters: 
-            None  
+        Returns:
+            the error report for stderr (string), None if there is nothing to report
+        """
+        self.url_cnter = self.metrics.record_url(get_host(url), saved)
+        if saved:
+            set_to_zero_thread_local_err_cntr()
+            return None
+        message = None
+        if get_thread_local_err_cntr() >= self.err_tolerance_num:
+            # the dispatcher stops handing out urls for stop_interval secs, no worker sleeps
+            self.paused_until = max(self.paused_until, time.monotonic() + self.stop_interval)
+            set_to_zero_thread_local_err_cntr()
+            message = "last error code is {}, error url: {}".format(status_code, url)
+        increment_thread_local_err_cntr()
+        return message
 
-        Returns: 
-            None
+    def make_result_row(self, url: str, saved: bool, status_code: Optional[int],
+                        last_attempt: Optional[Tuple[int, float]]=None, outpath: Optional[str]=None) -> Tuple:
         """
-        tmp = []
-        with open(self.log_file, "r") as f:
-            downloaded_url = collections.Counter([line.split("\t")[0] for line in f if "batch above" not in line])
-        for url, output_path in zip(self.url_list, self.output_path_list):
-            if url in downloaded_url:
-                downloaded_url[url] -= 1
-                if downloaded_url[url] == 0:
-                    downloaded_url.pop(url)
-            else:
-                tmp.append((url, output_path))
+        This function counts a finished url (see count_result) and returns the row that the pipeline writer collects.
 
-        self.url_list = [i[0] for i in tmp]
-        self.output_path_list = [i[1] for i in tmp]
+        Parameters:
+            url (string): the downloaded url.
+            saved (boolean): whether the body is saved.
+            status_code (int): the status code of the last attempt.
+            last_attempt (tuple): the bytes and secs of the last attempt, taken from the thread that made it by default.
+            outpath (string): the output path of the url.
 
-    def get_num_urls_needed(self) -> int:
-        """ 
-        This function returns the number of urls needs to download to the output folder.
-        
-        Parameters: 
-            None  
+        Returns:
+            (url, saved, status code, bytes and secs of the last attempt, stderr message, outpath),
+            the arguments of ResultColumns.append
+        """
+        message = self.count_result(url, saved, status_code)
+        size, elapsed = last_attempt or getattr(thread_local, "last_attempt", (0, 0.0))
+        return url, saved, status_code, size, elapsed, message, outpath
 
-        Returns: 
-            len(self.url_list) (int)
+    def make_expired_row(self, url: str, outpath: Optional[str]=None) -> Tuple:
         """
-        self.update_downloading_status()
-        return len(self.url_list)
+        This function counts an url whose deadline passed before it was dispatched and returns its result row.
+        It is not a consecutive error, so it never pauses the dispatcher.
 
-    def get_outpath_from_url(self, url: str) -> str:
-        """ 
-        This function generate output path for an url, based on the filename in an url.
-        
-        Parameters: 
-            url (string)  
+        Parameters:
+            url (string): the url.
+            outpath (string): the output path of the url.
 
-        Returns: 
-            outpath (string): output path for the given url
+        Returns:
+            the result row, see make_result_row
         """
-        parsing = urlparse(url)
-        if os.path.basename(parsing.path):
-            fname = os.path.basename(parsing.path)
-        else:
-            fname = parsing.netloc
-        outpath = os.path.join(self.local_output_path, "data", fname)
-        return outpath
+        self.url_cnter = self.metrics.record_url(get_host(url), False)
+        return url, False, None, 0, 0.0, None, outpath
 
-    def download_site(self, url: str, outpath: str, log_flag: bool=False) -> Tuple[List, List]:
+    def write_results(self, columns: ResultColumns):
         """
-        This function download an url and save its content to the outpath.
+        This function appends the log entries of a batch of finished urls and prints their progress, formatting both once per batch.
 
         Parameters:
-            url (string): the url to downalod.
-            outpath (string): the output path to save the content.
+            columns (ResultColumns): the finished urls.
 
         Returns:
             None
         """
-        session = get_session()
-        session.headers.update(self.http_headers)
+        entries = []
+        progress = []
+        verbose = self.verbose
+        for url, saved in zip(columns.urls, columns.saved):
+            self.num_written += 1
+            if saved:
+                if not self._is_refreshed(url):
+                    entries.append((url, False))
+                if verbose:
+                    progress.append("o")
+            else:
+                entries.append((url, True))
+                progress.append("x")
+            if self.num_written % 1000 == 0 and (verbose or not saved):
+                progress.append("# processed url: {}...".format(self.num_written))
+        progress.extend(columns.messages)
+        self.resume_index.append_entries(entries)
+        if progress:
+            sys.stderr.write("".join(progress))
+            sys.stderr.flush()
 
-        print_to_log_file = []
-        print_to_stderr = []
-        with session.get(url, timeout=self.timeout) as response:
-            if response:
-                if self.verbose:
-                    print_to_stderr.append("o")
-                self.url_cnter += 1
-                if self.url_cnter % 1000 == 0 and self.verbose:
-                    print_to_stderr.append("# processed url: {}...".format(self.url_cnter))
+    def save_response(self, outpath: str, response: requests.Response, url: Optional[str]=None
+                      ) -> Union[bool, concurrent.futures.Future]:
+        """
+        This function saves the body of a successful response to the outpath through the storage backend.
+        In stream mode the body is read chunk by chunk into a writer of the backend (for FileStorage a temp file
+        that is renamed to the outpath) and committed once it is complete.
+        While a pipeline runs, the save (in stream mode the commit) is submitted to the io_pool and
+        the worker gets a Future of the result.
+        With a processor the body is written to a temp file and handed to it instead, see _submit_processing.
+        The body is also made durable here if the log_fsync policy is "data", see sync_saved.
 
-                if self.custom_img_saver:
-                    self.custom_img_saver(outpath, response)
-                else:
-                    with open(outpath, "wb") as f:
-                        f.write(response.content)
-                print_to_log_file.append("{}\t{}\n".format(url, "o"))
-                set_to_zero_thread_local_err_cntr()
-            else:
-                print_to_stderr.append("x")
-                self.url_cnter += 1
-                if self.url_cnter % 1000 == 0:
-                    print_to_stderr.append("# processed url: {}...".format(self.url_cnter))
-                if get_thread_local_err_cntr() >= self.err_tolerance_num:
-                    time.sleep(self.stop_interval)
-                    set_to_zero_thread_local_err_cntr()
-                    print_to_stderr.append("last error code is {}, error url: {}".format(response.status_code, url))
-                increment_thread_local_err_cntr()
-                print_to_log_file.append("{}\t{}\n".format(url, "x"))
-        if log_flag:
-            for to_print in print_to_stderr:
-                print(to_print, end="", file=sys.stderr)
-            print("\n", end="", file=sys.stderr, flush=True)
+        Parameters:
+            outpath (string): the output path to save the content.
+            response (requests.Response): the response to save.
+            url (string): the requested url, recorded in the content store. Defaults to the url of the response.
 
-            with open(self.log_file, "a") as f:
-                for to_print in print_to_log_file:
-                    f.write(to_print)
-       
-        return (print_to_log_file, print_to_stderr)
+        Returns:
+            whether the body is saved (boolean, or a Future of it). It is False when the body is larger than
+            max_bytes_per_file or its size is not allowed by the content filter.
+        """
+        url = url or response.url
+        if not self.stream:
+            try:
+                # with a content filter the response is streamed, so the cap applies while the body is read
+                body = read_response_body(response, self.chunk_size,
+                                          self.get_max_body_size() if self.content_filter is not None else None)
+            except DownloadSizeExceeded as e:
+                logger.warning(str(e))
+                return False
+            if self._is_too_small(url, len(body)):
+                return False
+            if self.processor is not None:
+                return self._submit_processing(url, outpath, _write_temp_file(self.processing_dir, body))
+            if self.custom_img_saver:
+                # the body is read here, the saver may run on the io_pool after the response is closed
+                return self._submit_save(outpath, self.custom_img_saver, outpath, response)
+            store = self.content_store or self.storage
+            return self._submit_save(outpath, store.put_bytes, url, outpath, body)
+
+        content_length = response.headers.get("Content-Length")
+        if self.max_bytes_per_file is not None and content_length and content_length.isdigit() \
+                and int(content_length) > self.max_bytes_per_file:
+            logger.warning(f"Skip {response.url}, Content-Length {content_length} exceeds max_bytes_per_file")
+            return False
+        chunks = iter_response_chunks(response, self.chunk_size, self.get_max_body_size())
+        try:
+            if self.custom_stream_saver:
+                return self._save_and_sync(outpath, self.custom_stream_saver, outpath, chunks)
+            if self.custom_img_saver:
+                return self._save_and_sync(outpath, self.custom_img_saver, outpath, response)
+            if self.processor is not None:
+                writer = _TempFileWriter(self.processing_dir)
+            elif self.content_store:
+                writer = self.content_store.open_writer(url, outpath)
+            else:
+                writer = self.storage.open_writer(url, outpath)
+            num_bytes = 0
+            try:
+                for chunk in chunks:
+                    num_bytes += writer.write(chunk)
+            except BaseException:
+                writer.abort()
+                raise
+            if self._is_too_small(url, num_bytes):
+                writer.abort()
+                return False
+            if self.processor is not None:
+                writer.commit()
+                return self._submit_processing(url, outpath, writer.path)
+            return self._submit_save(outpath, writer.commit)
+        except DownloadSizeExceeded as e:
+            logger.warning(str(e))
+            return False
 
     def batch_download_sites(self, batch_size: int=-1):
         """ 
@@ -482,45 +4988,672 @@ class URLDownloader_v2:
         Its a multithread version of download_site. It download first [batch_size] of images
         
         Parameters: 
-            batch_size (int): the size of image to be downloaded from url_list.
+            batch_size (int): the size of image to be downloaded from url_list. -1 means all of them.
         Returns: 
             None
         """
-        if batch_size == -1:
-            num = len(self.url_list)
-        print("# files to download: {}".format(len( self.url_list[:num])))
-        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_thread) as executor:
-            results = executor.map(self.download_site, self.url_list[:num], self.output_path_list[:num])
+        tasks = self.iter_pending()
+        if batch_size != -1:
+            tasks = itertools.islice(tasks, batch_size)
+        self._download_tasks(tasks)
 
-        results = list(results)
-        for _, print_to_stderr in results:
-            for to_print in print_to_stderr:
-                print(to_print, end="", file=sys.stderr)
-        print("\n", end="", file=sys.stderr, flush=True)
+    def filter_tasks(self, tasks: Iterable[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+        """
+        This function drops the urls that the preflight check of the content filter rejects, before any request.
+        They are not logged, so they are checked again on the next run.
+
+        Parameters:
+            tasks (iterable): an iterable of (url, outpath).
 
-        with open(self.log_file, "a") as f:
-            for print_to_log_file, _ in results:
-                for to_print in print_to_log_file:
-                    f.write(to_print)
+        Returns:
+            an iterator of the (url, outpath) that pass
+        """
+        check_url = self.content_filter.check_url if self.content_filter is not None else None
+        for url, outpath in tasks:
+            if check_url is not None:
+                reason = check_url(url)
+                if reason is not None:
+                    logger.debug(f"Skip {url}: {reason}")
+                    self.metrics.record_filtered("url")
+                    continue
+            yield url, outpath
 
-        self.update_downloading_status()
+    def _download_tasks(self, tasks: Iterable[Tuple[str, str]], queue_size: Optional[int]=None):
+        pipeline = _DownloadPipeline(self, queue_size or 2 * self.num_thread)
+        with self._report_metrics():
+            try:
+                pipeline.run(self.filter_tasks(tasks))
+            finally:
+                self.stop_event.clear()
+                self.storage.close()
+                self.resume_index.flush()
+        logger.info(f"# processed url: {pipeline.num_dispatched}")
+
+    @contextlib.contextmanager
+    def _report_metrics(self):
+        reporter = None
+        if self.metrics_file:
+            reporter = MetricsReporter(self.metrics, self.metrics_file, self.metrics_interval)
+            reporter.start()
+        try:
+            yield
+        finally:
+            if reporter is not None:
+                reporter.stop()
+
+    def get_metrics(self) -> Dict:
+        """
+        This function returns a snapshot of the metrics, see DownloadMetrics.snapshot.
+
+        Parameters:
+            None
+
+        Returns:
+            the metrics (dict)
+        """
+        return self.metrics.snapshot()
+
+    def retry_failed(self, batch_size: int=1024):
+        """
+        This function downloads again only the urls that are logged as errors ("x") in the log.
+        A success is appended as a new "o" entry, which replaces the error entry in the resume index.
+
+        Parameters:
+            batch_size (int): the max number of urls waiting in the work queue.
+        Returns:
+            None
+        """
+        self._download_tasks(self.iter_failed(), batch_size)
+
+    def get_pool_stats(self) -> Dict:
+        """
+        This function returns the usage counters of the connection pools, see ConnectionPoolStats.snapshot.
+
+        Parameters:
+            None
 
+        Returns:
+            the counters (dict)
+        """
+        return self.pool_stats.snapshot()
 
     def download_all_sites(self, batch_size: int=1024):
         """ 
-        This function is a wrapper for batch_download_sites, it downloads all images in a batch way.
+        This function downloads all urls in one continuous pipeline, see _DownloadPipeline.
+        Every finished url is appended to the log by the writer thread as soon as it arrives,
+        so a slow url never holds back the others.
         
         Parameters: 
-            batch_size (int): the size of image to be download and output logs.
+            batch_size (int): the max number of urls waiting in the work queue.
         Returns: 
             None
         """
-        while len(self.url_list) > 0:
-            self.batch_download_sites(batch_size)
+        self._download_tasks(self.iter_pending(), batch_size)
+
+    def stop(self):
+        """
+        This function asks the running download to stop, from any thread. No new url is dispatched, the urls in flight
+        finish and are logged, and download_all_sites returns; the urls that were not dispatched stay pending.
+
+        Parameters:
+            None
+
+        Returns:
+            None
+        """
+        self.stop_event.set()
+
+    def read_body(self, outpath: str) -> Optional[bytes]:
+        """
+        This function reads a saved body back through the storage backend.
+
+        Parameters:
+            outpath (string): the output path of the body.
+
+        Returns:
+            the body (bytes), None if it cannot be read, e.g. a custom saver did not write it
+        """
+        try:
+            return self.storage.read(outpath)
+        except OSError as e:
+            logger.warning(f"Failed to read {outpath}: {e!r}")
+            return None
+
+    def iter_downloads(self, max_buffered: int=1024, read_bodies: bool=False) -> Iterator[DownloadResult]:
+        """
+        This function downloads the pending urls like download_all_sites on a background thread and yields a
+        DownloadResult for every url as soon as it is logged, so the bodies can be ingested while others still download.
+        At most [max_buffered] results wait for the caller. A slower caller holds back the writer, the writer the workers
+        and the workers the dispatcher, so a slow consumer slows the download down instead of growing the memory.
+        Leaving the loop early stops the download (see stop); the urls in flight are still logged, but not yielded.
+
+        Parameters:
+            max_buffered (int): the max number of results waiting for the caller.
+            read_bodies (boolean): whether to read every saved body into DownloadResult.body, on the caller's thread.
+
+        Returns:
+            an iterator of DownloadResult, in the order the urls finish
+        """
+        assert self.result_sink is None, "only one download of this object can be iterated at a time"
+        results = queue.Queue(maxsize=max(max_buffered, 1))
+        closed = threading.Event()
+        done = object()
+        errors = []
+
+        def put(item):
+            # gives up once the caller left the loop, the results are in the log anyway
+            while not closed.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def sink(columns: ResultColumns):
+            for result in DownloadResult.from_columns(columns):
+                put(result)
+
+        def run():
+            try:
+                self._download_tasks(self.iter_pending())
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                put(done)
+
+        self.result_sink = sink
+        thread = threading.Thread(target=run, name="downloader-iter", daemon=True)
+        thread.start()
+        try:
+            while True:
+                result = results.get()
+                if result is done:
+                    break
+                if read_bodies and result.ok:
+                    result.body = self.read_body(result.outpath)
+                yield result
+            if errors:
+                raise errors[0]
+        finally:
+            closed.set()
+            if thread.is_alive():
+                self.stop()
+            thread.join()
+            self.stop_event.clear()
+            self.result_sink = None
+
+
+class AsyncURLDownloader(URLDownloader_v2):
+    """
+    This is a class for downloading a batch of urls on an asyncio event loop with aiohttp.
+    It takes the same arguments as URLDownloader_v2 and shares its log format and resume semantics,
+    but keeps up to [max_concurrency] requests in flight on a single thread.
+    File writes run on a thread pool of [num_thread] threads, so the event loop never blocks on disk.
+
+    Attributes:
+        max_concurrency (int): the max number of requests in flight.
+        (and every attribute of URLDownloader_v2)
+    """
+    def __init__(self, *args, max_concurrency: int=1024, **kwargs):
+        """
+        The constructor for AsyncURLDownloader Class.
+
+        Parameters:
+            max_concurrency (int): the max number of requests in flight.
+            (and every parameter of URLDownloader_v2)
+
+        Returns:
+            The AsyncURLDownloader object
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncURLDownloader requires aiohttp, please install it with `pip install aiohttp`")
+        super().__init__(*args, **kwargs)
+        if self.custom_img_saver or self.custom_stream_saver:
+            raise ValueError("AsyncURLDownloader does not support custom_img_saver or custom_stream_saver")
+        if self.resume_partial:
+            raise ValueError("AsyncURLDownloader does not support resume_partial or segment_size")
+        if isinstance(self.host_limiter, AdaptiveConcurrencyLimiter):
+            raise ValueError("AsyncURLDownloader does not support adaptive_concurrency, it is bounded by max_concurrency")
+        self.max_concurrency = max_concurrency
+
+    async def download_site_async(self,
+                                  session: "aiohttp.ClientSession",
+                                  url: str,
+                                  outpath: str,
+                                  io_executor: concurrent.futures.Executor) -> Tuple:
+        """
+        This function download an url and save its content to the outpath, it is the coroutine version of download_site.
+
+        Parameters:
+            session (aiohttp.ClientSession): the session shared by all coroutines.
+            url (string): the url to download.
+            outpath (string): the output path to save the content.
+            io_executor (Executor): the executor for file writes.
+
+        Returns:
+            the result row of this url, see URLDownloader_v2.make_result_row
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self.metrics.worker_started()
+            try:
+                saved, status, retry_after, size, elapsed = await self._fetch_async(session, url, outpath, io_executor)
+            finally:
+                self.metrics.worker_finished()
+            if saved or self.retry_policy is None or not self.retry_policy.should_retry(status, attempt):
+                break
+            self.metrics.record_retry()
+            # only this coroutine waits, the other downloads keep running on the loop
+            await asyncio.sleep(self.retry_policy.get_delay(attempt, retry_after))
+
+        self.url_cnter = self.metrics.record_url(get_host(url), saved)
+        message = None
+        if saved:
+            self.err_cnter = 0
+        else:
+            if self.err_cnter >= self.err_tolerance_num:
+                self.err_cnter = 0
+                message = "last error code is {}, error url: {}".format(status, url)
+                # pause the dispatcher, not only this coroutine, so no other url goes to the failing site meanwhile
+                self.paused_until = time.monotonic() + self.stop_interval
+            self.err_cnter += 1
+        return url, saved, status, size or 0, elapsed, message, outpath
+
+    async def _fetch_async(self, session, url, outpath, io_executor) -> Tuple[bool, Optional[int], Optional[str], int, float]:
+        loop = asyncio.get_running_loop()
+        status = None
+        retry_after = None
+        saved = False
+        headers = None
+        # the storage may be remote (see S3Storage), so it is asked on the io_executor
+        if self.refresh and (self.content_store or await loop.run_in_executor(io_executor, self.storage.exists, outpath)):
+            headers = self.http_cache.get_conditional_headers(url)
+        size = 0
+        trace_ctx = {"connect": 0.0}
+        start = headers_time = loop.time()
+        try:
+            async with session.get(url, headers=headers, trace_request_ctx=trace_ctx) as response:
+                headers_time = loop.time()
+                status = response.status
+                retry_after = response.headers.get("Retry-After")
+                if status == 304 and headers:
+                    saved = True
+                    await loop.run_in_executor(io_executor, self.http_cache.touch, url)
+                elif response.status < 400 and self.is_rejected(url, response.headers.get("Content-Type"),
+                                                                response.content_length):
+                    saved = False
+                elif response.status < 400:
+                    saved, size = await self._save_response_async(loop, response, url, outpath, io_executor)
+                    if saved and self.http_cache is not None:
+                        await loop.run_in_executor(io_executor, self.http_cache.record, url, response.headers.get("ETag"),
+                                                   response.headers.get("Last-Modified"), size)
+                if saved and self.log_fsync == "data":
+                    await loop.run_in_executor(io_executor, self.sync_saved, outpath)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+            logger.debug(f"Failed to download {url}: {e!r}")
+            headers_time = loop.time()
+        end = loop.time()
+        connect = min(trace_ctx["connect"], headers_time - start)
+        self.metrics.record_attempt(url, get_host(url), status, saved, size or 0, connect,
+                                    headers_time - start - connect, end - headers_time)
+        return saved, status, retry_after, size or 0, end - start
+
+    @staticmethod
+    def _make_trace_config() -> "aiohttp.TraceConfig":
+        # times the new connections of a request into its trace_request_ctx["connect"]
+        async def on_connection_create_start(session, ctx, params):
+            ctx.connect_start = asyncio.get_running_loop().time()
+
+        async def on_connection_create_end(session, ctx, params):
+            ctx.trace_request_ctx["connect"] += asyncio.get_running_loop().time() - ctx.connect_start
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_connection_create_start.append(on_connection_create_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        return trace_config
+
+    async def _save_response_async(self, loop, response, url, outpath, io_executor) -> Tuple[bool, int]:
+        # returns whether the body is saved and its number of bytes, counted here since the storage may not be local
+        max_bytes = self.get_max_body_size()
+        if not self.stream:
+            if max_bytes is None:
+                body = await response.read()
+            else:
+                body = bytearray()
+                async for chunk in response.content.iter_chunked(self.chunk_size):
+                    body += chunk
+                    if len(body) > max_bytes:
+                        logger.warning(f"Skip {response.url}, body is larger than {max_bytes} bytes")
+                        return False, 0
+                body = bytes(body)
+            if self._is_too_small(url, len(body)):
+                return False, 0
+            if self.processor is not None:
+                path = await loop.run_in_executor(io_executor, _write_temp_file, self.processing_dir, body)
+                return await self._submit_processing_async(loop, url, outpath, path, io_executor), len(body)
+            store = self.content_store or self.storage
+            await loop.run_in_executor(io_executor, self._save_and_raise, outpath, store.put_bytes, url, outpath, body)
+            return True, len(body)
+
+        if self.max_bytes_per_file is not None and response.content_length is not None \
+                and response.content_length > self.max_bytes_per_file:
+            logger.warning(f"Skip {response.url}, Content-Length {response.content_length} exceeds max_bytes_per_file")
+            return False, 0
+        if self.processor is not None:
+            writer = await loop.run_in_executor(io_executor, _TempFileWriter, self.processing_dir)
+        else:
+            store = self.content_store or self.storage
+            writer = await loop.run_in_executor(io_executor, store.open_writer, url, outpath)
+        try:
+            total = 0
+            async for chunk in response.content.iter_chunked(self.chunk_size):
+                total += len(chunk)
+                if max_bytes is not None and total > max_bytes:
+                    raise DownloadSizeExceeded("body of {} is larger than {} bytes".format(response.url, max_bytes))
+                await loop.run_in_executor(io_executor, writer.write, chunk)
+        except BaseException as e:
+            await loop.run_in_executor(io_executor, writer.abort)
+            if isinstance(e, DownloadSizeExceeded):
+                logger.warning(str(e))
+                return False, 0
+            raise
+        if self._is_too_small(url, total):
+            await loop.run_in_executor(io_executor, writer.abort)
+            return False, 0
+        if self.processor is not None:
+            await loop.run_in_executor(io_executor, writer.commit)
+            return await self._submit_processing_async(loop, url, outpath, writer.path, io_executor), total
+        await loop.run_in_executor(io_executor, self._save_and_raise, outpath, writer.commit)
+        return True, total
+
+    def _save_and_raise(self, outpath: str, save: Callable, *args):
+        # the save of _save_and_sync for the event loop, whose caller turns the OSError into a failed attempt
+        start = time.perf_counter()
+        try:
+            save(*args)
+        finally:
+            self.metrics.record_stage("save", time.perf_counter() - start)
+
+    async def _submit_processing_async(self, loop, url, outpath, path, io_executor) -> bool:
+        # submit waits while the processing stage is full, so it blocks an executor thread instead of the loop
+        saved = await loop.run_in_executor(io_executor, self._submit_processing, url, outpath, path)
+        if isinstance(saved, concurrent.futures.Future):
+            saved = await asyncio.wrap_future(saved)
+        return saved
+
+    async def _download_all_async(self, tasks: Iterable[Tuple[str, str]], batch_size: int):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        pending_results = ResultColumns()
+        in_flight = set()
+        # set when a download finishes, so a dispatcher waiting for a host slot tries again
+        wakeup = asyncio.Event()
+
+        async def flush():
+            nonlocal pending_results
+            results, pending_results = pending_results, ResultColumns()
+            await loop.run_in_executor(io_executor, self.write_results, results)
+            if self.result_sink is not None:
+                # waits for the consumer of iter_downloads, and the loop dispatches nothing meanwhile
+                await loop.run_in_executor(io_executor, self.result_sink, results)
+
+        next_ready = float("inf")
+
+        def try_start(host):
+            # as _DownloadPipeline._try_start, a host over its rate is deferred and the others go ahead
+            nonlocal next_ready
+            if not self.host_limiter.try_acquire(host):
+                return False
+            if self.rate_limiter is not None:
+                wait = self.rate_limiter.try_acquire(host)
+                if wait > 0:
+                    self.host_limiter.release(host)
+                    next_ready = min(next_ready, time.monotonic() + wait)
+                    return False
+            return True
+
+        def on_done(host, task):
+            in_flight.discard(task)
+            self.host_limiter.release(host)
+            semaphore.release()
+            wakeup.set()
+            pending_results.append(*task.result())
+
+        per_host_limits = [i for i in (self.max_connections_per_host, self.host_limiter.max_per_host) if i is not None]
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency,
+                                         limit_per_host=min(per_host_limits, default=0),
+                                         force_close=not self.keep_alive)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        self.metrics.set_stage("download", self.max_concurrency)
+        self.metrics.set_stage("save", self.num_thread)
+        if self.processor is not None:
+            processing = ProcessingStage(self.processor, self.process_workers, self.metrics, self.process_max_pending)
+            self.metrics.set_stage("process", processing.num_process, lambda: processing.num_pending)
+            self.processing = processing
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.num_thread) as io_executor:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.http_headers,
+                                             trace_configs=[self._make_trace_config()]) as session:
+                scheduler = HostScheduler((DownloadTask(url, outpath) for url, outpath in tasks), self.schedule_window,
+                                          self.priority_fn, self.deadline_fn)
+                while True:
+                    await semaphore.acquire()
+                    download = None
+                    while not self.stop_event.is_set():
+                        wakeup.clear()
+                        now = time.monotonic()
+                        next_ready = float("inf")
+                        rate_wait = 0.0 if self.rate_limiter is None else self.rate_limiter.get_global_wait()
+                        if self.paused_until > now:
+                            # too many consecutive errors, see format_result
+                            next_ready = self.paused_until
+                        elif rate_wait > 0:
+                            next_ready = now + rate_wait
+                        else:
+                            download = scheduler.next(try_start)
+                        while scheduler.expired:
+                            expired = scheduler.expired.popleft()
+                            pending_results.append(*self.make_expired_row(expired.url, expired.outpath))
+                        if download is not None or (scheduler.exhausted and not scheduler):
+                            break
+                        # no host can start now: wait for a download to finish, the pause to end or a rate limit to refill
+                        try:
+                            await asyncio.wait_for(wakeup.wait(), timeout=min(max(next_ready - now, 0), 1))
+                        except asyncio.TimeoutError:
+                            pass
+                    if download is None:
+                        semaphore.release()
+                        break
+                    task = asyncio.ensure_future(self.download_site_async(session, download.url, download.outpath, io_executor))
+                    in_flight.add(task)
+                    task.add_done_callback(functools.partial(on_done, download.host))
+                    if len(pending_results) >= batch_size or (self.result_sink is not None and pending_results):
+                        await flush()
+                while in_flight:
+                    if self.result_sink is None:
+                        await asyncio.wait(set(in_flight))
+                    else:
+                        # the results of the last urls go to the consumer as they finish, not all at the end
+                        await asyncio.wait(set(in_flight), return_when=asyncio.FIRST_COMPLETED)
+                        await flush()
+            await flush()
+        print("\n", end="", file=sys.stderr, flush=True)
+
+    def _download_tasks(self, tasks: Iterable[Tuple[str, str]], queue_size: Optional[int]=None):
+        with self._report_metrics():
+            try:
+                asyncio.run(self._download_all_async(self.filter_tasks(tasks), queue_size or 1024))
+            finally:
+                if self.processing is not None:
+                    self.processing.shutdown()
+                    self.processing = None
+                self.stop_event.clear()
+                self.storage.close()
+                self.resume_index.flush()
+
+    def download_all_sites(self, batch_size: int=1024):
+        """
+        This function downloads all urls on one event loop and appends the log every [batch_size] finished urls.
+
+        Parameters:
+            batch_size (int): the number of finished urls to collect before writing the log.
+        Returns:
+            None
+        """
+        self._download_tasks(self.iter_pending(), batch_size)
+
+
+def _run_shard(downloader_cls, url_list, local_output_path: str, shard_index: int, shard_count: int, kwargs: Dict):
+    downloader = downloader_cls(url_list, local_output_path, shard_index=shard_index, shard_count=shard_count, **kwargs)
+    downloader.download_all_sites()
+
+
+def run_sharded(url_list: Union[Iterable, str],
+                local_output_path: str,
+                num_process: int,
+                downloader_cls: type=None,
+                merge_logs: bool=True,
+                **kwargs):
+    """
+    This function downloads the input with [num_process] processes, one shard each, and waits for all of them.
+    Every process reads the whole input and keeps its own shard, so pass a manifest path or a list, not a one-shot iterator.
+    The processes are started with "spawn", so the arguments should be picklable; a manifest path is cheaper than a big list.
+    To scale out over several nodes, run URLDownloader_v2(..., shard_index=i, shard_count=n) on every node instead.
+
+    Parameters:
+        url_list (iterable or string): the urls to download, or the path to a manifest.
+        local_output_path (string): the output folder shared by the shards.
+        num_process (int): the number of processes, which is also the shard count.
+        downloader_cls (class): URLDownloader_v2 (the default) or one of its subclasses.
+        merge_logs (boolean): whether to merge the shard logs into downloaded.log at the end, see merge_shard_logs.
+        kwargs: other constructor arguments of downloader_cls, e.g. num_thread.
+
+    Returns:
+        None
+    """
+    downloader_cls = downloader_cls or URLDownloader_v2
+    os.makedirs(local_output_path, exist_ok=True)
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=_run_shard, name="downloader-shard-{}".format(i),
+                                 args=(downloader_cls, url_list, local_output_path, i, num_process, kwargs))
+                 for i in range(num_process)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    failed = [process.name for process in processes if process.exitcode != 0]
+    if merge_logs:
+        merge_shard_logs(local_output_path)
+    if failed:
+        raise RuntimeError("shards failed: {}, run again to resume them".format(", ".join(failed)))
+
+
+def merge_shard_logs(local_output_path: str, output_file: Optional[str]=None) -> int:
+    """
+    This function combines the shard logs of a folder into one log in the downloaded.log format.
+    The shards hold disjoint urls, so the lines of every url keep their order. The merged log is written
+    to a temp file and renamed, and it replaces [output_file]; the shard logs are kept, so shards can still resume.
+    The merged log is binary if any shard log is binary, else text.
+
+    Parameters:
+        local_output_path (string): the output folder of the shards.
+        output_file (string): the path to the merged log, local_output_path/downloaded.log by default.
+
+    Returns:
+        the number of merged lines (int)
+    """
+    output_file = output_file or os.path.join(local_output_path, "downloaded.log")
+    shard_logs = sorted(glob.glob(os.path.join(local_output_path, "downloaded.shard-*-of-*.log")))
+    log_format = "binary" if any(get_log_format(shard_log) == "binary" for shard_log in shard_logs) else "text"
+    num_lines = 0
+    tmp_file = output_file + ".merge"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+    writer = LogWriter(tmp_file, log_format, flush_interval=0, batch_size=1 << 16)
+    for shard_log in shard_logs:
+        # the last record of a shard that crashed mid-write is not read
+        entries = []
+        fps = []
+        for url, failed, fp in LogReader(shard_log):
+            entries.append((url, failed))
+            fps.append(fp)
+            if len(entries) >= writer.batch_size:
+                writer.write(entries, fps)
+                num_lines += len(entries)
+                entries, fps = [], []
+        writer.write(entries, fps)
+        num_lines += len(entries)
+    writer.close()
+    if not os.path.exists(tmp_file):
+        open(tmp_file, "w").close()
+    os.replace(tmp_file, output_file)
+    logger.info(f"Merged {len(shard_logs)} shard logs into {output_file} ({num_lines} lines)")
+    return num_lines
+
+
+def _write_file(outpath: str, body: bytes):
+    with open(outpath, "wb") as f:
+        f.write(body)
+
+
+def _write_temp_file(folder: str, body: bytes) -> str:
+    writer = _TempFileWriter(folder)
+    try:
+        writer.write(body)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+    return writer.path
+
+
+class _TempFileWriter:
+    """
+    This is a class for writing a body to a new temp file in [folder] that is kept on commit, e.g. for a processor.
+
+    Attributes:
+        path (string): the path to the temp file.
+    """
+    def __init__(self, folder: str):
+        fd, self.path = tempfile.mkstemp(dir=folder)
+        self._f = os.fdopen(fd, "wb")
+
+    def write(self, chunk) -> int:
+        return self._f.write(chunk)
+
+    def commit(self):
+        self._f.close()
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _PartFileWriter:
+    """
+    This is a class for writing a body to [outpath].part and renaming it to [outpath] on commit,
+    the same steps as stream_to_file split into calls that can run on an executor.
+    """
+    def __init__(self, outpath: str):
+        self.outpath = outpath
+        self.part_path = outpath + ".part"
+        self._f = open(self.part_path, "wb")
+
+    def write(self, chunk) -> int:
+        return self._f.write(chunk)
+
+    def commit(self):
+        self._f.close()
+        os.replace(self.part_path, self.outpath)
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
 
 
 if __name__ == "__main__":
-    import shutil
     if os.path.exists('test_out'):
         shutil.rmtree('test_out')
     sites = [